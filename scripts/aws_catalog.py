@@ -5,28 +5,327 @@ Initial focus will be on NEXRAD Level 2 radar data but eventually other
 data types could be included.
 
 Classes:
+    FileIndex
     NexradLevel2
 
+Functions:
+    scan_datetime
+    scan_times
+    match_volumes
+
 Created on Mon May  4 08:36:33 2020
 
 @author: eric.lenning
 """
 
-import sys
 import os
 import math
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import timedelta
 from datetime import datetime
-import s3fs
 import numpy as np
+import s3fs
+import instrument
 
+BUCKET = 'noaa-nexrad-level2'
+
+# bytes read from S3 per request while streaming a file to disk
+CHUNK_SIZE = 2**20
+# volumes fetched into memory spill to a temporary file above this size
+SPOOL_SIZE = 64 * 2**20
+
+
+def scan_datetime(filename):
+    """Volume scan time encoded in a level 2 filename.
+
+    Args:
+        filename: AWS filename or filepath, e.g. KDMX20180719_221153_V06
+
+    Returns:
+        A datetime, or None for files that are not radar volumes (such as
+        the _MDM metadata files).
+    """
+
+    filename = filename.split('/')[-1]
+    stamp = filename[4:19]
+    # strptime alone also takes short fields, e.g. 20180719_2211 as 22:01:01
+    digits = stamp[:8] + stamp[9:]
+    if 'MDM' in filename or len(stamp) != 15 or not digits.isascii() or \
+            not digits.isdigit():
+        return None
+    try:
+        return datetime.strptime(stamp, '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+
+def scan_times(filenames):
+    """Vectorized scan_datetime of many filenames.
+
+    The YYYYmmdd_HHMMSS characters at fixed positions of every filename
+    are decoded together as one array of bytes, so a day of listings
+    costs a few NumPy operations instead of a strptime call per file.
+
+    Args:
+        filenames: Sequence of AWS filenames or filepaths.
+
+    Returns:
+        A datetime64[s] array, NaT for files that are not radar volumes.
+    """
+
+    names = np.array([f.rsplit('/', 1)[-1] for f in filenames], dtype=str)
+    times = np.full(len(names), np.datetime64('NaT'), dtype='datetime64[s]')
+    if len(names) == 0:
+        return times
+
+    chars = np.frombuffer(names.astype('S19').tobytes(), dtype=np.uint8)
+    digits = chars.reshape(-1, 19)[:, 4:19].astype(np.int64) - ord('0')
+    date, clock = digits[:, :8], digits[:, 9:]
+    valid = ((digits[:, 8] == ord('_') - ord('0')) &
+             ((date >= 0) & (date <= 9)).all(axis=1) &
+             ((clock >= 0) & (clock <= 9)).all(axis=1) &
+             (np.char.find(names, 'MDM') < 0))
+
+    year = date[:, :4] @ [1000, 100, 10, 1]
+    month = date[:, 4:6] @ [10, 1]
+    day = date[:, 6:8] @ [10, 1]
+    seconds = clock @ [36000, 3600, 600, 60, 10, 1]
+    valid &= ((month >= 1) & (month <= 12) & (day >= 1) &
+              (clock[:, :2] @ [10, 1] < 24) & (clock[:, 2:4] @ [10, 1] < 60) &
+              (clock[:, 4:] @ [10, 1] < 60))
+
+    year, month, day, seconds = (a[valid] for a in (year, month, day,
+                                                    seconds))
+    months = ((year - 1970) * 12 + month - 1).astype('datetime64[M]')
+    days = months.astype('datetime64[D]') + (day - 1)
+    # a day past the end of its month (e.g. Feb 30) is not a valid name
+    in_month = days.astype('datetime64[M]') == months
+    valid[valid] = in_month
+    times[valid] = (days[in_month].astype('datetime64[s]') +
+                    seconds[in_month])
+    return times
+
+
+def _datetime64(values):
+    """ Datetimes (or datetime64s) as a datetime64[us] array. """
+
+    return np.asarray(values, dtype='datetime64[us]')
+
+
+class FileIndex():
+    """Level 2 files sorted by scan time.
+
+    Keeps the filepaths, sizes and scan times returned by a bucket listing
+    in parallel arrays (times as datetime64[s]), so time range and
+    matching queries are binary searches over the whole index at once.
+
+    Args:
+        entries: Iterable of (filepath, size, scan datetime) tuples.
+    """
+
+    MODES = ('nearest', 'before', 'after')
+
+    def __init__(self, entries=()):
+        entries = list(entries)
+        self._set(np.array([e[0] for e in entries], dtype=object),
+                  np.array([e[1] for e in entries], dtype=np.int64),
+                  np.array([e[2] for e in entries], dtype='datetime64[s]'))
+
+    def _set(self, keys, sizes, times):
+        order = np.argsort(times, kind='stable')
+        self.keys = keys[order]
+        self.sizes = sizes[order]
+        self.times = times[order]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(zip(self.keys, self.sizes.tolist(),
+                        self.times.astype(object)))
+
+    @classmethod
+    def from_arrays(cls, keys, sizes, times):
+        """Build an index from parallel arrays, in any order."""
+
+        index = cls()
+        index._set(np.asarray(keys, dtype=object),
+                   np.asarray(sizes, dtype=np.int64),
+                   np.asarray(times, dtype='datetime64[s]'))
+        return index
+
+    @classmethod
+    def from_listing(cls, listing):
+        """Build an index from the detailed output of fs.ls.
 
-class NexradLevel2():
+        Args:
+            listing: List of dicts with at least 'name' and 'size' keys.
+
+        Returns:
+            A FileIndex of the entries that are radar volumes.
+        """
+
+        keys = np.array([info['name'] for info in listing], dtype=object)
+        sizes = np.array([info['size'] for info in listing], dtype=np.int64)
+        times = scan_times(keys)
+        volumes = ~np.isnat(times)
+        return cls.from_arrays(keys[volumes], sizes[volumes], times[volumes])
+
+    def merge(self, other):
+        """ New index holding the entries of both indexes. """
+
+        return FileIndex.from_arrays(
+            np.concatenate([self.keys, other.keys]),
+            np.concatenate([self.sizes, other.sizes]),
+            np.concatenate([self.times, other.times]))
+
+    def between(self, start_datetime, end_datetime):
+        """ New index limited to an inclusive time range. """
+
+        lo = np.searchsorted(self.times, _datetime64(start_datetime), 'left')
+        hi = np.searchsorted(self.times, _datetime64(end_datetime), 'right')
+        index = FileIndex()
+        index.keys = self.keys[lo:hi]
+        index.sizes = self.sizes[lo:hi]
+        index.times = self.times[lo:hi]
+        return index
+
+    def after(self, last_datetime):
+        """ New index of the entries strictly after a time. """
+
+        lo = np.searchsorted(self.times, _datetime64(last_datetime), 'right')
+        index = FileIndex()
+        index.keys = self.keys[lo:]
+        index.sizes = self.sizes[lo:]
+        index.times = self.times[lo:]
+        return index
+
+    def match(self, times, mode='nearest', tolerance=None):
+        """Position of the entry matching each of many times.
 
-    def __init__(self, site, start_datetime, end_datetime):
+        Args:
+            times: Sequence of datetimes (or datetime64s).
+            mode: 'nearest', 'before' (the last entry at or before the
+                time) or 'after' (the first entry at or after it).  A tie
+                for nearest goes to the earlier entry.
+            tolerance: Optional timedelta; matches further away than this
+                count as no match.
+
+        Returns:
+            An int array with the position in the index of the match for
+            each time, -1 where there is none.
+        """
+
+        if mode not in self.MODES:
+            raise ValueError(f'mode must be one of {self.MODES}')
+        query = _datetime64(times)
+        n = len(self.times)
+        right = np.searchsorted(self.times, query, 'right')
+        if mode == 'before':
+            found = right - 1
+        elif mode == 'after':
+            found = np.searchsorted(self.times, query, 'left')
+        else:
+            before = right - 1
+            after = np.minimum(right, n - 1)
+            if n:
+                gap_before = query - self.times[np.maximum(before, 0)]
+                gap_after = self.times[after] - query
+                found = np.where((before >= 0) &
+                                 ((right >= n) | (gap_before <= gap_after)),
+                                 before, right)
+            else:
+                found = before
+
+        found = np.where((found >= 0) & (found < n), found, -1)
+        if tolerance is not None and n:
+            gap = np.abs(self.times[np.maximum(found, 0)] - query)
+            found[gap > np.timedelta64(tolerance)] = -1
+        return found
+
+
+def match_volumes(queries, mode='nearest', tolerance=timedelta(minutes=30),
+                  fs=None, bucket=BUCKET, cache=None):
+    """Volumes matching many (site, valid time) pairs in one call.
+
+    Each site is listed once, for every day within tolerance of any of its
+    times, and all of its times are then matched together by
+    FileIndex.match.  Listings go through the catalog cache when one is
+    given.
+
+    Args:
+        queries: Iterable of (site, datetime) pairs.
+        mode: 'nearest', 'before' or 'after', see FileIndex.match.
+        tolerance: Largest time difference accepted (timedelta).  It also
+            bounds the days listed.  None accepts any difference but lists
+            only the day of each time, so a match on another day is not
+            found.
+        fs: Filesystem shared by all sites, see NexradLevel2.
+        bucket: Bucket (or local stand-in directory).
+        cache: Optional catalog_cache.CatalogCache.
+
+    Returns:
+        A list with, for each query in order, the (filepath, scan
+        datetime) of the matching volume, or None.
+    """
+
+    queries = list(queries)
+    fs = fs if fs is not None else s3fs.S3FileSystem(anon=True)
+    by_site = {}
+    for n, (site, valid_time) in enumerate(queries):
+        by_site.setdefault(site, []).append(n)
+
+    # range of each time whose days are listed
+    span = timedelta(0) if tolerance is None else tolerance
+    results = [None] * len(queries)
+    for site, positions in by_site.items():
+        times = [queries[n][1] for n in positions]
+        nexrad = NexradLevel2(site, min(times) - span, max(times) + span,
+                              fs=fs, bucket=bucket, cache=cache)
+        days = set()
+        for t in times:
+            first, last = (t - span).date(), (t + span).date()
+            days.update(first + timedelta(n)
+                        for n in range((last - first).days + 1))
+        index = FileIndex()
+        for day in sorted(days):
+            index = index.merge(nexrad.list_day(datetime.combine(
+                day, datetime.min.time())))
+        found = index.match(times, mode, tolerance)
+        for n, i in zip(positions, found):
+            if i >= 0:
+                results[n] = (index.keys[i], index.times[i].astype(object))
+    return results
+
+
+class NexradLevel2():
+    """Level 2 files for one radar site and time range.
+
+    Args:
+        site: Radar identifier, e.g. KGRR
+        start_datetime: Start of the time range (UTC).
+        end_datetime: End of the time range (UTC).
+        fs: Filesystem with the s3fs ls/info/open interface.  Defaults to
+            an anonymous S3FileSystem.
+        bucket: Bucket (or local stand-in directory) holding the
+            YYYY/mm/dd/SITE/ tree.
+        cache: Optional catalog_cache.CatalogCache consulted before any
+            bucket listing is made.
+    """
+
+    def __init__(self, site, start_datetime, end_datetime, fs=None,
+                 bucket=BUCKET, cache=None):
         self.site = site
         self.start_datetime = start_datetime
         self.end_datetime = end_datetime
+        self.fs = fs if fs is not None else s3fs.S3FileSystem(anon=True)
+        self.bucket = bucket
+        self.cache = cache
+        # remote file sizes seen in listings, keyed by filepath
+        self.sizes = {}
 
     def daterange(self):
         """ Yields list of dates within specified time range. """
@@ -41,122 +340,281 @@ class NexradLevel2():
         for n in range(day_span):
             yield self.start_datetime + timedelta(n)
 
-    def filelist(self):
-        """ List of files for site within specified time range. """
+    def day_prefix(self, single_date):
+        """ Bucket directory holding one day of files for the site. """
 
-        fs = s3fs.S3FileSystem(anon=True)
-        fs.ls('s3://noaa-nexrad-level2/')
+        YYYY = single_date.year  # strftime("%Y")
+        mm = single_date.month  # strftime("%m")
+        dd = single_date.day  # strftime("%d")
 
-        radarfiles = []
+        # sample bucket dir : 'noaa-nexrad-level2/2018/07/19/KDMX/'
+        return f'{self.bucket}/{YYYY:.0f}/{mm:02.0f}/{dd:02.0f}/{self.site}/'
 
-        for single_date in self.daterange():
+    def list_day(self, single_date, refresh=False):
+        """Index of all files for the site on one day.
 
-            YYYY = single_date.year  # strftime("%Y")
-            mm = single_date.month  # strftime("%m")
-            dd = single_date.day  # strftime("%d")
+        Costs a single listing request; sizes come back with the listing so
+        no per-file info calls are needed.  With a cache, days that are
+        already complete cost no request at all.
 
-            # sample bucket dir : 'noaa-nexrad-level2/2018/07/19/KDMX/'
-            # broken into two substrings to stay <79 columns
-            bucket_str1 = f'noaa-nexrad-level2/{YYYY:.0f}/'
-            bucket_str2 = f'{mm:02.0f}/{dd:02.0f}/{self.site}/'
-            bucket_dir_str = bucket_str1 + bucket_str2
-            # list available files in bucket
-            # sample filename :  KDMX20180719_221153_V06
-            files = np.array(fs.ls(bucket_dir_str))
-
-            for f in range(0, len(files)):
+        Args:
+            single_date: Date to list (UTC).
+            refresh: If True, skip the catalog cache and any listing cached
+                by the filesystem itself.
+        """
 
-                filename = files[f].split('/')[-1]  # extracts fname after /
+        bucket_dir_str = self.day_prefix(single_date)
+        with instrument.span('list', prefix=bucket_dir_str) as attrs:
+            entries = None
+            if self.cache is not None and not refresh:
+                entries = self.cache.get(bucket_dir_str, single_date)
+
+            attrs['cached'] = entries is not None
+            if entries is not None:
+                index = FileIndex(entries)
+            else:
+                if refresh and hasattr(self.fs, 'invalidate_cache'):
+                    self.fs.invalidate_cache(bucket_dir_str)
+                try:
+                    listing = self.fs.ls(bucket_dir_str, detail=True)
+                except FileNotFoundError:
+                    listing = []
+                index = FileIndex.from_listing(listing)
+                if self.cache is not None:
+                    self.cache.put(bucket_dir_str, single_date, index)
+            attrs['files'] = len(index)
 
-                if 'MDM' not in filename:
-                    file_date = filename[4:19]
+        self.sizes.update(zip(index.keys, index.sizes))
+        return index
 
-                    try:
-                        file_datetime = datetime.strptime(file_date,
-                                                          '%Y%m%d_%H%M%S')
+    def inventory(self):
+        """ Index of files for site within specified time range. """
 
-                        if (file_datetime >= self.start_datetime
-                           and file_datetime <= self.end_datetime):
+        index = FileIndex()
+        for single_date in self.daterange():
+            index = index.merge(self.list_day(single_date))
 
-                            print(files[f])
+        return index.between(self.start_datetime, self.end_datetime)
 
-                            radarfiles.append(files[f])
+    def filelist(self):
+        """ List of files for site within specified time range. """
 
-                            info = fs.info(files[f])
+        index = self.inventory()
+        for key, size, _ in index:
+            print(key, "  size ", size)
 
-                            print("size ", info['size'])
+        return list(index.keys)
 
-                            print(info)
+    def watch(self, raw_data_dir, interval=60, max_interval=600,
+              now=datetime.utcnow, sleep=time.sleep, polls=None,
+              download=True, retries=3):
+        """Follow the site in real time and download each new volume.
 
-                    except Exception:
-                        print("Unexpected error:", sys.exc_info()[0])
+        Every poll is a single listing of the current day's prefix (plus
+        the previous day's right after midnight, to catch the last volume
+        of that day).  Only volumes newer than the last one seen are
+        downloaded.  A volume whose download fails is tried again on the
+        following polls, up to retries more times.  When a poll finds
+        nothing new and nothing to retry the wait before the next poll
+        doubles, up to max_interval, and resets once a volume arrives.
 
-        return radarfiles
+        Args:
+            raw_data_dir: Full pathname of download destination.
+            interval: Seconds between polls while volumes are arriving.
+            max_interval: Longest wait between polls when nothing arrives.
+            now: Callable returning the current UTC datetime.
+            sleep: Callable used to wait between polls.
+            polls: Stop after this many polls; None polls forever.
+            download: If False, new volumes are only yielded, with a None
+                result, e.g. to read their lowest cuts straight from the
+                bucket with level2.read_remote.
+            retries: Times a failed download is tried again.
+
+        Yields:
+            (aws_filepath, result) for each new volume, where result is
+            the dict returned by download_file().  The first poll yields
+            the volumes at or after start_datetime.  A failed volume is
+            yielded again with the result of each retry.
+        """
 
-    def download(self, filelist, raw_data_dir):
+        # scan time of the newest volume handled so far; filenames carry
+        # whole seconds, so this lets the first poll include start_datetime
+        last_time = self.start_datetime - timedelta(seconds=1)
+        wait = interval
+        poll_count = 0
+        # failed downloads still to retry -> attempts so far
+        failed = {}
+
+        while polls is None or poll_count < polls:
+            current = now()
+            days = [current]
+            if last_time.date() < current.date():
+                days.insert(0, last_time)
+
+            index = FileIndex()
+            for single_date in days:
+                index = index.merge(self.list_day(single_date, refresh=True))
+
+            new = index.after(last_time)
+            new_keys = list(new.keys)
+            if new_keys:
+                last_time = new.times[-1].astype(object)
+
+            # keys sort by day and then scan time, so retries come in order
+            for aws_filepath in sorted(set(failed) | set(new_keys)):
+                if not download:
+                    yield aws_filepath, None
+                    continue
+                result = self.download_file(aws_filepath, raw_data_dir)
+                attempts = failed.pop(aws_filepath, 0) + 1
+                if result['status'] == 'failed':
+                    if attempts <= retries:
+                        failed[aws_filepath] = attempts
+                    else:
+                        print('  Giving up on  ' + aws_filepath)
+                yield aws_filepath, result
+
+            poll_count += 1
+            wait = (interval if new_keys or failed
+                    else min(wait * 2, max_interval))
+            if polls is None or poll_count < polls:
+                sleep(wait)
+
+    def download(self, filelist, raw_data_dir, workers=8):
         """Download level 2 radar files from AWS.
 
         Files will be named according to the format on AWS but assumes nothing
         about the destination folder.  self is because different users may
         have different requirements for where data should be stored.
 
+        Files are fetched concurrently by a bounded pool of worker threads.
+        A download is first written to a ``.part`` file next to its
+        destination, so an interrupted run resumes from the bytes already on
+        disk instead of starting over.
+
         Args:
             filelist: A list of files in the AWS NEXRAD inventory.
             raw_data_dir: Full pathname of download destination.
+            workers: Maximum number of files fetched at the same time.
 
         Returns:
-            The return value. True for success, False otherwise.
+            A dict keyed by AWS filepath.  Each value is a dict holding the
+            'status' ('downloaded', 'resumed', 'exists' or 'failed'), the
+            local 'path', the number of 'bytes' transferred and the 'error'
+            message for failures (None otherwise).
         """
 
         os.makedirs(raw_data_dir, exist_ok=True)
 
-        fs = s3fs.S3FileSystem(anon=True)
-
         # https://noaa-nexrad-level2.s3.amazonaws.com/
         #           2015/04/10/KLOT/KLOT20150410_235635_V06.gz
         # sample filename :  KDMX20180719_221153_V06
 
-        # downloaded = []
-
-        download_count = 0
-
         # sample source filepath
         # 'noaa-nexrad-level2/2018/07/19/KDMX/KDMX20180719_221153_V06'
-        for f in range(0, len(filelist)):
-            try:
-                print('getting... ' + str(filelist[f]))
-                dst_filepath = os.path.join(raw_data_dir,
-                                            filelist[f].split('/')[-1])
+        results = {}
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = {pool.submit(self.download_file, f,
+                                   raw_data_dir): f for f in filelist}
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
 
-                print('...to ', dst_filepath)
+        # keep the caller's ordering
+        return {f: results[f] for f in filelist}
 
-                info = fs.info(filelist[f])
+    def fetch(self, aws_filepath, max_memory=SPOOL_SIZE):
+        """Read a level 2 file into memory instead of downloading it.
 
-                remote_filesize = info['size']
+        The file is streamed into a SpooledTemporaryFile, which only
+        spills to a temporary file on disk when it grows past max_memory
+        bytes.  Nothing is written to raw_data_dir, and the buffer is gone
+        once closed.  pyart and level2.read_volume decode it directly.
 
-                try:
-                    stat = os.stat(dst_filepath)
-                    print(stat)
-                    local_filesize = stat.st_size
-
-                    print('remote and local filesize: ',
-                          remote_filesize, local_filesize)
-
-                    if local_filesize < remote_filesize:
-                        raise Exception('File exists but is too small.')
-
-                    print('Already downloaded.')
-                    download_count += 1
-                except Exception:
-                    fs.get(filelist[f], dst_filepath)  # download to dest dir
-                    print('  Download complete!')
-                    download_count += 1
-                    # downloaded.append(filelist[f])
-            except Exception:
-                pass
-
-        # Tell caller if you got all the files it wanted.
-        if download_count == len(filelist):
-            return True
-        else:
-            return False
+        Args:
+            aws_filepath: File in the AWS NEXRAD inventory.
+            max_memory: Largest size in bytes kept in memory.
+
+        Returns:
+            The file object, rewound.  Close it (or use it in a with
+            statement) once the volume is decoded.
+        """
+
+        spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+        try:
+            with instrument.span('fetch', file=aws_filepath) as attrs, \
+                    self.fs.open(aws_filepath, 'rb') as src:
+                shutil.copyfileobj(src, spool, CHUNK_SIZE)
+                attrs['bytes'] = spool.tell()
+        except BaseException:
+            spool.close()
+            raise
+        spool.seek(0)
+        return spool
+
+    def download_file(self, aws_filepath, raw_data_dir):
+        """Download (or resume) a single level 2 file.
+
+        The remote size comes from an earlier listing when there is one, so
+        only files that were never listed cost an extra info call.
+
+        Args:
+            aws_filepath: File in the AWS NEXRAD inventory.
+            raw_data_dir: Full pathname of download destination.
+
+        Returns:
+            A result dict as described in download().
+        """
+
+        dst_filepath = os.path.join(raw_data_dir,
+                                    aws_filepath.split('/')[-1])
+        part_filepath = dst_filepath + '.part'
+        result = {'status': 'failed', 'path': dst_filepath, 'bytes': 0,
+                  'error': None}
+
+        with instrument.span('download', file=aws_filepath) as attrs:
+            try:
+                print('getting... ' + str(aws_filepath))
+                os.makedirs(raw_data_dir, exist_ok=True)
+                remote_filesize = self.sizes.get(aws_filepath)
+                if remote_filesize is None:
+                    remote_filesize = self.fs.info(aws_filepath)['size']
+                    self.sizes[aws_filepath] = remote_filesize
+
+                if (os.path.exists(dst_filepath)
+                   and os.path.getsize(dst_filepath) >= remote_filesize):
+                    print('Already downloaded.  ' + dst_filepath)
+                    result['status'] = 'exists'
+                    return result
+
+                offset = 0
+                if os.path.exists(part_filepath):
+                    offset = os.path.getsize(part_filepath)
+                    if offset > remote_filesize:
+                        offset = 0
+
+                mode = 'ab' if offset else 'wb'
+                with self.fs.open(aws_filepath, 'rb') as src, \
+                        open(part_filepath, mode) as dst:
+                    src.seek(offset)
+                    while True:
+                        block = src.read(CHUNK_SIZE)
+                        if not block:
+                            break
+                        dst.write(block)
+                        result['bytes'] += len(block)
+
+                if os.path.getsize(part_filepath) < remote_filesize:
+                    raise IOError('File is smaller than the remote copy.')
+
+                os.replace(part_filepath, dst_filepath)
+                result['status'] = 'resumed' if offset else 'downloaded'
+                print('  Download complete!  ' + dst_filepath)
+
+            except Exception as e:
+                result['error'] = str(e)
+                print('  Download failed: ' + str(aws_filepath), e)
+            finally:
+                attrs.update(status=result['status'],
+                             bytes=result['bytes'], error=result['error'])
+
+        return result
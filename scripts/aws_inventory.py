@@ -6,7 +6,6 @@ Created on Wed Feb 26 18:30:54 2020
 """
 # Here we use Amazon AWS to download and process the desired radar data
 import s3fs
-import numpy as np
 from datetime import datetime
 from datetime import timedelta
 import math
@@ -40,6 +39,11 @@ from reference_data import set_paths
 data_dir,image_dir,archive_dir,gis_dir,py_call,placefile_dir = set_paths()
 
 from custom_cmaps import plts
+from aws_catalog import NexradLevel2
+from places import load_places
+from level2 import read_volume
+import sweeps
+import instrument
 #from gis_layers import pyart_gis_layers
 #shape_mini = pyart_gis_layers()
 
@@ -73,52 +77,9 @@ class Nexrad():
         aws_file_list : list
             a list of aws filepaths that meet the search criteria
         """
-
-        aws_file_list = []
-        fs = s3fs.S3FileSystem(anon=True)
-        fs.ls('s3://noaa-nexrad-level2/')
-
-        for single_date in self.daterange():
-
-            YYYY = single_date.year # strftime("%Y")
-            mm = single_date.month # strftime("%m")
-            dd = single_date.day # strftime("%d")
-
-            # example AWS bucket directory  : 'noaa-nexrad-level2/2018/07/19/KDMX/'
-            bucket_dir_str = f'noaa-nexrad-level2/{YYYY:.0f}/{mm:02.0f}/{dd:02.0f}/{self.site}/'
-            #print(bucket_dir_str)
-            # list available files in bucket
-            # sample filename :  KDMX20180719_221153_V06
-            files = np.array(fs.ls(bucket_dir_str))
-
-            for f in range(0, len(files)):
-                #print(files[f])
-                filename = files[f].split('/')[-1]  # this extracts filename only after last '/'
-
-                # searching for YYYYMMDD_HHmmss string in filename
-                p = re.compile('[0-9]{8}_[0-9]{6}')
-                m = p.search(filename)
-
-                try:
-                    file_datetime = datetime.strptime(m.group(0), '%Y%m%d_%H%M%S')
-
-                    if (file_datetime >= self.start_datetime and
-                        file_datetime <= self.end_datetime):
-
-                        aws_file_list.append(files[f])
-                        #print('aws file ... ' + str(files[f]))
-
-                        #try:
-                        #    yield files[f]
-                        #except GeneratorExit:
-                        #    print("Need to do some clean up.")
-                        #    pass
-                        
-
-                except:
-                    pass
-
-        return aws_file_list
+        # one listing per day, sizes included, see aws_catalog.FileIndex
+        catalog = NexradLevel2(self.site, self.start_datetime, self.end_datetime)
+        return catalog.filelist()
 
     def download_files(self,plot=True):
         """
@@ -132,9 +93,9 @@ class Nexrad():
         print('\ndownload directory  ....  ' + str(download_dir) + '\n')
         os.makedirs(download_dir,exist_ok=True)
         fs = s3fs.S3FileSystem(anon=True)
-        fs.ls('s3://noaa-nexrad-level2/')
-        for f in range(0, len(self.aws_files())):
-            filepath = self.aws_files()[f]
+        aws_file_list = self.aws_files()
+        for f in range(0, len(aws_file_list)):
+            filepath = aws_file_list[f]
 
             #print('downloading ... ' + str(filepath))
             filename = filepath.split('/')[-1]
@@ -148,7 +109,9 @@ class Nexrad():
                 pass
             else:
                 print(filename + '  ....  downloading ')
-                fs.get(filepath,test_path)
+                with instrument.span('download', file=filepath) as attrs:
+                    fs.get(filepath,test_path)
+                    attrs['bytes'] = os.path.getsize(test_path)
                 print(test_path)
 
             if plot:
@@ -161,29 +124,13 @@ class Nexrad():
     def get_places(self,xmin,xmax,ymin,ymax):
     
         src = 'C:/data/GIS/places/places_conus.csv'
-            
-        places = []
-        with open(src) as fp:  
-            content = fp.read().splitlines()
-            for line in content:
-                test = line.split(',')
-                place = test[0]
-                lat = test[-2][:6]
-                lon = test[-1][:7]
-                try:
-                    float(lon)
-                    if float(lon) > xmin and float(lon) < xmax:
-                        if float(lat) > ymin and float(lat) < ymax:
-                            places.append([place,lon,lat])
-                except:
-                    pass
-        
-        return places
+        # parsed once per process, see places.PlaceIndex
+        return load_places(src).places(xmin, xmax, ymin, ymax)
 
 
 
     def nexrad_location(self,filepath,dx=1,dy=1):
-        radar = pyart.io.read_nexrad_archive(self.download_files()[0])
+        radar = read_volume(self.download_files()[0], fields=[], cuts=[5])
         self.nexrad_lon = radar.longitude['data'][0]
         self.nexrad_lat = radar.latitude['data'][0]
         
@@ -196,19 +143,7 @@ class Nexrad():
 
 
     def extract_sweeps(self,orig_list,cut):
-        sweep_list = [int(round(x*10)) for x in orig_list]
-        cut_list = []
-        found_cut = False
-        for t in range (0,len(sweep_list)):
-
-            if sweep_list[t] == cut and found_cut is False:
-
-                cut_list.append(t)       
-                found_cut = True
-            elif sweep_list[t] == cut and found_cut is True:
-                found_cut = False
-
-        return cut_list
+        return [int(t) for t in sweeps.select(sweeps.classify(orig_list), cut)]
 
     def format_name(self,title_str):
         #'KILX 0.5 Deg. 2019-06-16T03:01:10.802000Z \nEquivalent reflectivity factor'
@@ -266,7 +201,8 @@ class Nexrad():
         title = datetime.strftime(local_dt_obj, '%a %b %d, %Y\n%I:%M %p EDT')
 
         #filename = filepath.split('\\')[-1]
-        radar = pyart.io.read_nexrad_archive(filepath)
+        with instrument.span('decode', file=os.path.basename(filepath)):
+            radar = read_volume(filepath, fields=prods, cuts=[5])
         display = pyart.graph.RadarMapDisplay(radar)
 
         angles = list(radar.fixed_angle['data'])
@@ -280,9 +216,9 @@ class Nexrad():
         ymin = rda_lat - dy
         ymax = rda_lat + dy
 
+        locations = self.get_places(xmin, xmax, ymin, ymax)
         for s in these_sweeps:
 
-            locations = self.get_places(xmin, xmax, ymin, ymax)
             fig = plt.figure(figsize=(6,6))
             title = display.generate_title('reflectivity',1)
             #title = 'hi'
@@ -317,7 +253,8 @@ class Nexrad():
             #fname = "{}_{}.png".format(fname_dt,el)
             fname = "{}_ref.png".format(fname_dt)
             image_dst_path = os.path.join(self.image_dest_dir,fname)
-            plt.savefig(image_dst_path,format='png',bbox_inches="tight", dpi=150)
+            with instrument.span('savefig', file=os.path.basename(filepath), sweep=int(s)):
+                plt.savefig(image_dst_path,format='png',bbox_inches="tight", dpi=150)
             print('  Image saved at  ' + image_dst_path)
             plt.close()
 
@@ -0,0 +1,348 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the download -> decode -> render pipeline.
+
+Runs every stage against level 2 files already on disk, so results do not
+depend on the network.  The files are staged into a local directory laid
+out like the AWS bucket (YYYY/mm/dd/SITE/), which NexradLevel2 lists and
+downloads from through an fsspec LocalFileSystem.  Stages timed:
+
+    list            NexradLevel2.filelist of the staged day
+    download        NexradLevel2.download_file, per volume (also MB/s)
+    decode          pyart.io.read_nexrad_archive, per volume
+    extract_sweeps  pyart_plot.extract_sweeps of the 0.5 degree cut
+    get_places      pyart_plot.get_places around the radar
+    render          FrameRenderer.render, per frame
+    render_fast     fast_render.render_sweep, per frame
+
+Each stage reports the number of samples, p50/p95/mean/max in seconds and
+the peak resident memory of the process after the stage.  Peak RSS only
+grows, so stages are run in the order above.  Results are written as JSON
+and two result files can be compared, e.g. before and after a change:
+
+    python benchmark.py /data/KGRR -o new.json --compare old.json
+
+Functions:
+    stage_bucket
+    run
+    compare
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from fsspec.implementations.local import LocalFileSystem
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+from aws_catalog import NexradLevel2, scan_datetime
+
+STAGES = ('list', 'download', 'decode', 'extract_sweeps', 'get_places',
+          'render', 'render_fast')
+
+
+def peak_rss_mb():
+    """ Peak resident memory of this process in MB, None if unknown. """
+
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return peak / 2**20
+    return peak / 2**10
+
+
+def summarize(samples, **extra):
+    """ Statistics of a list of durations in seconds. """
+
+    summary = {'n': len(samples), 'p50': None, 'p95': None, 'mean': None,
+               'max': None}
+    if samples:
+        values = np.asarray(samples)
+        summary.update(p50=float(np.percentile(values, 50)),
+                       p95=float(np.percentile(values, 95)),
+                       mean=float(values.mean()), max=float(values.max()))
+    summary['peak_rss_mb'] = peak_rss_mb()
+    summary.update(extra)
+    return summary
+
+
+def timed(func, *args, **kwargs):
+    """ Call func with its progress prints silenced; (seconds, result). """
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        return time.perf_counter() - start, result
+
+
+def stage_bucket(filepaths, bucket_dir):
+    """
+    Lay out level 2 files like the AWS bucket.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        local level 2 files, named like KGRR20200408_000300_V06
+    bucket_dir : str
+        root of the stand-in bucket
+
+    Returns
+    -------
+    days : dict
+        (site, date) -> list of the staged filepaths of that day
+
+    """
+    days = {}
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        scan_time = scan_datetime(filename)
+        if scan_time is None:
+            continue
+        site = filename[:4]
+        day_dir = os.path.join(bucket_dir, scan_time.strftime('%Y/%m/%d'),
+                               site)
+        os.makedirs(day_dir, exist_ok=True)
+        dst = os.path.join(day_dir, filename)
+        try:
+            os.link(filepath, dst)
+        except OSError:
+            shutil.copyfile(filepath, dst)
+        days.setdefault((site, scan_time.date()), []).append(dst)
+    return days
+
+
+def run(filepaths, work_dir, repeat=3, render=True, places=True):
+    """
+    Time every stage of the pipeline.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        local level 2 files
+    work_dir : str
+        scratch directory for the staged bucket, downloads and images
+    repeat : int, optional
+        times the list stage and the downloads are repeated.
+        The default is 3.
+    render : bool, optional
+        set False to skip the matplotlib/cartopy render stage
+    places : bool, optional
+        set False to skip get_places, which needs the GIS files of
+        configlocal
+
+    Returns
+    -------
+    results : dict
+        'environment' and 'stages', see the module docstring
+
+    """
+    fs = LocalFileSystem()
+    bucket_dir = os.path.join(work_dir, 'bucket')
+    days = stage_bucket(filepaths, bucket_dir)
+    if not days:
+        raise ValueError('no level 2 files among the inputs')
+    stages = {}
+
+    listing, keys = [], []
+    for _ in range(repeat):
+        keys = []
+        for site, day in days:
+            start = datetime.combine(day, datetime.min.time())
+            end = datetime.combine(day, datetime.max.time())
+            nexrad = NexradLevel2(site, start, end, fs=fs, bucket=bucket_dir)
+            seconds, filelist = timed(nexrad.filelist)
+            listing.append(seconds)
+            keys.extend((nexrad, key) for key in filelist)
+    stages['list'] = summarize(listing, files=len(keys))
+
+    downloaded, bytes_total = [], 0
+    local_paths = []
+    for attempt in range(repeat):
+        raw_dir = os.path.join(work_dir, f'raw{attempt}')
+        for nexrad, key in keys:
+            seconds, result = timed(nexrad.download_file, key, raw_dir)
+            if result['status'] == 'failed':
+                raise IOError(result['error'])
+            downloaded.append(seconds)
+            bytes_total += result['bytes']
+            if attempt == 0:
+                local_paths.append(result['path'])
+        if attempt:
+            shutil.rmtree(raw_dir, ignore_errors=True)
+    mb_per_s = bytes_total / 2**20 / max(sum(downloaded), 1e-9)
+    stages['download'] = summarize(downloaded, mb_per_s=mb_per_s)
+
+    # heavy imports are left out of the listing and download timings
+    import pyart
+    import pyart_plot
+    import fast_render
+    from frame_renderer import FrameRenderer
+    from gate_cache import GateCache
+    from radar_cmaps import plts
+
+    decoded, radars = [], []
+    for filepath in local_paths:
+        seconds, radar = timed(pyart.io.read_nexrad_archive, filepath)
+        decoded.append(seconds)
+        radars.append(radar)
+    stages['decode'] = summarize(decoded)
+
+    extracted, frames = [], []
+    for filepath, radar in zip(local_paths, radars):
+        seconds, cut_list = timed(pyart_plot.extract_sweeps,
+                                  radar.fixed_angle['data'], 5)
+        extracted.append(seconds)
+        frames.extend((filepath, radar, s) for s in cut_list)
+    stages['extract_sweeps'] = summarize(extracted)
+
+    extents = {}
+    for radar in radars:
+        rda_lon = float(radar.longitude['data'][0])
+        rda_lat = float(radar.latitude['data'][0])
+        extents[id(radar)] = (rda_lon - 0.75, rda_lon + 0.75,
+                              rda_lat - 0.75, rda_lat + 0.75)
+
+    if places:
+        searched = []
+        for radar in radars:
+            xmin, xmax, ymin, ymax = extents[id(radar)]
+            seconds, _ = timed(pyart_plot.get_places, xmin, xmax, ymin, ymax,
+                               min_distance=0.1)
+            searched.append(seconds)
+        stages['get_places'] = summarize(searched)
+
+    image_dir = os.path.join(work_dir, 'images')
+    os.makedirs(image_dir, exist_ok=True)
+    if render:
+        rendered, renderer = [], None
+        try:
+            for n, (filepath, radar, s) in enumerate(frames):
+                if renderer is None:
+                    # static layers are drawn once, as in render_loop, and
+                    # the gate grid is projected on the first frame only
+                    renderer = FrameRenderer(
+                        float(radar.latitude['data'][0]),
+                        float(radar.longitude['data'][0]),
+                        extents[id(radar)], cmap=plts['Ref']['cmap'],
+                        vmin=-30, vmax=80, cblabel=plts['Ref']['cblabel'],
+                        gate_cache=GateCache())
+                image_path = os.path.join(image_dir, f'frame{n}.png')
+                seconds, _ = timed(renderer.render, radar, s, 'reflectivity',
+                                   os.path.basename(filepath), image_path)
+                rendered.append(seconds)
+        finally:
+            if renderer is not None:
+                renderer.close()
+        stages['render'] = summarize(rendered)
+
+    fast = []
+    for n, (filepath, radar, s) in enumerate(frames):
+        image_path = os.path.join(image_dir, f'fast{n}.png')
+        seconds, _ = timed(fast_render.render_sweep, radar, s,
+                           'reflectivity', 'Ref', extents[id(radar)],
+                           image_path)
+        fast.append(seconds)
+    stages['render_fast'] = summarize(fast)
+
+    return {'environment': environment(), 'stages': stages}
+
+
+def environment():
+    """ Versions and machine the results were measured with. """
+
+    import pyart
+    try:
+        revision = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {'revision': revision, 'time': datetime.utcnow().isoformat(),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'pyart': pyart.__version__, 'machine': platform.platform(),
+            'cpus': os.cpu_count()}
+
+
+def compare(old, new):
+    """
+    Print the change of p50 and p95 of every stage between two results.
+
+    Parameters
+    ----------
+    old, new : dict
+        results of run, e.g. loaded from the JSON files
+
+    """
+    print(f'{"stage":16}{"p50 old":>10}{"p50 new":>10}{"change":>9}'
+          f'{"p95 old":>10}{"p95 new":>10}{"change":>9}')
+    for stage in STAGES:
+        a = old['stages'].get(stage)
+        b = new['stages'].get(stage)
+        if not a or not b or a['p50'] is None or b['p50'] is None:
+            continue
+        row = f'{stage:16}'
+        for stat in ('p50', 'p95'):
+            change = (b[stat] - a[stat]) / a[stat] * 100 if a[stat] else 0.0
+            row += f'{a[stat]:10.4f}{b[stat]:10.4f}{change:+8.1f}%'
+        print(row)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('inputs', nargs='+',
+                        help='level 2 files or directories holding them')
+    parser.add_argument('-o', '--output', default='benchmark.json',
+                        help='JSON results file (default benchmark.json)')
+    parser.add_argument('-n', '--repeat', type=int, default=3,
+                        help='repeats of the list and download stages')
+    parser.add_argument('--compare', metavar='OLD_JSON',
+                        help='earlier results to compare against')
+    parser.add_argument('--no-render', action='store_true',
+                        help='skip the matplotlib render stage')
+    parser.add_argument('--no-places', action='store_true',
+                        help='skip the get_places stage')
+    args = parser.parse_args()
+
+    filepaths = []
+    for path in args.inputs:
+        if os.path.isdir(path):
+            filepaths.extend(sorted(os.path.join(path, f)
+                                    for f in os.listdir(path)))
+        else:
+            filepaths.append(path)
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run(filepaths, work_dir, repeat=args.repeat,
+                      render=not args.no_render, places=not args.no_places)
+
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print('Results written to  ' + args.output)
+    for stage, summary in results['stages'].items():
+        if summary['n']:
+            print(f'  {stage:16} n={summary["n"]:<4} '
+                  f'p50={summary["p50"]:.4f}s  p95={summary["p95"]:.4f}s  '
+                  f'peak RSS {summary["peak_rss_mb"]} MB')
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), results)
+
+
+if __name__ == '__main__':
+    main()
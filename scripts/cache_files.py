@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+"""
+Reading and writing the files of the on-disk caches.
+
+Several processes (render workers, later runs) share the cache files.  A
+file is written under a temporary name unique to the process and renamed
+into place, so readers only ever see complete files and parallel writers
+of the same entry never share a temporary file.  A file that cannot be
+read, e.g. one written by an incompatible version, counts as missing so
+the entry is simply rebuilt.
+
+Functions:
+    read
+    write
+"""
+
+import os
+
+
+def read(path, load):
+    """
+    Contents of a cache file, or None when it is missing or unreadable.
+
+    Parameters
+    ----------
+    path : str
+    load : callable
+        load(path) returns the contents
+
+    """
+    if not os.path.exists(path):
+        return None
+    try:
+        return load(path)
+    except Exception:
+        return None
+
+
+def write(path, save, suffix=''):
+    """
+    Write a cache file atomically.
+
+    Parameters
+    ----------
+    path : str
+    save : callable
+        save(tmp_path) writes the contents to tmp_path
+    suffix : str, optional
+        ending of the temporary name, for writers that add one themselves
+        (np.savez appends '.npz').  The default is ''.
+
+    """
+    tmp_path = f'{path}.{os.getpid()}.tmp{suffix}'
+    try:
+        save(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
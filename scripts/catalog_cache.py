@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of AWS level 2 bucket listings.
+
+Listings are stored in a small SQLite database, one row per file with the
+filepath, size and scan time.  A day that was listed after it ended (plus a
+grace period for late arriving volumes) never changes again, so it is served
+from the cache forever.  Listings for the current day are refreshed once they
+are older than the TTL.
+
+Classes:
+    CatalogCache
+"""
+
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+from datetime import datetime, timedelta
+
+# volumes keep arriving for a few minutes after the end of their day
+GRACE = timedelta(hours=1)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS listings (
+    prefix TEXT PRIMARY KEY,
+    day TEXT NOT NULL,
+    fetched REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    prefix TEXT NOT NULL,
+    key TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    scan_time TEXT NOT NULL,
+    PRIMARY KEY (prefix, key)
+);
+"""
+
+
+class CatalogCache():
+    """Listings of site/day bucket prefixes kept on disk.
+
+    Args:
+        path: Full pathname of the SQLite database file.
+        ttl: Seconds a listing of a day that is not yet complete stays
+            valid.
+    """
+
+    def __init__(self, path, ttl=300):
+        self.path = path
+        self.ttl = ttl
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with self._connect() as con:
+            con.executescript(SCHEMA)
+
+    @contextmanager
+    def _connect(self):
+        # the inner with commits (or rolls back); closing releases the file
+        with closing(sqlite3.connect(self.path, timeout=30)) as con, con:
+            yield con
+
+    def is_fresh(self, single_date, fetched, now=None):
+        """True if a listing fetched at `fetched` (epoch seconds) is usable.
+
+        Args:
+            single_date: Date the listing covers (UTC).
+            fetched: Epoch seconds when the listing was made.
+            now: Epoch seconds to compare against; defaults to time.time().
+        """
+
+        now = time.time() if now is None else now
+        day_end = datetime(single_date.year, single_date.month,
+                           single_date.day) + timedelta(days=1)
+        complete_after = (day_end + GRACE - datetime(1970, 1, 1))
+        if fetched >= complete_after.total_seconds():
+            return True
+        return now - fetched < self.ttl
+
+    def get(self, prefix, single_date, now=None):
+        """Cached entries for a prefix, or None when a listing is needed.
+
+        Args:
+            prefix: Bucket directory that was listed.
+            single_date: Date the prefix covers (UTC).
+            now: Epoch seconds to compare against; defaults to time.time().
+
+        Returns:
+            A list of (filepath, size, scan datetime) tuples, or None.
+        """
+
+        with self._connect() as con:
+            row = con.execute('SELECT fetched FROM listings WHERE prefix = ?',
+                              (prefix,)).fetchone()
+            if row is None or not self.is_fresh(single_date, row[0], now):
+                return None
+            rows = con.execute('SELECT key, size, scan_time FROM files '
+                               'WHERE prefix = ?', (prefix,)).fetchall()
+
+        return [(key, size, datetime.fromisoformat(scan_time))
+                for key, size, scan_time in rows]
+
+    def put(self, prefix, single_date, entries, now=None):
+        """Replace the cached listing of a prefix.
+
+        Args:
+            prefix: Bucket directory that was listed.
+            single_date: Date the prefix covers (UTC).
+            entries: Iterable of (filepath, size, scan datetime) tuples.
+            now: Epoch seconds of the listing; defaults to time.time().
+        """
+
+        now = time.time() if now is None else now
+        rows = [(prefix, key, int(size), scan_time.isoformat(sep=' '))
+                for key, size, scan_time in entries]
+        with self._connect() as con:
+            con.execute('DELETE FROM files WHERE prefix = ?', (prefix,))
+            con.executemany('INSERT INTO files VALUES (?, ?, ?, ?)', rows)
+            con.execute('INSERT OR REPLACE INTO listings VALUES (?, ?, ?)',
+                        (prefix, single_date.strftime('%Y-%m-%d'), now))
@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+"""
+Real-time ingest of level 2 volumes from the chunks bucket.
+
+The archive bucket only gets a volume once the whole scan has finished.
+The chunks bucket gets it while it is being scanned, as a series of
+objects laid out as
+
+    SITE/VOLNUM/YYYYMMDD-HHMMSS-NNN-T
+
+where VOLNUM counts volumes from 1 to 999 and then starts over, NNN counts
+the chunks of a volume and T is S (start: volume header and metadata),
+I (intermediate) or E (end of the volume).  Every chunk holds complete LDM
+records, so appending the chunks in order rebuilds the Archive II file.
+
+ChunkIngester polls the volume being scanned and appends each new chunk to
+the volume so far.  Each new record is decompressed only to find the
+radials that end a scan (see level2.fetch_cuts), so every sweep is
+published as soon as its last chunk arrives.  The 0.5 degree images then
+come a minute or so after that cut is scanned, not after the volume.
+
+For testing, a local directory with the same layout stands in for the
+bucket (bucket=that directory, fs=fsspec LocalFileSystem); stage_chunks
+splits an existing volume into such a directory.
+
+Classes:
+    ChunkIngester
+
+Functions:
+    read_sweeps
+    stage_chunks
+"""
+
+import bz2
+import io
+import os
+import struct
+import time
+import pyart
+import s3fs
+import instrument
+from level2 import (CONTROL_WORD_SIZE, CTM_SIZE, END_OF_SCAN,
+                    MSG31_STATUS_OFFSET, MSG_HEADER_SIZE, VOLUME_HEADER_SIZE,
+                    iter_messages, parse_vcp)
+
+CHUNKS_BUCKET = 'unidata-nexrad-level2-chunks'
+# volume numbers run from 1 to this and then wrap around
+MAX_VOLUME = 999
+# offset of the elevation number (1 based, in VCP order) in message 31
+MSG31_ELEVATION_OFFSET = 22
+
+
+def chunk_info(key):
+    """
+    Parts of a chunk key.
+
+    Returns
+    -------
+    info : tuple or None
+        (chunk number, type letter, 'YYYYMMDD_HHMMSS' volume start), or
+        None when the key is not a chunk
+
+    """
+    parts = key.split('/')[-1].split('-')
+    if len(parts) != 4 or not parts[2].isdigit():
+        return None
+    return int(parts[2]), parts[3], parts[0] + '_' + parts[1]
+
+
+class ChunkIngester():
+    """
+    Follows one site in the chunks bucket and publishes finished sweeps.
+
+    Parameters
+    ----------
+    site : str
+        radar identifier, e.g. KGRR
+    fs : filesystem, optional
+        with the fsspec ls/cat_file interface.  The default is an
+        anonymous S3FileSystem.
+    bucket : str, optional
+        bucket (or local stand-in directory) holding the SITE/VOLNUM tree.
+    volume : int, optional
+        volume number to start with.  The default is the volume being
+        scanned, see latest_volume.
+
+    """
+
+    def __init__(self, site, fs=None, bucket=CHUNKS_BUCKET, volume=None):
+        self.site = site
+        self.fs = fs if fs is not None else s3fs.S3FileSystem(anon=True)
+        self.bucket = bucket
+        self.volume = volume
+        # start of the last volume completed; chunks of a directory not yet
+        # reused for a newer volume are at or before it
+        self.after = ''
+        self._reset()
+
+    def _reset(self):
+        # state of the volume being ingested
+        self.buffer = bytearray()
+        self.next_chunk = 1
+        # 'YYYYMMDD_HHMMSS' start of the S chunk; chunks of other volumes
+        # left in the same directory are ignored
+        self.start = None
+        self.vcp = None
+        self.name = None
+        self.scans_ended = 0
+        self.visit = []
+        self.complete = False
+
+    def _ls(self, prefix):
+        if hasattr(self.fs, 'invalidate_cache'):
+            self.fs.invalidate_cache(prefix)
+        try:
+            return sorted(self.fs.ls(prefix, detail=False))
+        except FileNotFoundError:
+            return []
+
+    def volume_prefix(self, volume):
+        """ Bucket directory of one volume number. """
+
+        return f'{self.bucket}/{self.site}/{volume}/'
+
+    def volume_start(self, volume):
+        """
+        'YYYYMMDD_HHMMSS' start of a volume, None if it has no chunks.
+
+        Chunks left from before the wrap around are older, so the newest
+        start is the volume now in the directory.
+
+        """
+        starts = [info[2] for info in map(chunk_info,
+                                          self._ls(self.volume_prefix(volume)))
+                  if info is not None]
+        return max(starts) if starts else None
+
+    def latest_volume(self):
+        """
+        Number of the volume scanned most recently.
+
+        Volume numbers wrap around, so the start times of the volume
+        directories increase up to the newest volume and then drop to the
+        oldest.  A binary search finds that point with a handful of
+        listings instead of one per directory.
+
+        """
+        numbers = sorted(int(p.rstrip('/').split('/')[-1])
+                         for p in self._ls(f'{self.bucket}/{self.site}/')
+                         if p.rstrip('/').split('/')[-1].isdigit())
+        if not numbers:
+            return None
+        first = self.volume_start(numbers[0]) or ''
+        last = self.volume_start(numbers[-1]) or ''
+        if first <= last:
+            return numbers[-1]
+        lo, hi = 0, len(numbers) - 1
+        while hi - lo > 1:
+            mid = (lo + hi) // 2
+            if (self.volume_start(numbers[mid]) or '') >= first:
+                lo = mid
+            else:
+                hi = mid
+        return numbers[lo]
+
+    def poll(self):
+        """
+        Fetch the chunks that arrived since the last poll.
+
+        Chunks are appended strictly in order; when one is still missing
+        the later ones wait for the next poll.  Only chunks with the start
+        time of the volume's S chunk are used, so chunks left in the
+        directory from before the volume numbers wrapped around are
+        ignored.  After the E chunk the next volume number is followed.
+        A volume missing a chunk is given up once the next volume has
+        started, so one lost chunk does not stall the ingest.
+
+        Returns
+        -------
+        sweeps : list of dict
+            one per scan that ended, see _scan_ended
+
+        """
+        if self.volume is None:
+            self.volume = self.latest_volume()
+            if self.volume is None:
+                return []
+
+        published = []
+        while True:
+            listed = [(key, info) for key, info in
+                      ((key, chunk_info(key)) for key in
+                       self._ls(self.volume_prefix(self.volume)))
+                      if info is not None]
+            if self.start is None:
+                # the newest S chunk after the last volume starts this one
+                starts = [info[2] for _, info in listed
+                          if info[1] == 'S' and info[2] > self.after]
+                if not starts:
+                    return published
+                self.start = max(starts)
+                self.name = f'{self.site}{self.start}_V06'
+            chunks = {info[0]: (key, info) for key, info in listed
+                      if info[2] == self.start and
+                      info[0] >= self.next_chunk}
+            if self.next_chunk not in chunks:
+                if published or not self._next_started():
+                    return published
+                print(f'  Giving up on  {self.name}  at chunk '
+                      f'{self.next_chunk}')
+                self.after = self.start
+                self.volume = self.volume % MAX_VOLUME + 1
+                self._reset()
+                continue
+
+            while self.next_chunk in chunks:
+                key, (number, kind, start) = chunks[self.next_chunk]
+                with instrument.span('chunk', file=key) as attrs:
+                    data = self.fs.cat_file(key)
+                    attrs['bytes'] = len(data)
+                published.extend(self._append(data, kind == 'S'))
+                self.next_chunk = number + 1
+                if kind == 'E':
+                    self.complete = True
+                    self.after = start
+                    break
+
+            if not self.complete:
+                return published
+            # on to the next volume, which may already have chunks
+            self.volume = self.volume % MAX_VOLUME + 1
+            self._reset()
+
+    def _next_started(self):
+        # True when the next volume number holds a newer S chunk
+        prefix = self.volume_prefix(self.volume % MAX_VOLUME + 1)
+        return any(info is not None and info[1] == 'S' and
+                   info[2] > self.start
+                   for info in map(chunk_info, self._ls(prefix)))
+
+    def _append(self, data, start):
+        # add the records of a chunk, returning the sweeps they completed
+        self.buffer.extend(data)
+        pos = VOLUME_HEADER_SIZE if start else 0
+        published = []
+        while pos + CONTROL_WORD_SIZE <= len(data):
+            size = abs(struct.unpack_from('>i', data, pos)[0])
+            end = pos + CONTROL_WORD_SIZE + size
+            if size == 0:
+                break
+            record = bz2.decompress(data[pos + CONTROL_WORD_SIZE:end])
+            if self.vcp is None:
+                self.vcp = parse_vcp(record) or []
+            for msg_type, msg_pos in iter_messages(record):
+                if msg_type != 31:
+                    continue
+                body = msg_pos + CTM_SIZE + MSG_HEADER_SIZE
+                if record[body + MSG31_STATUS_OFFSET] in END_OF_SCAN:
+                    elevation = record[body + MSG31_ELEVATION_OFFSET]
+                    # every sweep keeps the records up to its last radial
+                    published.append(self._scan_ended(
+                        elevation, len(self.buffer) - len(data) + end))
+            pos = end
+        return published
+
+    def _scan_ended(self, elevation, nbytes):
+        """
+        Sweep published when a scan ends.
+
+        Returns
+        -------
+        sweep : dict
+            'name' (archive style filename of the volume, e.g.
+            KGRR20200408_000300_V06), 'volume' number, 'scan' (zero based,
+            in file order), 'cut' (elevation times 10), 'visit' (the scans
+            of this visit of the cut so far, e.g. both scans of a split
+            cut), 'last_of_cut' (True when the next scan is another cut or
+            the volume ends), 'buffer' (the volume so far, shared by the
+            sweeps of the volume and not copied) and 'nbytes' (the length
+            of the volume up to this sweep, see read_sweeps)
+
+        """
+        scan = self.scans_ended
+        self.scans_ended += 1
+        cut = last_of_cut = None
+        if 0 < elevation <= len(self.vcp):
+            cut = int(round(self.vcp[elevation - 1]['angle'] * 10))
+            last_of_cut = (elevation == len(self.vcp) or
+                           int(round(self.vcp[elevation]['angle'] * 10)) !=
+                           cut)
+        if self.visit and self.visit[-1][1] != cut:
+            self.visit = []
+        self.visit.append((scan, cut))
+        return {'name': self.name, 'volume': self.volume, 'scan': scan,
+                'cut': cut, 'visit': [s for s, _ in self.visit],
+                'last_of_cut': bool(last_of_cut),
+                'buffer': self.buffer, 'nbytes': nbytes}
+
+    def watch(self, interval=10, sleep=time.sleep, polls=None):
+        """
+        Poll the site and yield sweeps as they are published.
+
+        Parameters
+        ----------
+        interval : float, optional
+            seconds between polls.  The default is 10.
+        sleep : callable, optional
+            used to wait between polls
+        polls : int, optional
+            stop after this many polls.  The default (None) polls forever.
+
+        Yields
+        ------
+        sweep : dict
+            see _scan_ended
+
+        """
+        count = 0
+        while polls is None or count < polls:
+            for sweep in self.poll():
+                yield sweep
+            count += 1
+            if polls is None or count < polls:
+                sleep(interval)
+
+
+def read_sweeps(sweep, fields=None, scans=None):
+    """
+    Decode sweeps of a published volume buffer.
+
+    Parameters
+    ----------
+    sweep : dict
+        from ChunkIngester.poll or watch
+    fields : list of str, optional
+        pyart fields to decode.  The default (None) decodes every moment.
+    scans : list of int, optional
+        scans to decode.  The default is sweep['visit'].
+
+    Returns
+    -------
+    radar : pyart.core.Radar
+
+    """
+    if scans is None:
+        scans = sweep['visit']
+    # the buffer keeps growing; only this sweep's part of it is copied, and
+    # the view is released so the ingester can still extend the buffer
+    with memoryview(sweep['buffer']) as view:
+        data = bytes(view[:sweep['nbytes']])
+    with instrument.span('decode', file=sweep['name'], scans=scans):
+        return pyart.io.read_nexrad_archive(io.BytesIO(data),
+                                            include_fields=fields,
+                                            scans=scans)
+
+
+def stage_chunks(filepath, chunk_dir, volume=1, records_per_chunk=1):
+    """
+    Split a local volume into chunk files, as a stand-in for the bucket.
+
+    Parameters
+    ----------
+    filepath : str
+        bzip2 compressed Archive II volume, e.g. KGRR20200408_000300_V06
+    chunk_dir : str
+        root of the stand-in bucket; chunks are written to
+        {chunk_dir}/SITE/{volume}/
+    volume : int, optional
+        The default is 1.
+    records_per_chunk : int, optional
+        LDM records in each I and E chunk.  The default is 1.
+
+    Returns
+    -------
+    paths : list of str
+        the chunk files in order, e.g. to copy them into the bucket one at
+        a time
+
+    """
+    with open(filepath, 'rb') as fh:
+        data = fh.read()
+    filename = os.path.basename(filepath)
+    site, start = filename[:4], filename[4:19].replace('_', '-')
+
+    records = []
+    pos = VOLUME_HEADER_SIZE
+    while pos + CONTROL_WORD_SIZE <= len(data):
+        size = abs(struct.unpack_from('>i', data, pos)[0])
+        if size == 0:
+            break
+        records.append(data[pos:pos + CONTROL_WORD_SIZE + size])
+        pos += CONTROL_WORD_SIZE + size
+
+    # the S chunk holds the volume header and the metadata record
+    chunks = [data[:VOLUME_HEADER_SIZE] + records[0]]
+    for n in range(1, len(records), records_per_chunk):
+        chunks.append(b''.join(records[n:n + records_per_chunk]))
+
+    volume_dir = os.path.join(chunk_dir, site, str(volume))
+    os.makedirs(volume_dir, exist_ok=True)
+    paths = []
+    for n, chunk in enumerate(chunks):
+        kind = 'S' if n == 0 else 'E' if n == len(chunks) - 1 else 'I'
+        path = os.path.join(volume_dir, f'{start}-{n + 1:03d}-{kind}')
+        with open(path, 'wb') as fh:
+            fh.write(chunk)
+        paths.append(path)
+    return paths
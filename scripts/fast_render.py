@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Fast rendering of sweeps straight from arrays to PNG, without matplotlib.
+
+For bulk image production the map, overlays and colorbar drawn by
+matplotlib and cartopy cost far more than the radar data itself.  This
+module resamples a sweep onto a fixed pixel grid instead:
+
+    PixelIndex    for every pixel of a domain, the azimuth bin and range
+                  gate it falls in.  It only depends on the site, the
+                  domain, the gate spacing and the elevation, so it is
+                  computed once and reused for every frame.
+    resample      per frame, a lookup table from azimuth bin to ray number
+                  (the rays of each volume start at a different azimuth),
+                  then one gather of the field.
+    to_rgba       the plts lookup table applied in NumPy
+    write_png     a PNG encoder using only zlib
+
+Pixels are centered on a plain lon/lat grid over the extent (rows from
+north to south).  PixelIndex also accepts any other lon/lat pixel centers,
+for example map tiles.
+
+Classes:
+    PixelIndex
+
+Functions:
+    pixel_index
+    azimuth_lut
+    write_png
+    render_sweep
+"""
+
+import struct
+import zlib
+from functools import lru_cache
+import numpy as np
+from pyart.core import geographic_to_cartesian_aeqd
+from radar_cmaps import to_rgba
+
+# pixels look up rays through azimuth bins of this many degrees
+AZIMUTH_BIN = 0.1
+AZIMUTH_BINS = int(round(360 / AZIMUTH_BIN))
+# effective earth radius of the 4/3 model used by pyart
+EARTH_RADIUS = 6371.0 * 1000.0 * 4.0 / 3.0
+
+
+class PixelIndex():
+    """
+    Azimuth bin and range gate of every pixel of a domain.
+
+    Parameters
+    ----------
+    lons, lats : ndarray of float
+        pixel centers in degrees, shape (height, width)
+    rda_lat, rda_lon : float
+        radar location
+    first_gate, gate_spacing : float
+        range to the center of the first gate and between gates, meters
+    ngates : int
+    elevation : float
+        elevation angle of the sweeps drawn, degrees
+
+    """
+
+    def __init__(self, lons, lats, rda_lat, rda_lon, first_gate,
+                 gate_spacing, ngates, elevation):
+        self.shape = np.shape(lons)
+        x, y = geographic_to_cartesian_aeqd(np.ravel(lons), np.ravel(lats),
+                                            rda_lon, rda_lat)
+        azimuth = np.degrees(np.arctan2(x, y)) % 360.0
+        distance = np.hypot(x, y)
+        slant, _ = beam_geometry(distance, elevation)
+        gate = np.rint((slant - first_gate) / gate_spacing)
+        inside = (gate >= 0) & (gate < ngates)
+
+        # only pixels within range are kept
+        self.pixels = np.flatnonzero(inside)
+        self.gates = gate[inside].astype(np.intp)
+        # distance from the radar along the ground, meters
+        self.distances = distance[inside].astype(np.float32)
+        self.azimuth_bins = (azimuth[inside] // AZIMUTH_BIN).astype(np.intp)
+        self.azimuth_bins %= AZIMUTH_BINS
+
+    @classmethod
+    def for_extent(cls, rda_lat, rda_lon, extent, first_gate, gate_spacing,
+                   ngates, elevation, width=800, height=None):
+        """
+        Index of a lon/lat image covering extent.
+
+        Parameters
+        ----------
+        extent : tuple of float
+            (min_lon, max_lon, min_lat, max_lat)
+        width : int, optional
+            image width in pixels.  The default is 800.
+        height : int, optional
+            The default keeps pixels about square on the ground.
+
+        """
+        min_lon, max_lon, min_lat, max_lat = extent
+        if height is None:
+            aspect = ((max_lat - min_lat) /
+                      ((max_lon - min_lon) *
+                       np.cos(np.radians((min_lat + max_lat) / 2))))
+            height = max(int(round(width * aspect)), 1)
+        dlon = (max_lon - min_lon) / width
+        dlat = (max_lat - min_lat) / height
+        lons = min_lon + (np.arange(width) + 0.5) * dlon
+        lats = max_lat - (np.arange(height) + 0.5) * dlat
+        lons, lats = np.meshgrid(lons, lats)
+        return cls(lons, lats, rda_lat, rda_lon, first_gate, gate_spacing,
+                   ngates, elevation)
+
+    def resample(self, radar, sweep, field):
+        """
+        Field values of a sweep at every pixel.
+
+        Returns
+        -------
+        values : ndarray of float32, shape self.shape
+            NaN where the pixel is out of range, between rays of a sector
+            scan or the gate is masked
+
+        """
+        rays = azimuth_lut(radar.get_azimuth(sweep))[self.azimuth_bins]
+        hit = rays >= 0
+        data = radar.get_field(sweep, field)
+        gathered = np.ma.filled(
+            data[rays[hit], self.gates[hit]].astype(np.float32), np.nan)
+
+        values = np.full(int(np.prod(self.shape)), np.nan, dtype=np.float32)
+        values[self.pixels[hit]] = gathered
+        return values.reshape(self.shape)
+
+
+def beam_geometry(distance, elevation):
+    """
+    Slant range and height of a beam above points on the ground.
+
+    Inverse of pyart's antenna_to_cartesian (4/3 earth model).
+
+    Parameters
+    ----------
+    distance : ndarray of float
+        distance from the radar along the ground, meters
+    elevation : float
+        beam elevation angle, degrees
+
+    Returns
+    -------
+    slant, height : ndarray of float
+        meters; inf where the beam never comes down to that distance
+
+    """
+    arc = np.asarray(distance, dtype=float) / EARTH_RADIUS
+    theta = np.radians(elevation)
+    cos = np.cos(theta + arc)
+    with np.errstate(divide='ignore'):
+        cos = np.where(cos > 0, cos, 0.0)
+        slant = EARTH_RADIUS * np.sin(arc) / cos
+        height = EARTH_RADIUS * np.cos(theta) / cos - EARTH_RADIUS
+    return slant, height
+
+
+@lru_cache(maxsize=32)
+def pixel_index(rda_lat, rda_lon, extent, first_gate, gate_spacing, ngates,
+                elevation, width=800, height=None):
+    """
+    PixelIndex.for_extent, computed once per site, domain and geometry.
+
+    Arguments must be hashable (extent a tuple); round floats read from a
+    radar so that volumes of the same site share an index.
+
+    """
+    return PixelIndex.for_extent(rda_lat, rda_lon, extent, first_gate,
+                                 gate_spacing, ngates, elevation, width,
+                                 height)
+
+
+def azimuth_lut(azimuths, bin_width=AZIMUTH_BIN):
+    """
+    Nearest ray of a sweep for each azimuth bin.
+
+    Parameters
+    ----------
+    azimuths : ndarray of float
+        azimuth of every ray of the sweep, degrees
+    bin_width : float, optional
+        degrees.  The default is AZIMUTH_BIN.
+
+    Returns
+    -------
+    lut : ndarray of int, shape (360 / bin_width,)
+        ray number, or -1 where the nearest ray is further away than the
+        typical ray spacing (outside a sector scan)
+
+    """
+    azimuths = np.asarray(azimuths, dtype=float) % 360.0
+    order = np.argsort(azimuths, kind='stable')
+    ordered = azimuths[order]
+    spacing = np.median(np.diff(ordered)) if len(ordered) > 1 else 1.0
+
+    # wrap the first and last rays around so every bin has two neighbors
+    ring = np.concatenate([ordered[-1:] - 360.0, ordered,
+                           ordered[:1] + 360.0])
+    ring_rays = np.concatenate([order[-1:], order, order[:1]])
+    centers = (np.arange(int(round(360 / bin_width))) + 0.5) * bin_width
+    right = np.searchsorted(ring, centers)
+    left = right - 1
+    left_gap = centers - ring[left]
+    right_gap = ring[right] - centers
+    nearest = np.where(left_gap <= right_gap, left, right)
+    gap = np.minimum(left_gap, right_gap)
+    return np.where(gap <= max(spacing, bin_width), ring_rays[nearest], -1)
+
+
+def write_png(path, rgba, level=6):
+    """
+    Write an RGBA image as PNG.
+
+    Parameters
+    ----------
+    path : str
+    rgba : ndarray of uint8, shape (height, width, 4)
+    level : int, optional
+        zlib compression level.  The default is 6.
+
+    """
+    height, width = rgba.shape[:2]
+    # every scanline starts with filter type 0 (none)
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind, data):
+        body = kind + data
+        return (struct.pack('>I', len(data)) + body +
+                struct.pack('>I', zlib.crc32(body) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0)
+    with open(path, 'wb') as fp:
+        fp.write(b'\x89PNG\r\n\x1a\n')
+        fp.write(chunk(b'IHDR', header))
+        fp.write(chunk(b'IDAT', zlib.compress(raw.tobytes(), level)))
+        fp.write(chunk(b'IEND', b''))
+
+
+def render_sweep(radar, sweep, field, product, extent, image_path,
+                 width=800):
+    """
+    Resample one sweep onto a lon/lat image and save it as PNG.
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+    sweep : int
+    field : str
+        name of the field in radar, in the units of the plts limits
+    product : str
+        plts key giving the colormap and limits, e.g. 'Ref'
+    extent : tuple of float
+        (min_lon, max_lon, min_lat, max_lat)
+    image_path : str
+    width : int, optional
+        The default is 800.
+
+    """
+    ranges = radar.range['data']
+    index = pixel_index(round(float(radar.latitude['data'][0]), 4),
+                        round(float(radar.longitude['data'][0]), 4),
+                        tuple(round(float(v), 4) for v in extent),
+                        round(float(ranges[0]), 1),
+                        round(float(ranges[1] - ranges[0]), 1),
+                        len(ranges),
+                        round(float(radar.fixed_angle['data'][sweep]), 1),
+                        width)
+    values = index.resample(radar, sweep, field)
+    write_png(image_path, to_rgba(product, values, bytes=True))
@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Fast rendering of animation frames from one radar.
+
+A loop of images from the same radar only differs in the radar data and the
+title, yet plotting each one with RadarMapDisplay.plot_ppi_map rebuilds the
+figure, map projection, overlays, labels and colorbar every time.
+FrameRenderer builds all of that once.  Each frame then only swaps the data
+of the existing mesh and the title text before the figure is saved.
+
+Rays are drawn in azimuth order, so volumes whose sweeps start at different
+azimuths still share one mesh.  The mesh is only rebuilt when the sweep
+geometry changes (ray or gate count, gate spacing or a noticeably different
+set of azimuths).  With a GateCache the projected gate grids are also
+shared between renderers and runs.
+
+Classes:
+    FrameRenderer
+"""
+
+import numpy as np
+import matplotlib.pyplot as plt
+from matplotlib.cm import ScalarMappable
+from matplotlib.colors import Normalize
+import cartopy.crs as ccrs
+import cartopy.feature as cfeature
+from gate_cache import GateCache
+import instrument
+
+# sorted azimuths may differ by this many degrees and still reuse a mesh
+AZIMUTH_TOLERANCE = 0.25
+# a gap between rays this many times their median spacing is a sector gap
+SECTOR_GAP = 5.0
+
+
+class FrameRenderer():
+    """
+    Figure with static layers for one radar, reused for every frame.
+
+    Parameters
+    ----------
+    rda_lat, rda_lon : float
+        radar location, used as the center of the map projection
+    extent : tuple of float
+        (min_lon, max_lon, min_lat, max_lat) of the map
+    cmap : matplotlib colormap
+    vmin, vmax : float
+        data limits of the colormap
+    cblabel : str, optional
+        colorbar label
+    counties : list of shapely geometries, optional
+        overlay already projected into the map projection, e.g. from
+        gis_cache.LayerCache.geometries
+    locations : list of [name, lon, lat], optional
+        places to label, e.g. from get_places
+    resolution : str, optional
+        Natural Earth scale of coastlines and state lines.
+        The default is '50m'.
+    figsize : tuple, optional
+        The default is (6, 6).
+    gate_cache : gate_cache.GateCache, optional
+        cache of projected gate grids.  The default (None) computes the
+        grid whenever the sweep geometry changes.
+
+    """
+
+    def __init__(self, rda_lat, rda_lon, extent, cmap, vmin, vmax,
+                 cblabel=None, counties=None, locations=(), resolution='50m',
+                 figsize=(6, 6), gate_cache=None):
+        self.projection = ccrs.LambertConformal(central_latitude=rda_lat,
+                                                central_longitude=rda_lon)
+        self.radar_crs = ccrs.AzimuthalEquidistant(central_latitude=rda_lat,
+                                                   central_longitude=rda_lon)
+        self.cmap = cmap
+        self.norm = Normalize(vmin=vmin, vmax=vmax)
+        self.gate_cache = gate_cache
+
+        self.fig = plt.figure(figsize=figsize)
+        self.ax = self.fig.add_subplot(1, 1, 1, projection=self.projection)
+        self.ax.set_extent(extent, crs=ccrs.PlateCarree())
+
+        states = cfeature.NaturalEarthFeature(
+            category='cultural', name='admin_1_states_provinces_lines',
+            scale=resolution, facecolor='none')
+        self.ax.coastlines(resolution=resolution)
+        self.ax.add_feature(states, edgecolor='gray')
+        if counties:
+            self.ax.add_geometries(counties, crs=self.projection,
+                                   facecolor='none', edgecolor='gray',
+                                   linewidth=0.7)
+
+        for place, lon, lat in locations:
+            self.ax.plot(lon, lat, 'o', color='black',
+                         transform=ccrs.PlateCarree(), zorder=10)
+            self.ax.text(lon, lat, place, horizontalalignment='center',
+                         verticalalignment='top',
+                         transform=ccrs.PlateCarree())
+
+        mappable = ScalarMappable(norm=self.norm, cmap=self.cmap)
+        self.fig.colorbar(mappable, ax=self.ax, label=cblabel)
+        self.title = self.ax.set_title('')
+
+        self.mesh = None
+        self._geometry = None
+
+    def close(self):
+        """ Release the figure. """
+
+        plt.close(self.fig)
+
+    def _geometry_of(self, radar, sweep):
+        azimuths = radar.get_azimuth(sweep)
+        order = np.argsort(azimuths, kind='stable')
+        azimuths = azimuths[order]
+        # a sector scan starts right after its gap, so it is drawn as one
+        # increasing run instead of wrapping across the gap.  A full circle
+        # stays anchored at 0 degrees: its gaps are all about the same, and
+        # ray jitter would otherwise move the start from volume to volume.
+        gaps = np.diff(np.append(azimuths, azimuths[0] + 360.0))
+        widest = int(np.argmax(gaps))
+        start = 0
+        if len(gaps) > 1 and gaps[widest] > SECTOR_GAP * np.median(gaps):
+            start = (widest + 1) % len(azimuths)
+        order = np.roll(order, -start)
+        azimuths = np.roll(azimuths, -start)
+        azimuths[len(azimuths) - start:] += 360.0
+        return order, {'azimuths': azimuths,
+                       'range': radar.range['data'],
+                       'elevation': float(radar.fixed_angle['data'][sweep])}
+
+    def _same_geometry(self, geometry):
+        if self._geometry is None:
+            return False
+        old = self._geometry
+        return (old['azimuths'].shape == geometry['azimuths'].shape and
+                old['range'].shape == geometry['range'].shape and
+                np.allclose(old['range'], geometry['range']) and
+                abs(old['elevation'] - geometry['elevation']) < 0.05 and
+                np.abs(old['azimuths'] - geometry['azimuths']).max() <=
+                AZIMUTH_TOLERANCE)
+
+    def gate_edges(self, radar, sweep, geometry):
+        """
+        Gate edge coordinates of a sweep in the map projection.
+
+        Parameters
+        ----------
+        geometry : dict
+            sorted 'azimuths', 'range' and fixed 'elevation' of the sweep
+
+        Returns
+        -------
+        x, y : ndarray of shape (nrays + 1, ngates + 1)
+
+        """
+        args = (self.projection, self.radar_crs, geometry['azimuths'],
+                geometry['range'], geometry['elevation'])
+        if self.gate_cache is None:
+            return GateCache.build(*args)
+        return self.gate_cache.edges(*args)
+
+    def render(self, radar, sweep, field, title, image_path, dpi=150):
+        """
+        Draw one sweep and save the figure.
+
+        Parameters
+        ----------
+        radar : pyart.core.Radar
+        sweep : int
+            sweep number within radar
+        field : str
+            name of the field to plot, e.g. 'reflectivity'
+        title : str
+        image_path : str
+            full path of the image to write
+        dpi : int, optional
+            The default is 150.
+
+        """
+        order, geometry = self._geometry_of(radar, sweep)
+        data = radar.get_field(sweep, field)[order]
+
+        if self._same_geometry(geometry):
+            self.mesh.set_array(data)
+        else:
+            if self.mesh is not None:
+                self.mesh.remove()
+            with instrument.span('project', sweep=int(sweep)):
+                x, y = self.gate_edges(radar, sweep, geometry)
+            # edgecolors='face' as in plot_ppi_map, so gates smaller than a
+            # pixel still show up the same way
+            self.mesh = self.ax.pcolormesh(x, y, data, cmap=self.cmap,
+                                           norm=self.norm, edgecolors='face')
+            self._geometry = geometry
+
+        self.title.set_text(title)
+        with instrument.span('savefig', sweep=int(sweep)):
+            self.fig.savefig(image_path, format='png', bbox_inches='tight',
+                             dpi=dpi)
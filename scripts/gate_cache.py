@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of gate edge coordinates projected into the map projection.
+
+Drawing a sweep needs the map x/y of every gate corner.  Working those out
+(antenna angles to Cartesian, then a cartopy transform of a few million
+points) is repeated for every frame, yet a site scans the same azimuths
+and range gates volume after volume.  GateCache keeps the projected grids
+keyed by site (the projections, centered on the radar), azimuth set,
+range gates and elevation.  Grids stay in memory with LRU eviction and,
+with a cache_dir, are also written to disk for later runs.
+
+Azimuths are rounded to AZIMUTH_QUANTUM before computing the grid, so the
+rays of different volumes, which jitter by a few hundredths of a degree,
+share one entry.
+
+Classes:
+    GateCache
+"""
+
+import hashlib
+import os
+from collections import OrderedDict
+import numpy as np
+import pyart
+import cache_files
+
+# azimuths are snapped to multiples of this many degrees
+AZIMUTH_QUANTUM = 0.125
+
+
+class GateCache():
+    """
+    Projected gate edge grids, reused across frames and runs.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        directory where grids are stored between runs.  The default (None)
+        only caches in memory.
+    maxsize : int, optional
+        number of grids kept in memory.  The default is 16.
+
+    """
+
+    def __init__(self, cache_dir=None, maxsize=16):
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self._grids = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # grids are large; a copy sent to a worker process starts empty
+        state = self.__dict__.copy()
+        state['_grids'] = OrderedDict()
+        return state
+
+    @staticmethod
+    def key(map_crs, radar_crs, azimuths, ranges, elevation):
+        """ Cache key of a projected gate grid. """
+
+        digest = hashlib.sha1()
+        digest.update(map_crs.proj4_init.encode())
+        digest.update(radar_crs.proj4_init.encode())
+        digest.update(np.asarray(azimuths, dtype=np.float64).tobytes())
+        digest.update(np.asarray(ranges, dtype=np.float64).tobytes())
+        digest.update(f'{elevation:.2f}'.encode())
+        return digest.hexdigest()
+
+    def edges(self, map_crs, radar_crs, azimuths, ranges, elevation):
+        """
+        Gate edge coordinates in the map projection.
+
+        Parameters
+        ----------
+        map_crs : cartopy.crs.Projection
+            projection of the map axes
+        radar_crs : cartopy.crs.CRS
+            azimuthal equidistant projection centered on the radar
+        azimuths : ndarray of float
+            ray azimuths in drawing order, degrees (may exceed 360)
+        ranges : ndarray of float
+            range to the center of each gate, meters
+        elevation : float
+            fixed angle of the sweep, degrees
+
+        Returns
+        -------
+        x, y : ndarray of shape (nrays + 1, ngates + 1)
+
+        """
+        azimuths = (np.rint(np.asarray(azimuths) / AZIMUTH_QUANTUM) *
+                    AZIMUTH_QUANTUM)
+        key = self.key(map_crs, radar_crs, azimuths, ranges, elevation)
+        if key in self._grids:
+            self._grids.move_to_end(key)
+            return self._grids[key]
+
+        grid = self._load(key)
+        if grid is None:
+            grid = self.build(map_crs, radar_crs, azimuths, ranges,
+                              elevation)
+            self._save(key, grid)
+
+        self._grids[key] = grid
+        while len(self._grids) > self.maxsize:
+            self._grids.popitem(last=False)
+        return grid
+
+    @staticmethod
+    def build(map_crs, radar_crs, azimuths, ranges, elevation):
+        """ Compute a grid without caching it; see edges. """
+
+        elevations = np.full(len(azimuths), elevation)
+        x, y, _ = pyart.core.antenna_vectors_to_cartesian(
+            ranges, azimuths, elevations, edges=True)
+        xyz = map_crs.transform_points(radar_crs, x, y)
+        # float32 halves the footprint; meters stay well below a pixel
+        return (xyz[..., 0].astype(np.float32),
+                xyz[..., 1].astype(np.float32))
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.npz')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        def load(path):
+            with np.load(path) as npz:
+                return npz['x'], npz['y']
+
+        return cache_files.read(self._path(key), load)
+
+    def _save(self, key, grid):
+        if self.cache_dir is None:
+            return
+        cache_files.write(self._path(key),
+                          lambda path: np.savez(path, x=grid[0], y=grid[1]),
+                          suffix='.npz')
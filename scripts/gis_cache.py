@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of GIS overlay geometry clipped and projected for each radar.
+
+Reading a county shapefile and reprojecting every polygon for every image is
+a large part of the time spent per plot.  LayerCache reads each shapefile
+once, clips it to a radar's map domain, projects the result into that
+radar's map projection and keeps it in memory for every following frame.
+With a cache_dir the projected geometry is also written to disk (as WKB) so
+later runs skip the work entirely.
+
+Classes:
+    LayerCache
+"""
+
+import hashlib
+import os
+import pickle
+from functools import lru_cache
+import cartopy.crs as ccrs
+import cartopy.io.shapereader as shpreader
+import numpy as np
+import shapely.wkb
+from shapely.geometry import box
+import cache_files
+
+# degrees added around the map extent before clipping, so outlines run off
+# the edge of the image instead of stopping at it
+CLIP_MARGIN = 0.5
+
+
+@lru_cache(maxsize=None)
+def read_shapefile(shape_path):
+    """
+    Geometries of a shapefile (lon/lat) and their bounds, read once.
+
+    Returns
+    -------
+    geoms : list of shapely geometries
+    bounds : ndarray of shape (n, 4)
+        minx, miny, maxx, maxy of each geometry
+
+    """
+    geoms = [g for g in shpreader.Reader(shape_path).geometries()
+             if g is not None and not g.is_empty]
+    bounds = np.array([g.bounds for g in geoms]).reshape(-1, 4)
+    return geoms, bounds
+
+
+class LayerCache():
+    """
+    Shapefile geometry clipped to a domain and projected once.
+
+    Parameters
+    ----------
+    cache_dir : str, optional
+        directory where projected geometry is stored between runs.
+        The default (None) only caches in memory.
+
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._layers = {}
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(shape_path, projection, extent):
+        """ Cache key for a shapefile, map projection and lon/lat extent. """
+
+        stat = os.stat(shape_path)
+        parts = [os.path.abspath(shape_path), str(stat.st_size),
+                 str(int(stat.st_mtime)), projection.proj4_init,
+                 ','.join(f'{v:.3f}' for v in extent)]
+        return hashlib.sha1('|'.join(parts).encode()).hexdigest()
+
+    def geometries(self, shape_path, projection, extent):
+        """
+        Shapefile geometry inside a map extent, in map coordinates.
+
+        Parameters
+        ----------
+        shape_path : str
+            full local path to the shapefile
+        projection : cartopy.crs.Projection
+            map projection of the axes the geometry is drawn on
+        extent : tuple of float
+            (min_lon, max_lon, min_lat, max_lat) of the map
+
+        Returns
+        -------
+        geoms : list of shapely geometries
+            already projected; draw them with crs=projection so cartopy
+            does not transform them again
+
+        """
+        key = self.key(shape_path, projection, extent)
+        if key in self._layers:
+            return self._layers[key]
+
+        geoms = self._load(key)
+        if geoms is None:
+            geoms = self._build(shape_path, projection, extent)
+            self._save(key, geoms)
+
+        self._layers[key] = geoms
+        return geoms
+
+    def _build(self, shape_path, projection, extent):
+        min_lon, max_lon, min_lat, max_lat = extent
+        domain = box(min_lon - CLIP_MARGIN, min_lat - CLIP_MARGIN,
+                     max_lon + CLIP_MARGIN, max_lat + CLIP_MARGIN)
+        geoms, bounds = read_shapefile(shape_path)
+        # cheap bounding box test before any exact intersection
+        near = np.flatnonzero((bounds[:, 0] <= domain.bounds[2]) &
+                              (bounds[:, 2] >= domain.bounds[0]) &
+                              (bounds[:, 1] <= domain.bounds[3]) &
+                              (bounds[:, 3] >= domain.bounds[1]))
+        src_crs = ccrs.PlateCarree()
+        projected = []
+        for i in near:
+            clipped = geoms[i].intersection(domain)
+            if clipped.is_empty:
+                continue
+            geom = projection.project_geometry(clipped, src_crs)
+            if not geom.is_empty:
+                projected.append(geom)
+        return projected
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.wkb.pkl')
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+
+        def load(path):
+            with open(path, 'rb') as fp:
+                return [shapely.wkb.loads(b) for b in pickle.load(fp)]
+
+        return cache_files.read(self._path(key), load)
+
+    def _save(self, key, geoms):
+        if self.cache_dir is None:
+            return
+
+        def save(path):
+            with open(path, 'wb') as fp:
+                pickle.dump([shapely.wkb.dumps(g) for g in geoms], fp)
+
+        cache_files.write(self._path(key), save)
@@ -0,0 +1,296 @@
+# -*- coding: utf-8 -*-
+"""
+Gridded products from a volume: composite reflectivity, CAPPIs, echo tops.
+
+pyart.map.grid_from_radars searches every gate around every grid point for
+each volume.  A site scans the same geometry volume after volume, so here
+the mapping from gates to grid cells is worked out once per geometry
+(elevation cuts, azimuth spacing, range gates and a grid centered on the
+radar) and kept:
+
+    gates     for every sweep and cell of the Cartesian grid, the flat
+              number of the gate above the cell and the beam height there
+    weights   per CAPPI height, a scipy.sparse matrix that interpolates
+              linearly in height between the two sweeps around it
+
+Every volume is first laid out on fixed azimuth bins, so the same flat gate
+numbers apply to all volumes whatever azimuth their rays start at.  A new
+volume then costs one gather for composite reflectivity and echo tops and
+one sparse mat-vec per CAPPI height.
+
+Gates without echo (masked) are left out of the interpolation: the weights
+of the gates that remain are renormalized.
+
+Classes:
+    VolumeGridder
+
+Functions:
+    gridder_for
+    grid_volume
+    save_png
+"""
+
+from functools import lru_cache
+import numpy as np
+import scipy.sparse
+from pyart.core import cartesian_to_geographic_aeqd
+from fast_render import azimuth_lut, beam_geometry, write_png
+from radar_cmaps import to_rgba
+import sweeps
+
+# half of the 3 dB beam width, used to extend CAPPIs just past the
+# lowest and highest sweeps
+HALF_BEAM = np.radians(0.5)
+# reflectivity threshold of echo tops, dBZ
+ECHO_TOP_DBZ = 18.0
+
+
+class VolumeGridder():
+    """
+    Gate to grid cell mapping of one site geometry.
+
+    Parameters
+    ----------
+    elevations : list of float
+        fixed angle of each sweep used, degrees, in increasing order
+    bin_widths : list of float
+        azimuth bin width of each sweep, degrees
+    first_gate, gate_spacing : float
+        meters
+    ngates : int
+    heights : list of float, optional
+        CAPPI heights above the radar, meters.  The default is
+        (1000, 2000, 3000).
+    half_width : float, optional
+        the grid spans -half_width..half_width meters east and north of
+        the radar.  The default is 150 km.
+    resolution : float, optional
+        grid spacing in meters.  The default is 1 km.
+
+    """
+
+    def __init__(self, elevations, bin_widths, first_gate, gate_spacing,
+                 ngates, heights=(1000, 2000, 3000), half_width=150e3,
+                 resolution=1e3):
+        self.elevations = list(elevations)
+        self.bin_widths = list(bin_widths)
+        self.first_gate = first_gate
+        self.gate_spacing = gate_spacing
+        self.ngates = ngates
+        self.heights = list(heights)
+
+        n = int(round(2 * half_width / resolution))
+        # cell centers, rows from north to south like the image writers
+        self.x = -half_width + (np.arange(n) + 0.5) * resolution
+        self.y = half_width - (np.arange(n) + 0.5) * resolution
+        self.shape = (n, n)
+        x, y = np.meshgrid(self.x, self.y)
+        x, y = x.ravel(), y.ravel()
+        distance = np.hypot(x, y)
+        azimuth = np.degrees(np.arctan2(x, y)) % 360.0
+
+        self.nbins = [int(round(360 / w)) for w in self.bin_widths]
+        sizes = [nbins * ngates for nbins in self.nbins]
+        self.offsets = np.concatenate([[0], np.cumsum(sizes)])
+        self.size = int(self.offsets[-1])
+
+        nsweeps = len(self.elevations)
+        self.gates = np.full((nsweeps, n * n), -1, dtype=np.intp)
+        self.beam_heights = np.full((nsweeps, n * n), np.nan)
+        slants = np.full((nsweeps, n * n), np.nan)
+        for k, elevation in enumerate(self.elevations):
+            slant, height = beam_geometry(distance, elevation)
+            gate = np.rint((slant - first_gate) / gate_spacing)
+            inside = (gate >= 0) & (gate < ngates)
+            azimuth_bin = (azimuth // self.bin_widths[k]).astype(np.intp)
+            azimuth_bin %= self.nbins[k]
+            self.gates[k, inside] = (self.offsets[k] +
+                                     azimuth_bin[inside] * ngates +
+                                     gate[inside].astype(np.intp))
+            self.beam_heights[k, inside] = height[inside]
+            slants[k, inside] = slant[inside]
+
+        self.weights = {h: self._cappi_weights(h, slants)
+                        for h in self.heights}
+
+    def _cappi_weights(self, height, slants):
+        """ Sparse (cells x gates) matrix of a CAPPI at height. """
+
+        z = self.beam_heights
+        ncells = z.shape[1]
+        cells = np.arange(ncells)
+        # sweeps are ordered by elevation, so heights increase along axis 0
+        below = np.where(np.isnan(z), False, z <= height).sum(axis=0) - 1
+
+        rows, cols, data = [], [], []
+        lower = np.clip(below, 0, len(z) - 1)
+        upper = np.clip(below + 1, 0, len(z) - 1)
+        z0 = z[lower, cells]
+        z1 = z[upper, cells]
+        between = ((below >= 0) & (below + 1 < len(z)) &
+                   (self.gates[lower, cells] >= 0) &
+                   (self.gates[upper, cells] >= 0))
+        w1 = np.zeros(ncells)
+        w1[between] = ((height - z0[between]) /
+                       (z1[between] - z0[between]))
+        for k, w in ((lower, 1 - w1), (upper, w1)):
+            rows.append(cells[between])
+            cols.append(self.gates[k, cells][between])
+            data.append(w[between])
+
+        # just below the lowest or above the highest beam, within the beam
+        for k, edge in ((0, below < 0), (len(z) - 1, below == len(z) - 1)):
+            near = (edge & (self.gates[k] >= 0) &
+                    (np.abs(z[k] - height) <= slants[k] * HALF_BEAM))
+            rows.append(cells[near])
+            cols.append(self.gates[k, near])
+            data.append(np.ones(near.sum()))
+
+        return scipy.sparse.csr_matrix(
+            (np.concatenate(data), (np.concatenate(rows),
+                                    np.concatenate(cols))),
+            shape=(ncells, self.size))
+
+    def binned(self, radar, sweep_numbers, field):
+        """
+        Field of the sweeps laid out on the fixed azimuth bins.
+
+        Returns
+        -------
+        values : ndarray of float32, shape (self.size,)
+            NaN where a gate is masked or a bin has no ray
+
+        """
+        values = np.full(self.size, np.nan, dtype=np.float32)
+        for k, sweep in enumerate(sweep_numbers):
+            rays = azimuth_lut(radar.get_azimuth(sweep), self.bin_widths[k])
+            data = np.ma.filled(radar.get_field(sweep, field)[
+                :, :self.ngates].astype(np.float32), np.nan)
+            block = np.full((self.nbins[k], self.ngates), np.nan,
+                            dtype=np.float32)
+            hit = rays >= 0
+            block[hit, :data.shape[1]] = data[rays[hit]]
+            values[self.offsets[k]:self.offsets[k + 1]] = block.ravel()
+        return values
+
+    def products(self, radar, sweep_numbers, field='reflectivity'):
+        """
+        Gridded products of one volume.
+
+        Parameters
+        ----------
+        radar : pyart.core.Radar
+        sweep_numbers : list of int
+            sweeps of radar matching self.elevations, see grid_volume
+        field : str, optional
+            The default is 'reflectivity'.
+
+        Returns
+        -------
+        products : dict
+            'composite' (max over all sweeps), 'cappi' (dict of grids by
+            height) and 'echo_tops' (height in meters of the highest beam
+            at or above ECHO_TOP_DBZ), each a masked array of self.shape
+
+        """
+        values = self.binned(radar, sweep_numbers, field)
+        column = np.where(self.gates >= 0, values[self.gates], np.nan)
+
+        with np.errstate(invalid='ignore'):
+            composite = np.fmax.reduce(column, axis=0)
+            echo = np.where(column >= ECHO_TOP_DBZ, self.beam_heights,
+                            np.nan)
+            echo_tops = np.fmax.reduce(echo, axis=0)
+
+        valid = np.isfinite(values)
+        filled = np.where(valid, values, 0.0)
+        cappi = {}
+        for height, weights in self.weights.items():
+            total = weights @ valid.astype(np.float64)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                grid = (weights @ filled) / total
+            cappi[height] = self._grid(np.where(total > 0, grid, np.nan))
+
+        return {'composite': self._grid(composite), 'cappi': cappi,
+                'echo_tops': self._grid(echo_tops)}
+
+    def _grid(self, flat):
+        return np.ma.masked_invalid(flat.reshape(self.shape))
+
+    def lonlat(self, rda_lat, rda_lon):
+        """ Longitude and latitude of the cell centers of a site. """
+
+        x, y = np.meshgrid(self.x, self.y)
+        return cartesian_to_geographic_aeqd(x, y, rda_lon, rda_lat)
+
+
+@lru_cache(maxsize=8)
+def _cached_gridder(elevations, bin_widths, first_gate, gate_spacing, ngates,
+                    heights, half_width, resolution):
+    return VolumeGridder(elevations, bin_widths, first_gate, gate_spacing,
+                         ngates, heights, half_width, resolution)
+
+
+def gridder_for(radar, sweep_numbers, heights=(1000, 2000, 3000),
+                half_width=150e3, resolution=1e3):
+    """
+    VolumeGridder of a volume's geometry, built once per geometry.
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+    sweep_numbers : list of int
+        sweeps to grid, in increasing elevation
+    heights, half_width, resolution : optional
+        as for VolumeGridder
+
+    """
+    ranges = radar.range['data']
+    spacing = float(ranges[1] - ranges[0])
+    # only gates that can fall inside the grid are kept
+    ngates = min(len(ranges),
+                 int((half_width * np.sqrt(2) - ranges[0]) / spacing) + 2)
+    elevations = tuple(round(float(radar.fixed_angle['data'][s]), 1)
+                       for s in sweep_numbers)
+    bin_widths = []
+    for s in sweep_numbers:
+        azimuths = np.sort(radar.get_azimuth(s))
+        spacing_deg = np.median(np.diff(azimuths)) if len(azimuths) > 1 \
+            else 1.0
+        # super resolution sweeps have 0.5 degree rays, the others 1 degree
+        bin_widths.append(0.5 if spacing_deg < 0.75 else 1.0)
+    return _cached_gridder(elevations, tuple(bin_widths),
+                           round(float(ranges[0]), 1), round(spacing, 1),
+                           ngates, tuple(heights), float(half_width),
+                           float(resolution))
+
+
+def grid_volume(radar, field='reflectivity', heights=(1000, 2000, 3000),
+                half_width=150e3, resolution=1e3):
+    """
+    Composite reflectivity, CAPPIs and echo tops of a volume.
+
+    The first visit of every cut is gridded (SAILS revisits of the lowest
+    cut are skipped); for split cuts the surveillance scan is used.
+
+    Returns
+    -------
+    products : dict
+        see VolumeGridder.products; also the 'lon' and 'lat' of the cells
+
+    """
+    labels = sweeps.sweep_labels(radar)
+    chosen = sweeps.select(labels, np.unique(labels['cut']), repeats=[0])
+    chosen = chosen[np.argsort(radar.fixed_angle['data'][chosen],
+                               kind='stable')]
+    gridder = gridder_for(radar, chosen, heights, half_width, resolution)
+    products = gridder.products(radar, chosen, field)
+    products['lon'], products['lat'] = gridder.lonlat(
+        float(radar.latitude['data'][0]), float(radar.longitude['data'][0]))
+    return products
+
+
+def save_png(grid, product, image_path):
+    """ Save a gridded field colored with a plts product, e.g. 'Ref'. """
+
+    write_png(image_path, to_rgba(product, grid, bytes=True))
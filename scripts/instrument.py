@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+"""
+Per-stage timing spans and optional profiling of each volume.
+
+Stages of the pipeline (listing, download, decode, projection, overlays,
+savefig, ...) are wrapped in span().  When a trace log is configured each
+span appends one JSON line:
+
+    {"stage": "download", "start": 1586304180.5, "seconds": 0.82,
+     "pid": 4120, "file": "KGRR20200408_000300_V06", "bytes": 14567210,
+     "error": null}
+
+Without a log, span() costs next to nothing, so the calls stay in place.
+The settings are kept in environment variables, so render workers started
+by a process pool (forked or spawned) trace into the same log.  Lines are
+short and appended in a single write, so processes do not interleave them.
+
+profiled() wraps the handling of one volume.  In 'cprofile' mode it saves
+a {name}.prof file (open with pstats or snakeviz); in 'tracemalloc' mode
+it saves the top allocations to {name}.tracemalloc.txt and logs the peak.
+
+Running this module summarizes a trace log per stage:
+
+    python instrument.py trace.jsonl
+
+Functions:
+    configure
+    span
+    profiled
+    summarize
+"""
+
+import cProfile
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+
+ENV_LOG = 'NEXRAD_TRACE_LOG'
+ENV_PROFILE = 'NEXRAD_PROFILE'
+ENV_PROFILE_DIR = 'NEXRAD_PROFILE_DIR'
+PROFILE_MODES = ('cprofile', 'tracemalloc')
+# allocations listed in a tracemalloc report
+TOP_ALLOCATIONS = 25
+
+_lock = threading.Lock()
+
+
+def configure(log_path=None, profile=None, profile_dir=None):
+    """
+    Turn tracing and profiling on or off for this and child processes.
+
+    Parameters
+    ----------
+    log_path : str, optional
+        JSON-lines file spans are appended to.  None turns tracing off.
+    profile : str, optional
+        'cprofile' or 'tracemalloc' to profile every volume.  None turns
+        profiling off.
+    profile_dir : str, optional
+        where profiles are saved.  The default is the directory of
+        log_path, or the current directory.
+
+    """
+    if profile is not None and profile not in PROFILE_MODES:
+        raise ValueError(f'profile must be one of {PROFILE_MODES}')
+    if profile_dir is None:
+        profile_dir = os.path.dirname(os.path.abspath(log_path or '.'))
+    for name, value in ((ENV_LOG, log_path), (ENV_PROFILE, profile),
+                        (ENV_PROFILE_DIR, profile_dir)):
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+    if log_path is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(log_path)),
+                    exist_ok=True)
+
+
+def write(record):
+    """ Append a record to the trace log, if there is one. """
+
+    log_path = os.environ.get(ENV_LOG)
+    if log_path is None:
+        return
+    line = json.dumps(record, default=str) + '\n'
+    with _lock, open(log_path, 'a') as fp:
+        fp.write(line)
+
+
+@contextmanager
+def span(stage, **attrs):
+    """
+    Time a stage and log it with its attributes.
+
+    Yields the attrs dict, so the body can add what it only learns while
+    running, e.g. attrs['bytes'] after a download, or an 'error' it handled
+    itself.  An exception raised by the body is logged as the span's
+    'error' and raised again.
+
+    Parameters
+    ----------
+    stage : str
+        name of the stage, e.g. 'decode'
+    **attrs
+        JSON-serializable details such as file, bytes or sweep
+
+    """
+    if ENV_LOG not in os.environ:
+        yield attrs
+        return
+    record = {'stage': stage, 'start': time.time(), 'seconds': None,
+              'pid': os.getpid()}
+    start = time.perf_counter()
+    error = None
+    try:
+        yield attrs
+    except BaseException as e:
+        error = repr(e)
+        raise
+    finally:
+        record['seconds'] = time.perf_counter() - start
+        record.update(attrs)
+        if error is not None or 'error' not in record:
+            record['error'] = error
+        write(record)
+
+
+@contextmanager
+def profiled(name):
+    """
+    Profile the body in the configured mode, see the module docstring.
+
+    Parameters
+    ----------
+    name : str
+        base name of the profile files, e.g. the volume filename
+
+    """
+    mode = os.environ.get(ENV_PROFILE)
+    if mode is None:
+        yield
+        return
+    profile_dir = os.environ.get(ENV_PROFILE_DIR, '.')
+    os.makedirs(profile_dir, exist_ok=True)
+
+    if mode == 'cprofile':
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            path = os.path.join(profile_dir, name + '.prof')
+            profile.dump_stats(path)
+            write({'stage': 'profile', 'start': time.time(),
+                   'pid': os.getpid(), 'file': name, 'path': path})
+        return
+
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if started:
+            tracemalloc.stop()
+        path = os.path.join(profile_dir, name + '.tracemalloc.txt')
+        with open(path, 'w') as fp:
+            fp.write(f'peak {peak / 2**20:.1f} MB, '
+                     f'current {current / 2**20:.1f} MB\n')
+            for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS]:
+                fp.write(str(stat) + '\n')
+        write({'stage': 'profile', 'start': time.time(), 'pid': os.getpid(),
+               'file': name, 'path': path, 'peak_bytes': peak})
+
+
+def summarize(log_path):
+    """
+    Per-stage statistics of a trace log.
+
+    Returns
+    -------
+    stages : dict
+        stage -> 'n', 'errors', 'total', 'p50' and 'p95' seconds and the
+        total 'bytes' where the spans have them
+
+    """
+    seconds, errors, nbytes = {}, {}, {}
+    with open(log_path) as fp:
+        for line in fp:
+            record = json.loads(line)
+            if record.get('seconds') is None:
+                continue
+            stage = record['stage']
+            seconds.setdefault(stage, []).append(record['seconds'])
+            errors[stage] = errors.get(stage, 0) + bool(record.get('error'))
+            nbytes[stage] = nbytes.get(stage, 0) + (record.get('bytes') or 0)
+
+    stages = {}
+    for stage, values in seconds.items():
+        values = np.asarray(values)
+        stages[stage] = {'n': len(values), 'errors': errors[stage],
+                         'total': float(values.sum()),
+                         'p50': float(np.percentile(values, 50)),
+                         'p95': float(np.percentile(values, 95)),
+                         'bytes': nbytes[stage]}
+    return stages
+
+
+if __name__ == '__main__':
+    stages = summarize(sys.argv[1])
+    print(f'{"stage":14}{"n":>6}{"errors":>8}{"total s":>10}{"p50 s":>9}'
+          f'{"p95 s":>9}{"MB":>9}')
+    for stage, s in sorted(stages.items(), key=lambda i: -i[1]['total']):
+        print(f'{stage:14}{s["n"]:6d}{s["errors"]:8d}{s["total"]:10.2f}'
+              f'{s["p50"]:9.3f}{s["p95"]:9.3f}{s["bytes"] / 2**20:9.1f}')
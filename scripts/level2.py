@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+"""
+Low level helpers for NEXRAD Archive II (level 2) volumes.
+
+An Archive II file is a 24 byte volume header followed by LDM records.  Each
+record is a 4 byte size followed by a bzip2 stream of messages.  The first
+record holds the metadata messages, including the volume coverage pattern
+(message 5) that lists every elevation cut of the volume in scan order.
+Reading only that first record is enough to know which scans hold the
+elevation cuts wanted, so pyart can be asked to decode just those.
+
+Volumes are written in scan order, so the lowest cuts sit at the start of
+the file.  fetch_cuts reads a remote volume with byte-range requests, one
+LDM record after another, and stops as soon as the radial status of the
+message 31 radials shows that the last scan wanted has ended.  For 0.5
+degree products that is usually a small part of the file.
+
+Functions:
+    read_vcp
+    select_scans
+    read_volume
+    fetch_cuts
+    read_remote
+"""
+
+import bz2
+import io
+import struct
+import pyart
+from pyart.io.common import prepare_for_read
+import instrument
+
+VOLUME_HEADER_SIZE = 24
+CONTROL_WORD_SIZE = 4
+# each message starts with 12 bytes of legacy CTM data and a 16 byte header
+CTM_SIZE = 12
+MSG_HEADER_SIZE = 16
+# messages other than 31 are padded to this size
+RECORD_SIZE = 2432
+# number of fixed size messages in the metadata record
+METADATA_MESSAGES = 134
+
+# message 5 body: msg_size, pattern_type, pattern_number, num_cuts, ...
+MSG5_HEADER = struct.Struct('>HHHH')
+MSG5_HEADER_SIZE = 22
+MSG5_CUT_SIZE = 46
+# elevation angles are 16 bit binary angles
+ANGLE_SCALE = 360.0 / 65536.0
+
+# message 5 waveform types
+WAVEFORMS = {1: 'CS', 2: 'CDW', 3: 'CDWO', 4: 'B', 5: 'SPP'}
+
+# offset of the radial status in the message 31 body, and the statuses of
+# the last radial of a scan (end of elevation, end of volume)
+MSG31_STATUS_OFFSET = 21
+END_OF_SCAN = (2, 4)
+# bytes asked for per byte-range request by fetch_cuts
+BLOCK_SIZE = 2**18
+
+
+def iter_messages(buf):
+    """
+    Walk the messages of a decompressed LDM record.
+
+    Yields
+    ------
+    msg_type, pos : int, int
+        message type and offset of the message (CTM bytes included)
+
+    """
+    pos = 0
+    while pos + CTM_SIZE + MSG_HEADER_SIZE <= len(buf):
+        size, _, msg_type = struct.unpack_from('>HBB', buf, pos + CTM_SIZE)
+        yield msg_type, pos
+        if msg_type == 31:
+            if size == 0:
+                return
+            pos += CTM_SIZE + size * 2
+        else:
+            pos += RECORD_SIZE
+
+
+def parse_vcp(buf):
+    """
+    Elevation cuts of the message 5 found in a decompressed record.
+
+    Returns
+    -------
+    cuts : list of dict or None
+        one dict per cut in scan order, with the 'angle' in degrees and
+        the 'waveform' code; None when the record has no message 5
+
+    """
+    for msg_type, pos in iter_messages(buf):
+        if msg_type != 5:
+            continue
+        body = pos + CTM_SIZE + MSG_HEADER_SIZE
+        num_cuts = MSG5_HEADER.unpack_from(buf, body)[3]
+        cuts = []
+        for n in range(num_cuts):
+            cut = body + MSG5_HEADER_SIZE + n * MSG5_CUT_SIZE
+            angle, _, waveform = struct.unpack_from('>HBB', buf, cut)
+            cuts.append({'angle': angle * ANGLE_SCALE,
+                         'waveform': WAVEFORMS.get(waveform, waveform)})
+        return cuts
+    return None
+
+
+def read_vcp(filename):
+    """
+    Elevation cuts of a volume, read from its metadata record only.
+
+    Parameters
+    ----------
+    filename : str or file-like
+        Archive II file; gzip or bzip2 compressed files are handled.
+        File-like objects are rewound after reading.
+
+    Returns
+    -------
+    cuts : list of dict or None
+        as returned by parse_vcp; None if the volume has no usable VCP
+
+    """
+    if hasattr(filename, 'read'):
+        start = filename.tell()
+        fh = filename
+    else:
+        fh = prepare_for_read(filename)
+    try:
+        header = fh.read(VOLUME_HEADER_SIZE + CONTROL_WORD_SIZE)
+        if len(header) < VOLUME_HEADER_SIZE + CONTROL_WORD_SIZE:
+            return None
+        first = fh.read(2)
+        if first == b'BZ':
+            size = struct.unpack_from('>i', header, VOLUME_HEADER_SIZE)[0]
+            record = bz2.decompress(first + fh.read(abs(size) - 2))
+        else:
+            # uncompressed messages follow the volume header directly
+            record = (header[VOLUME_HEADER_SIZE:] + first +
+                      fh.read(METADATA_MESSAGES * RECORD_SIZE))
+        return parse_vcp(record)
+    except (OSError, ValueError, EOFError, struct.error):
+        return None
+    finally:
+        if fh is filename:
+            fh.seek(start)
+        else:
+            fh.close()
+
+
+def select_scans(cuts, angles):
+    """
+    Scan numbers of the cuts at the requested elevations.
+
+    Parameters
+    ----------
+    cuts : list of dict
+        elevation cuts from read_vcp
+    angles : list of int
+        elevation angles times 10, as used by extract_sweeps (e.g. 5 for
+        the 0.5 degree cut)
+
+    Returns
+    -------
+    scans : list of int
+        zero based scan numbers, in scan order
+
+    """
+    wanted = set(angles)
+    return [n for n, cut in enumerate(cuts)
+            if int(round(cut['angle'] * 10)) in wanted]
+
+
+def read_volume(filename, fields=None, cuts=None, **kwargs):
+    """
+    Read a volume, decoding only the moments and elevation cuts needed.
+
+    Parameters
+    ----------
+    filename : str or file-like
+        Archive II file
+    fields : list of str, optional
+        pyart field names to decode (e.g. the prods list).  The default
+        (None) decodes every moment.
+    cuts : list of int, optional
+        elevation angles times 10 to decode (e.g. [5]).  Both scans of a
+        split cut are kept, so extract_sweeps works on the result.  The
+        default (None) decodes every scan.  A ValueError is raised when
+        the volume has none of the cuts.
+    **kwargs
+        passed on to pyart.io.read_nexrad_archive
+
+    Returns
+    -------
+    radar : pyart.core.Radar
+
+    """
+    scans = None
+    if cuts is not None:
+        vcp = read_vcp(filename)
+        if vcp:
+            scans = select_scans(vcp, cuts)
+            if not scans:
+                raise ValueError(f'volume has none of the cuts {cuts}')
+
+    try:
+        return pyart.io.read_nexrad_archive(filename, include_fields=fields,
+                                            scans=scans, **kwargs)
+    except IndexError:
+        # a truncated volume may hold fewer scans than its VCP lists
+        if hasattr(filename, 'seek'):
+            filename.seek(0)
+        radar = pyart.io.read_nexrad_archive(filename, include_fields=fields,
+                                             **kwargs)
+        if cuts is not None:
+            keep = [n for n, a in enumerate(radar.fixed_angle['data'])
+                    if int(round(a * 10)) in set(cuts)]
+            if not keep:
+                raise ValueError(f'volume has none of the cuts {cuts}')
+            radar = radar.extract_sweeps(keep)
+        return radar
+
+
+def fetch_cuts(fs, path, cuts=None, block_size=BLOCK_SIZE):
+    """
+    Start of a remote volume, up to the end of the last cut wanted.
+
+    The volume header and LDM records are fetched in order with byte-range
+    requests of at least block_size bytes.  The metadata record gives the
+    scans of the cuts (see read_vcp); every later record is decompressed
+    only to count the scans ending in it.  Volumes that are not bzip2
+    compressed, or that have no usable VCP, are fetched whole; of a volume
+    with none of the cuts only the metadata record is fetched.
+
+    Parameters
+    ----------
+    fs : filesystem
+        with the fsspec cat_file interface, e.g. s3fs.S3FileSystem
+    path : str
+        volume in the bucket, e.g. a key from NexradLevel2.filelist
+    cuts : list of int, optional
+        elevation angles times 10, as for read_volume.  The default (None)
+        fetches the whole volume.
+    block_size : int, optional
+        smallest request in bytes.  The default is BLOCK_SIZE.
+
+    Returns
+    -------
+    buf : bytes
+        the volume header and the complete records read, which
+        read_volume decodes like a full file
+    nbytes : int
+        bytes transferred, including any read past the last record
+
+    """
+    buf = bytearray()
+    eof = False
+
+    def fill(end=None):
+        # extend buf to at least end bytes, or to the end of the file
+        nonlocal eof
+        while not eof and (end is None or len(buf) < end):
+            want = block_size if end is None else max(end - len(buf),
+                                                      block_size)
+            data = fs.cat_file(path, start=len(buf), end=len(buf) + want)
+            eof = len(data) < want
+            buf.extend(data)
+        return end is None or len(buf) >= end
+
+    pos = VOLUME_HEADER_SIZE
+    magic = pos + CONTROL_WORD_SIZE
+    if cuts is None or not fill(magic + 2) or buf[magic:magic + 2] != b'BZ':
+        fill()
+        return bytes(buf), len(buf)
+
+    last_scan = None
+    ended = 0
+    while fill(pos + CONTROL_WORD_SIZE):
+        size = abs(struct.unpack_from('>i', buf, pos)[0])
+        end = pos + CONTROL_WORD_SIZE + size
+        if size == 0 or not fill(end):
+            break
+        record = bz2.decompress(bytes(buf[pos + CONTROL_WORD_SIZE:end]))
+        pos = end
+
+        if last_scan is None:
+            # the metadata record
+            vcp = parse_vcp(record)
+            if not vcp:
+                fill()
+                return bytes(buf), len(buf)
+            scans = select_scans(vcp, cuts)
+            if not scans:
+                # read_volume finds none of the cuts in the metadata alone
+                break
+            last_scan = max(scans)
+            continue
+
+        for msg_type, msg_pos in iter_messages(record):
+            if msg_type != 31:
+                continue
+            status = record[msg_pos + CTM_SIZE + MSG_HEADER_SIZE +
+                            MSG31_STATUS_OFFSET]
+            if status in END_OF_SCAN:
+                ended += 1
+        if ended > last_scan:
+            break
+
+    return bytes(buf[:pos]), len(buf)
+
+
+def read_remote(fs, path, fields=None, cuts=None, block_size=BLOCK_SIZE,
+                **kwargs):
+    """
+    Decode the cuts of a remote volume without downloading all of it.
+
+    The part of the volume from fetch_cuts is decoded in memory by
+    read_volume; nothing is written to disk.
+
+    Parameters
+    ----------
+    fs, path, block_size :
+        as for fetch_cuts
+    fields, cuts, **kwargs :
+        as for read_volume
+
+    Returns
+    -------
+    radar : pyart.core.Radar
+
+    """
+    with instrument.span('partial_read', file=path, cuts=cuts) as attrs:
+        buf, attrs['bytes'] = fetch_cuts(fs, path, cuts, block_size)
+        attrs['used'] = len(buf)
+    with instrument.span('decode', file=path.split('/')[-1], partial=True):
+        return read_volume(io.BytesIO(buf), fields=fields, cuts=cuts,
+                           **kwargs)
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Regional composites of several WSR-88Ds for one valid time.
+
+For every site the volume closest to the valid time is found in the AWS
+catalog, downloaded and decoded (lowest cut and one moment only).  The
+lowest sweep nearest the valid time, which may be a SAILS revisit, is then
+resampled onto a common lon/lat grid with a fast_render.PixelIndex.  That
+index map is computed once per site, grid and gate geometry and reused for
+every later composite.  Sites are processed in parallel worker processes
+and merged with one of two rules:
+
+    max       highest value of any radar covering a cell
+    nearest   value of the closest radar covering the cell
+
+Functions:
+    nearest_volume
+    site_grid
+    mosaic
+    save_png
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import numpy as np
+from aws_catalog import BUCKET, NexradLevel2
+from fast_render import pixel_index, write_png
+from level2 import read_vcp, read_volume
+from radar_cmaps import to_rgba
+import sweeps
+
+RULES = ('max', 'nearest')
+
+
+def grid_shape(extent, resolution):
+    """ (height, width) of a lon/lat grid covering extent. """
+
+    min_lon, max_lon, min_lat, max_lat = extent
+    return (int(round((max_lat - min_lat) / resolution)),
+            int(round((max_lon - min_lon) / resolution)))
+
+
+def nearest_volume(nexrad, valid_time):
+    """
+    Filepath of the volume of a site closest to the valid time.
+
+    Parameters
+    ----------
+    nexrad : aws_catalog.NexradLevel2
+        catalog of the site, covering a window around valid_time
+    valid_time : datetime
+
+    Returns
+    -------
+    aws_filepath : str or None
+        None when the site has no volume in the window
+
+    """
+    index = nexrad.inventory()
+    found = index.match([valid_time], 'nearest')[0]
+    return None if found < 0 else index.keys[found]
+
+
+def site_grid(nexrad, aws_filepath, raw_data_dir, valid_time, extent,
+              resolution, field='reflectivity', scale=1.0):
+    """
+    Lowest sweep of one site resampled onto the mosaic grid.
+
+    Runs in a worker process of mosaic.
+
+    Parameters
+    ----------
+    nexrad : aws_catalog.NexradLevel2
+        catalog used to download the volume
+    aws_filepath : str
+        volume from nearest_volume
+    raw_data_dir : str
+        full pathname of download destination
+    valid_time : datetime
+    extent : tuple of float
+        (min_lon, max_lon, min_lat, max_lat) of the grid
+    resolution : float
+        grid spacing in degrees
+    field : str, optional
+        pyart field to grid.  The default is 'reflectivity'.
+    scale : float, optional
+        factor converting the field to the units of the plts limits.
+
+    Returns
+    -------
+    result : dict
+        'values' (float32 grid, NaN where no echo or out of range),
+        'distances' (float32 grid of ground range, inf out of range),
+        'sweep_time' and the 'error' raised (None on success)
+
+    """
+    shape = grid_shape(extent, resolution)
+    result = {'values': None, 'distances': None, 'sweep_time': None,
+              'error': None}
+    try:
+        download = nexrad.download_file(aws_filepath, raw_data_dir)
+        if download['status'] == 'failed':
+            raise IOError(download['error'])
+        filepath = download['path']
+
+        vcp = read_vcp(filepath)
+        lowest = None
+        if vcp:
+            lowest = min(int(round(cut['angle'] * 10)) for cut in vcp)
+        radar = read_volume(filepath, fields=[field],
+                            cuts=None if lowest is None else [lowest])
+        labels = sweeps.sweep_labels(radar)
+        if lowest is None:
+            lowest = int(labels['cut'].min())
+        candidates = sweeps.select(labels, lowest)
+
+        # the visit of the lowest cut closest to the valid time
+        start = radar.time['units'].split(' ')[-1]
+        volume_start = np.datetime64(start.rstrip('Z'))
+        sweep_times = volume_start + (
+            labels['time'][candidates] * 1e6).astype('timedelta64[us]')
+        offsets = np.abs(sweep_times - np.datetime64(valid_time))
+        sweep = int(candidates[np.argmin(offsets)])
+
+        ranges = radar.range['data']
+        index = pixel_index(round(float(radar.latitude['data'][0]), 4),
+                            round(float(radar.longitude['data'][0]), 4),
+                            tuple(extent),
+                            round(float(ranges[0]), 1),
+                            round(float(ranges[1] - ranges[0]), 1),
+                            len(ranges),
+                            round(float(radar.fixed_angle['data'][sweep]), 1),
+                            shape[1], shape[0])
+        result['values'] = index.resample(radar, sweep, field) * scale
+        distances = np.full(shape[0] * shape[1], np.inf, dtype=np.float32)
+        distances[index.pixels] = index.distances
+        result['distances'] = distances.reshape(shape)
+        result['sweep_time'] = sweep_times[np.argmin(offsets)].item()
+    except Exception as e:
+        result['error'] = repr(e)
+    return result
+
+
+def mosaic(sites, valid_time, extent, raw_data_dir, resolution=0.01,
+           rule='max', field='reflectivity', scale=1.0,
+           window=timedelta(minutes=10), cache=None, fs=None, bucket=BUCKET,
+           workers=None, pool=None):
+    """
+    Composite of several radars on a common lon/lat grid.
+
+    Parameters
+    ----------
+    sites : list of str
+        radar identifiers, e.g. ['KGRR', 'KDTX', 'KIWX']
+    valid_time : datetime
+        time of the composite (UTC)
+    extent : tuple of float
+        (min_lon, max_lon, min_lat, max_lat) of the grid
+    raw_data_dir : str
+        full pathname of download destination
+    resolution : float, optional
+        grid spacing in degrees.  The default is 0.01.
+    rule : str, optional
+        'max' or 'nearest', see the module docstring.  The default is 'max'.
+    field : str, optional
+        pyart field to composite.  The default is 'reflectivity'.
+    scale : float, optional
+        factor converting the field to the units of the plts limits.
+    window : timedelta, optional
+        volumes further than this from valid_time are ignored.
+        The default is 10 minutes.
+    cache : catalog_cache.CatalogCache, optional
+        passed on to NexradLevel2
+    fs, bucket : optional
+        passed on to NexradLevel2, e.g. for a local copy of the bucket
+    workers : int, optional
+        number of worker processes.  The default is the number of CPUs.
+    pool : concurrent.futures.Executor, optional
+        pool to run the sites on instead of a new one.  Workers keep their
+        index maps, so reusing one pool for a series of valid times only
+        computes each site's map once per worker.
+
+    Returns
+    -------
+    result : dict
+        'data' (masked grid, rows from north to south), 'extent' and,
+        per site, the 'sites' dict of 'key', 'sweep_time' and 'error'
+
+    """
+    if rule not in RULES:
+        raise ValueError(f'rule must be one of {RULES}')
+    extent = tuple(float(v) for v in extent)
+    shape = grid_shape(extent, resolution)
+
+    catalogs = {}
+    site_info = {}
+    for site in sites:
+        nexrad = NexradLevel2(site, valid_time - window, valid_time + window,
+                              fs=fs, bucket=bucket, cache=cache)
+        key = None
+        try:
+            key = nearest_volume(nexrad, valid_time)
+        except Exception as e:
+            site_info[site] = {'key': None, 'sweep_time': None,
+                               'error': repr(e)}
+            continue
+        if key is None:
+            site_info[site] = {'key': None, 'sweep_time': None,
+                               'error': 'no volume near the valid time'}
+            continue
+        catalogs[site] = (nexrad, key)
+
+    grids = {}
+    own_pool = pool is None
+    if own_pool:
+        pool = ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {site: pool.submit(site_grid, nexrad, key,
+                                     os.path.join(raw_data_dir, site),
+                                     valid_time, extent, resolution, field,
+                                     scale)
+                   for site, (nexrad, key) in catalogs.items()}
+        for site, future in futures.items():
+            try:
+                grids[site] = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. killed for memory
+                grids[site] = {'values': None, 'error': repr(e)}
+            site_info[site] = {'key': catalogs[site][1],
+                               'sweep_time': grids[site].get('sweep_time'),
+                               'error': grids[site]['error']}
+    finally:
+        if own_pool:
+            pool.shutdown()
+
+    data = np.full(shape, np.nan, dtype=np.float32)
+    nearest = np.full(shape, np.inf, dtype=np.float32)
+    for site in sites:
+        grid = grids.get(site)
+        if grid is None or grid['values'] is None:
+            continue
+        if rule == 'max':
+            data = np.fmax(data, grid['values'])
+        else:
+            closer = grid['distances'] < nearest
+            data[closer] = grid['values'][closer]
+            nearest[closer] = grid['distances'][closer]
+
+    return {'data': np.ma.masked_invalid(data), 'extent': extent,
+            'sites': {site: site_info[site] for site in sites}}
+
+
+def save_png(result, product, image_path):
+    """
+    Save a composite colored with a plts product, e.g. 'Ref'.
+
+    Cells without echo are transparent, so the image can be laid over a
+    base map covering result['extent'].
+
+    """
+    write_png(image_path, to_rgba(product, result['data'], bytes=True))
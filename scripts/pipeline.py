@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming download -> decode -> render pipeline for level 2 volumes.
+
+Instead of waiting for every download to finish before plotting starts,
+each volume is handed to a render worker as soon as its own download
+completes.  The number of volumes in flight (downloading, waiting for a
+worker or rendering) is bounded, so a long backfill never piles up more
+raw files than the render pool can keep up with.
+
+With in_memory=True there is no download stage at all: the render workers
+fetch each volume into memory themselves and decode it from there, so no
+raw file is written.
+
+Functions:
+    stream
+"""
+
+from functools import partial
+from concurrent.futures import (ThreadPoolExecutor, ProcessPoolExecutor,
+                                FIRST_COMPLETED, wait)
+
+
+def stream(nexrad, filelist, raw_data_dir, image_dest_dir=None,
+           render=None, download_workers=4, render_workers=None,
+           max_in_flight=8, in_memory=False):
+    """
+    Download and render volumes, yielding each one as it finishes.
+
+    Parameters
+    ----------
+    nexrad : aws_catalog.NexradLevel2
+        catalog used to download the files
+    filelist : list of str
+        AWS filepaths, usually from nexrad.filelist()
+    raw_data_dir : str
+        full pathname of download destination
+    image_dest_dir : str, optional
+        directory where images are saved, passed on to render
+    render : callable, optional
+        picklable function render(filepath, image_dest_dir) returning a
+        dict with 'images' and 'error'.  The default is
+        pyart_plot.render_file.
+    download_workers : int, optional
+        number of concurrent downloads.  The default is 4.
+    render_workers : int, optional
+        number of render processes.  The default is the number of CPUs.
+    max_in_flight : int, optional
+        upper bound on volumes between submission and completion.
+        The default is 8.
+    in_memory : bool, optional
+        skip the download stage: render is called with the AWS filepath
+        and fetches the volume itself (the default render does so through
+        nexrad).  The default is False.
+
+    Yields
+    ------
+    aws_filepath, result : str, dict
+        result holds the 'download' result dict, the saved 'images' and
+        the 'error' of whichever stage failed (None on success).
+        A failed download never blocks the other volumes.  In memory,
+        'download' is None.
+
+    """
+    if render is None:
+        from pyart_plot import render_file as render
+        if in_memory:
+            render = partial(render, nexrad=nexrad)
+
+    pending = iter(filelist)
+    downloads = {}
+    renders = {}
+
+    with ThreadPoolExecutor(max_workers=download_workers) as dl_pool, \
+            ProcessPoolExecutor(max_workers=render_workers) as render_pool:
+
+        def fill():
+            while len(downloads) + len(renders) < max_in_flight:
+                aws_filepath = next(pending, None)
+                if aws_filepath is None:
+                    return
+                if in_memory:
+                    future = render_pool.submit(render, aws_filepath,
+                                                image_dest_dir)
+                    renders[future] = (aws_filepath, None)
+                    continue
+                future = dl_pool.submit(nexrad.download_file, aws_filepath,
+                                        raw_data_dir)
+                downloads[future] = aws_filepath
+
+        fill()
+        while downloads or renders:
+            done, _ = wait(list(downloads) + list(renders),
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in downloads:
+                    aws_filepath = downloads.pop(future)
+                    download = future.result()
+                    if download['status'] == 'failed':
+                        yield aws_filepath, {'download': download,
+                                             'images': [],
+                                             'error': download['error']}
+                        continue
+                    render_future = render_pool.submit(render,
+                                                       download['path'],
+                                                       image_dest_dir)
+                    renders[render_future] = (aws_filepath, download)
+                else:
+                    aws_filepath, download = renders.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        # the worker itself died, e.g. killed for memory
+                        result = {'images': [], 'error': repr(e)}
+                    result['download'] = download
+                    yield aws_filepath, result
+            fill()
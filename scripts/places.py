@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Spatial index of the place names plotted on radar images.
+
+The csv (name, lat, lon[, population]) is parsed once per process into NumPy
+arrays.  Places are bucketed on a regular lon/lat grid so a bounding box
+query only looks at the cells it overlaps, and every comparison is
+vectorized.  Labels can be decluttered so that, in dense areas, only the
+most important place within a minimum distance is kept.
+
+Importance is the population column when the csv has one, otherwise the
+order of the rows (earlier rows win).
+
+Classes:
+    PlaceIndex
+
+Functions:
+    load_places
+"""
+
+import csv
+from functools import lru_cache
+import numpy as np
+
+
+class PlaceIndex():
+    """
+    Places held in coordinate arrays with a uniform grid index.
+
+    Parameters
+    ----------
+    names : list of str
+    lons, lats : array-like of float
+        place coordinates in degrees
+    priority : array-like of float, optional
+        larger values are labeled first when decluttering.  The default
+        favors places in the order given.
+    cell : float, optional
+        grid cell size in degrees.  The default is 1.
+
+    """
+
+    def __init__(self, names, lons, lats, priority=None, cell=1.0):
+        self.names = np.asarray(names, dtype=object)
+        self.lons = np.asarray(lons, dtype=float)
+        self.lats = np.asarray(lats, dtype=float)
+        if priority is None:
+            priority = -np.arange(len(self.names), dtype=float)
+        self.priority = np.asarray(priority, dtype=float)
+        self.cell = cell
+
+        if len(self.names) == 0:
+            self.lon0 = self.lat0 = 0.0
+            self.nx = self.ny = 1
+        else:
+            self.lon0 = np.floor(self.lons.min())
+            self.lat0 = np.floor(self.lats.min())
+            self.nx = int((self.lons.max() - self.lon0) // cell) + 1
+            self.ny = int((self.lats.max() - self.lat0) // cell) + 1
+
+        cx = ((self.lons - self.lon0) // cell).astype(int)
+        cy = ((self.lats - self.lat0) // cell).astype(int)
+        cell_ids = cy * self.nx + cx
+        # places sorted by cell; cell k owns order[starts[k]:starts[k+1]]
+        self.order = np.argsort(cell_ids, kind='stable')
+        self.starts = np.searchsorted(cell_ids[self.order],
+                                      np.arange(self.nx * self.ny + 1))
+
+    @classmethod
+    def from_csv(cls, src, cell=1.0):
+        """ Build an index from a name,lat,lon[,population] csv file. """
+
+        names, lats, lons, population = [], [], [], []
+        # the file is not utf-8; latin-1 decodes any byte
+        with open(src, newline='', encoding='latin-1') as fp:
+            for row in csv.reader(fp):
+                try:
+                    lat = float(row[1])
+                    lon = float(row[2])
+                except (IndexError, ValueError):
+                    continue
+                names.append(row[0])
+                lats.append(lat)
+                lons.append(lon)
+                try:
+                    population.append(float(row[3]))
+                except (IndexError, ValueError):
+                    population.append(np.nan)
+
+        priority = None
+        if len(population) > 0 and not np.isnan(population).any():
+            priority = population
+        return cls(names, lons, lats, priority=priority, cell=cell)
+
+    def query(self, xmin, xmax, ymin, ymax):
+        """
+        Indices of places strictly inside a lon/lat box.
+
+        Returns
+        -------
+        indices : ndarray of int
+            sorted by descending priority
+
+        """
+        cx0 = max(int((xmin - self.lon0) // self.cell), 0)
+        cx1 = min(int((xmax - self.lon0) // self.cell), self.nx - 1)
+        cy0 = max(int((ymin - self.lat0) // self.cell), 0)
+        cy1 = min(int((ymax - self.lat0) // self.cell), self.ny - 1)
+        if cx0 > cx1 or cy0 > cy1:
+            return np.zeros(0, dtype=int)
+
+        rows = np.arange(cy0, cy1 + 1) * self.nx
+        candidates = np.concatenate(
+            [self.order[self.starts[r + cx0]:self.starts[r + cx1 + 1]]
+             for r in rows])
+
+        lons = self.lons[candidates]
+        lats = self.lats[candidates]
+        inside = ((lons > xmin) & (lons < xmax) &
+                  (lats > ymin) & (lats < ymax))
+        candidates = candidates[inside]
+        return candidates[np.argsort(-self.priority[candidates],
+                                     kind='stable')]
+
+    def declutter(self, indices, min_distance):
+        """
+        Greedily keep the highest priority places at least min_distance
+        degrees apart.
+
+        Parameters
+        ----------
+        indices : ndarray of int
+            candidates, in descending priority as returned by query
+        min_distance : float
+            minimum separation in degrees of latitude; longitude
+            differences are scaled by cos(latitude)
+
+        Returns
+        -------
+        kept : ndarray of int
+
+        """
+        if len(indices) == 0 or not min_distance:
+            return indices
+
+        coslat = np.cos(np.radians(self.lats[indices].mean()))
+        xs = self.lons[indices] * coslat
+        ys = self.lats[indices]
+        # accepted labels bucketed by cells of size min_distance, so each
+        # candidate is checked against its 3x3 neighborhood only
+        keys = np.floor(np.stack([xs, ys], axis=1) / min_distance)
+        keys = keys.astype(int)
+        buckets = {}
+        kept = []
+        for n in range(len(indices)):
+            kx, ky = keys[n]
+            near = [m for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                    for m in buckets.get((kx + dx, ky + dy), ())]
+            if near:
+                d2 = (xs[near] - xs[n])**2 + (ys[near] - ys[n])**2
+                if d2.min() < min_distance**2:
+                    continue
+            buckets.setdefault((kx, ky), []).append(n)
+            kept.append(n)
+
+        return indices[np.array(kept, dtype=int)]
+
+    def places(self, xmin, xmax, ymin, ymax, min_distance=None):
+        """
+        Places inside a lon/lat box.
+
+        Returns
+        -------
+        places : list of [name, lon, lat]
+            highest priority first
+
+        """
+        indices = self.declutter(self.query(xmin, xmax, ymin, ymax),
+                                 min_distance)
+        return [[self.names[i], float(self.lons[i]), float(self.lats[i])]
+                for i in indices]
+
+
+@lru_cache(maxsize=None)
+def load_places(src):
+    """ PlaceIndex for a csv file, parsed only on first use. """
+
+    return PlaceIndex.from_csv(src)
@@ -13,9 +13,28 @@ Prequisites:
 
 import sys
 import os
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import configlocal as cfg
 from aws_catalog import NexradLevel2
-import matplotlib.pyplot as plt
+from catalog_cache import CatalogCache
+from pipeline import stream
+from places import load_places
+from gis_cache import LayerCache
+from gate_cache import GateCache
+from frame_renderer import FrameRenderer
+import fast_render
+import instrument
+from tiles import TileWriter
+from chunks_ingest import ChunkIngester, read_sweeps
+from level2 import read_remote, read_volume
+from volume_cache import VolumeCache
+import sweeps
+import matplotlib
+# images are only ever saved, never shown; Agg is also safe in pool workers
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
+import numpy as np
 import pyart
 import cartopy.crs as ccrs
 # from metpy.plots import USCOUNTIES
@@ -34,31 +53,54 @@ archive_dir = cfg.archive_dir
 
 gis_dir = cfg.gis_dir
 shape_path = os.path.join(gis_dir, 'c_02ap19', 'c_02ap19.shp')
+# counties clipped and projected once per radar, kept on disk between runs
+layer_cache = LayerCache(os.path.join(data_dir, 'gis_cache'))
+# projected gate grids, shared by the volumes of a site
+gate_cache = GateCache(os.path.join(data_dir, 'gate_cache'))
 
 py_call = cfg.py_call
 
+# Assuming we'll do central time for Chicago
+# my klunky way of subtracting 6 hours from UTC, to get local time
+# This of course changes with transition between standard and daylight time.
+# Been meaning to include more robust handling of this, but since I'm focused
+# more on research, UTC has always been sufficient
+# maybe this is a good project for someone else :)
 
-def get_places(xmin, xmax, ymin, ymax):
+time_shift = timedelta(hours=5)
 
-    src = os.path.join(cfg.gis_dir, "places_conus.csv")
+# pyart field behind each plts product, the factor converting the field
+# units to those of the plts limits, and whether the field comes from the
+# Doppler scan of a split cut rather than the surveillance scan
+PRODUCTS = {
+    'Ref': {'field': 'reflectivity', 'scale': 1.0, 'doppler': False},
+    'Vel': {'field': 'velocity', 'scale': 1.943844, 'doppler': True},
+    'SRV': {'field': 'velocity', 'scale': 1.943844, 'doppler': True},
+    'SpectrumWidth': {'field': 'spectrum_width', 'scale': 1.943844,
+                      'doppler': True},
+    'RhoHV': {'field': 'cross_correlation_ratio', 'scale': 1.0,
+              'doppler': False},
+}
+
+
+def get_places(xmin, xmax, ymin, ymax, min_distance=None):
+    """
 
-    places = []
-    with open(src) as fp:
-        content = fp.read().splitlines()
-        for line in content:
-            test = line.split(',')
-            place = test[0]
-            lat = test[-2][:6]
-            lon = test[-1][:7]
-            try:
-                float(lon)
-                if float(lon) > xmin and float(lon) < xmax:
-                    if float(lat) > ymin and float(lat) < ymax:
-                        places.append([place, lon, lat])
-            except Exception:
-                pass
+    Parameters
+    ----------
+    xmin, xmax, ymin, ymax : float
+        lon/lat bounding box, in degrees
+    min_distance : float, optional
+        if given, drop lower priority places closer than this many degrees
+        to a place already labeled
+
+    Returns
+    -------
+    places : list of [name, lon, lat]
 
-    return places
+    """
+    src = os.path.join(cfg.gis_dir, "places_conus.csv")
+    return load_places(src).places(xmin, xmax, ymin, ymax, min_distance)
 
 
 def extract_sweeps(orig_list, cut):
@@ -75,27 +117,158 @@ def extract_sweeps(orig_list, cut):
     Returns
     -------
     cut_list : list of integers
-        indices representing sweep numbers associated with CS cuts
+        indices representing sweep numbers associated with CS cuts, one
+        per visit of the cut (SAILS revisits included)
 
     """
-    # multiply elevations by 10 and round to ensure that the possible
-    # values listed above are represented
-    sweep_list = [int(round(x*10)) for x in orig_list]
-    cut_list = []
-    found_cut = False
-    for t in range(0, len(sweep_list)):
+    labels = sweeps.classify(orig_list)
+    return [int(t) for t in sweeps.select(labels, cut)]
 
-        if sweep_list[t] == cut and found_cut is False:
 
-            cut_list.append(t)
-            found_cut = True
-        elif sweep_list[t] == cut and found_cut is True:
-            found_cut = False
+def read_radar(filepath, fields=None, cuts=None, volume_cache=None):
+    """
+    Read a volume, through volume_cache when one is given.
+
+    Parameters
+    ----------
+    filepath : str
+        full local path to Archive 2 radar file
+    fields, cuts : list, optional
+        pyart fields and elevation cuts times 10 to read, see
+        level2.read_volume
+    volume_cache : volume_cache.VolumeCache, optional
+        decoded volumes kept on disk between renders
+
+    Returns
+    -------
+    radar : pyart.core.Radar
 
-    return cut_list
+    """
+    with instrument.span('decode', file=os.path.basename(filepath),
+                         cached=volume_cache is not None):
+        if volume_cache is None:
+            return read_volume(filepath, fields=fields, cuts=cuts)
+        return volume_cache.read(filepath, fields=fields, cuts=cuts)
 
 
-def pyart_plot_reflectivity(filepath, filename, dx=1, dy=1):
+def product_sweeps(labels, cuts, product):
+    """
+
+    Parameters
+    ----------
+    labels : ndarray
+        sweep labels of the volume from sweeps.sweep_labels
+
+    cuts : list of integers representing desired cuts to plot
+
+    product : str
+        plts key, e.g. 'Ref' or 'Vel'
+
+    Returns
+    -------
+    sweeps : ndarray of integers
+        for surveillance products the same sweeps as extract_sweeps.
+        Doppler products use the Doppler scan of each split cut instead.
+
+    """
+    if PRODUCTS[product]['doppler']:
+        scans = (sweeps.DOPPLER, sweeps.BATCH)
+    else:
+        scans = (sweeps.SURVEILLANCE, sweeps.BATCH)
+    return sweeps.select(labels, cuts, scans)
+
+
+def product_field(radar, product, storm_motion=None):
+    """
+    Add the field plotted for a product to radar, in the plts units.
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+    product : str
+        plts key, e.g. 'Ref' or 'Vel'
+    storm_motion : tuple of float, optional
+        (direction, speed) the storm is moving toward, in degrees and kts.
+        Required for 'SRV'.
+
+    Returns
+    -------
+    field : str
+        name of the field in radar to plot
+
+    """
+    info = PRODUCTS[product]
+    if product != 'SRV' and info['scale'] == 1.0:
+        return info['field']
+
+    name = info['field'] + '_' + product
+    if name in radar.fields:
+        return name
+    data = radar.fields[info['field']]['data'] * info['scale']
+    if product == 'SRV':
+        if storm_motion is None:
+            raise ValueError('SRV needs a storm_motion (direction, speed)')
+        direction, speed = storm_motion
+        # remove the storm motion component along each beam
+        azimuth = np.radians(radar.azimuth['data'] - direction)
+        elevation = np.radians(radar.elevation['data'])
+        data = data - (speed * np.cos(azimuth) * np.cos(elevation))[:, None]
+    radar.add_field(name, {'data': data,
+                           'units': plts[product]['cblabel']})
+    return name
+
+
+def frame_names(radar, display, s, product='Ref', cut=5):
+    """
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+    display : pyart.graph.RadarMapDisplay
+        display of radar, used to generate the default title
+    s : int
+        sweep number
+    product : str, optional
+        plts key of the product plotted.  The default is 'Ref'.
+    cut : int, optional
+        elevation cut times 10.  The default is 5.
+
+    Returns
+    -------
+    title : str
+        plot title with the radar, elevation, product and sweep time
+    image_filename : str
+        name of the png, e.g. KGRR_20200408_0003_UTC.png for the 0.5 degree
+        reflectivity or KGRR_Vel_09_20200408_0003_UTC.png for the 0.9
+        degree velocity
+
+    """
+    # the sweep's own start, so every visit of a cut gets its own name
+    # whichever scans of the volume were decoded
+    new_time = sweeps.sweep_datetime(radar, s)
+    full_title = display.generate_title(PRODUCTS[product]['field'], s)
+    # example of how temp_title looks
+    # 'KILX 0.5 Deg. 2019-06-16T03:01:10.802000Z \n
+    # Equivalent reflectivity factor'
+    title_parts = full_title.split(' ')
+    rda_str = title_parts[0]
+    elevation_str = title_parts[1]
+    new_title = "{} {} Degrees {}\n".format(rda_str, elevation_str,
+                                            plts[product]['title'])
+
+    time_title = datetime.strftime(new_time, '%a %b %d, %Y\n%I:%M %p UTC')
+    image_time = datetime.strftime(new_time, '_%Y%m%d_%H%M_UTC.png')
+    # the original 0.5 degree reflectivity names are kept unchanged
+    if product == 'Ref' and cut == 5:
+        image_filename = rda_str + image_time
+    else:
+        image_filename = f'{rda_str}_{product}_{cut:02d}{image_time}'
+    title = new_title + time_title
+    return title, image_filename
+
+
+def pyart_plot_reflectivity(filepath, filename, dx=1, dy=1,
+                            image_dest_dir=None, radar=None):
     """
 
     Parameters
@@ -110,12 +283,18 @@ def pyart_plot_reflectivity(filepath, filename, dx=1, dy=1):
     dy : float, optional
         Number of degrees latitude on each side of the radar location to plot.
         The default is 1.
+    image_dest_dir : str, optional
+        Directory where images are saved.  The default is
+        {image_dir}/YYYYmmdd/radar using the date in filename.
+    radar : pyart.core.Radar, optional
+        the volume already decoded; filepath is then not read
 
     Dependencies
     ----------
     shapefile  : str
         shape_path - full local path to shapefile to add.
                      This needs to be staged in advance.
+                     Drawn from layer_cache.
 
          cmap  : str
                  plts dictionary that needs to be imported.
@@ -124,16 +303,23 @@ def pyart_plot_reflectivity(filepath, filename, dx=1, dy=1):
 
     Returns
     -------
-    Nothing. Just exits after creating and saving plot.
+    image_paths : list of str
+        full paths of the saved images
 
     """
     # create datetime object from filename
     file_timestamp = datetime.strptime(filename[4:19], '%Y%m%d_%H%M%S')
+    if image_dest_dir is None:
+        image_dest_dir = os.path.join(image_dir, filename[4:12], 'radar')
+    os.makedirs(image_dest_dir, exist_ok=True)
+    image_paths = []
     # convert datetime object from UTC to local time
     local_dt_obj = file_timestamp - time_shift
     # create string for title based on new datetime object
     title = datetime.strftime(local_dt_obj, '%a %b %d, %Y\n%I:%M %p EDT')
-    radar = pyart.io.read_nexrad_archive(filepath)
+    # only the 0.5 degree reflectivity is plotted
+    if radar is None:
+        radar = read_radar(filepath, ['reflectivity'], [5])
     display = pyart.graph.RadarMapDisplay(radar)
 
     rda_lon = radar.longitude['data'][0]
@@ -145,122 +331,563 @@ def pyart_plot_reflectivity(filepath, filename, dx=1, dy=1):
     ymin = rda_lat - dy + 0.25
     ymax = rda_lat + dy - 0.25
 
-    locations = get_places(xmin, xmax, ymin, ymax)
+    with instrument.span('places', file=filename):
+        locations = get_places(xmin, xmax, ymin, ymax, min_distance=0.1)
 
     # extract sweeps for the 0.5 degree cut
-    angles = list(radar.fixed_angle['data'])
-    desired_sweeps = extract_sweeps(angles, 5)
+    desired_sweeps = sweeps.select(sweeps.sweep_labels(radar), 5)
 
     for s in desired_sweeps:
 
-        # look up first radial of the sweep
-        sweep_start = radar.sweep_start_ray_index['data'][s]
-        # retrieve number of seconds elapsed since very first sweep
-        sweep_start_seconds = int(round(radar.time['data'][sweep_start]))
-
-        new_time = file_timestamp + timedelta(seconds=sweep_start_seconds)
-        full_title = display.generate_title('reflectivity', s)
-        # example of how temp_title looks
-        # 'KILX 0.5 Deg. 2019-06-16T03:01:10.802000Z \n
-        # Equivalent reflectivity factor'        
-        title_parts = full_title.split(' ')
-        rda_str = title_parts[0]
-        elevation_str = title_parts[1]
-        new_title = "{} {} Degrees Reflectivity\n".format(rda_str,
-                                                          elevation_str)
-
-        time_title = datetime.strftime(new_time, '%a %b %d, %Y\n%I:%M %p UTC')
-        image_time = datetime.strftime(new_time, '_%Y%m%d_%H%M_UTC.png')
-        image_filename = rda_str + image_time
-        title = new_title + time_title
+        title, image_filename = frame_names(radar, display, s)
         fig = plt.figure(figsize=(6, 6))
         projection = ccrs.LambertConformal(central_latitude=rda_lat,
                                            central_longitude=rda_lon)
-        display.plot_ppi_map('reflectivity', int(s), vmin=-30, vmax=80,
-                             cmap=plts['Ref']['cmap'],
-                             title=title, title_flag=True,
-                             colorbar_flag=True,
-                             colorbar_label=plts['Ref']['cblabel'],
-                             min_lon=xmin, max_lon=xmax, min_lat=ymin,
-                             max_lat=ymax,
-                             resolution='50m', projection=projection,
-                             shapefile=shape_path,
-                             shapefile_kwargs={'facecolor': 'none',
-                                               'edgecolor': 'gray',
-                                               'linewidth': 0.7},
-                             lat_lines=[0], lon_lines=[0],  # omit grid lines
-                             fig=fig, lat_0=rda_lat, lon_0=rda_lon)
-
-        # ax = display.ax
-        # ax.add_feature(USCOUNTIES.with_scale('5m'), edgecolor='gray',
-        #                linewidth=0.7)
-
-        for p in range(0, len(locations)):
-            place = locations[p][0]
-            lat = float(locations[p][2])
-            lon = float(locations[p][1])
-            plt.plot(lon, lat, 'o', color='black',
-                     transform=ccrs.PlateCarree(), zorder=10)
-            plt.text(lon, lat, place, horizontalalignment='center',
-                     verticalalignment='top', transform=ccrs.PlateCarree())
+        with instrument.span('plot', file=filename, sweep=int(s)):
+            display.plot_ppi_map('reflectivity', int(s), vmin=-30, vmax=80,
+                                 cmap=plts['Ref']['cmap'],
+                                 title=title, title_flag=True,
+                                 colorbar_flag=True,
+                                 colorbar_label=plts['Ref']['cblabel'],
+                                 min_lon=xmin, max_lon=xmax, min_lat=ymin,
+                                 max_lat=ymax,
+                                 resolution='50m', projection=projection,
+                                 lat_lines=[0], lon_lines=[0],  # no grid
+                                 fig=fig, lat_0=rda_lat, lon_0=rda_lon)
+
+        with instrument.span('overlays', file=filename, sweep=int(s)):
+            # counties are already in the map projection, so cartopy draws
+            # them without reading or transforming the shapefile again
+            counties = layer_cache.geometries(shape_path, projection,
+                                              (xmin, xmax, ymin, ymax))
+            display.ax.add_geometries(counties, crs=projection,
+                                      facecolor='none', edgecolor='gray',
+                                      linewidth=0.7)
+
+            # ax = display.ax
+            # ax.add_feature(USCOUNTIES.with_scale('5m'), edgecolor='gray',
+            #                linewidth=0.7)
+
+            for p in range(0, len(locations)):
+                place = locations[p][0]
+                lat = float(locations[p][2])
+                lon = float(locations[p][1])
+                plt.plot(lon, lat, 'o', color='black',
+                         transform=ccrs.PlateCarree(), zorder=10)
+                plt.text(lon, lat, place, horizontalalignment='center',
+                         verticalalignment='top',
+                         transform=ccrs.PlateCarree())
 
         # image_dst_path = os.path.join(this_image_dir, filename + '.png')
-        image_dst_path = os.path.join(this_image_dir, image_filename)
+        image_dst_path = os.path.join(image_dest_dir, image_filename)
 
-        plt.savefig(image_dst_path, format='png', bbox_inches="tight", dpi=150)
+        with instrument.span('savefig', file=filename, sweep=int(s)):
+            plt.savefig(image_dst_path, format='png', bbox_inches="tight",
+                        dpi=150)
         print('  Image saved at  ' + image_dst_path)
         plt.close()
+        image_paths.append(image_dst_path)
 
-    return None
+    return image_paths
 
 
-# TODO: Move other GIS files to an external location, and eventually
-# provide via a GUI.
-# Define radar, date, hours in which to acquire files and plot data
-###########################################
-radar = 'KGRR'
-start_date = datetime(2020, 4, 8, 0, 0)
-end_date = datetime(2020, 4, 8, 0, 10)
-###########################################
+def render_products(filepath, products=('Ref',), cuts=(5,), dx=1, dy=1,
+                    image_dest_dir=None, storm_motion=None,
+                    volume_cache=None, fast=False, radar=None):
+    """
+    Plot several products and cuts of a volume from a single decode.
 
-# Go to AWS or other location and get list of available files for date range
-nexradlist = NexradLevel2(radar, start_date, end_date)
-filelist = nexradlist.filelist()
+    The volume is read once, decoding only the moments and cuts requested.
+    Every product then gets one FrameRenderer, with the colormap, limits
+    and colorbar label of its plts entry, that draws all of its cuts.
+    With fast=True the sweeps are instead resampled straight to PNG by
+    fast_render: data only, no map, labels or colorbar.
 
-# Assuming we'll do central time for Chicago
-# my klunky way of subtracting 6 hours from UTC, to get local time
-# This of course changes with transition between standard and daylight time.
-# Been meaning to include more robust handling of this, but since I'm focused
-# more on research, UTC has always been sufficient
-# maybe this is a good project for someone else :)
+    Parameters
+    ----------
+    filepath : str
+        full local path to Archive 2 radar file
+    products : list of str, optional
+        plts keys to plot, any of PRODUCTS.  The default is ('Ref',).
+    cuts : list of int, optional
+        elevation cuts times 10, e.g. (5, 9).  The default is (5,).
+    dx, dy : float, optional
+        Degrees of longitude/latitude on each side of the radar to plot.
+    image_dest_dir : str, optional
+        Directory where images are saved.  The default is
+        {image_dir}/YYYYmmdd/radar using the date in the filename.
+    storm_motion : tuple of float, optional
+        (direction, speed) in degrees and kts, needed for 'SRV'.
+    volume_cache : volume_cache.VolumeCache, optional
+        if given, the decoded volume is stored in and read from it
+    fast : bool, optional
+        render with fast_render.render_sweep.  The default is False.
+    radar : pyart.core.Radar, optional
+        the volume already decoded, e.g. by level2.read_remote; filepath
+        then only names the images
 
-time_shift = timedelta(hours=5)
+    Returns
+    -------
+    image_paths : list of str
+        full paths of the saved images
+
+    """
+    filename = os.path.basename(filepath)
+    if image_dest_dir is None:
+        image_dest_dir = os.path.join(image_dir, filename[4:12], 'radar')
+    os.makedirs(image_dest_dir, exist_ok=True)
+
+    fields = sorted({PRODUCTS[p]['field'] for p in products})
+    if radar is None:
+        radar = read_radar(filepath, fields, list(cuts), volume_cache)
+    display = pyart.graph.RadarMapDisplay(radar)
+
+    rda_lon = radar.longitude['data'][0]
+    rda_lat = radar.latitude['data'][0]
+    # add or subtract 0.25 degrees to ensure names stay within plot panel
+    xmin = rda_lon - dx + 0.25
+    xmax = rda_lon + dx - 0.25
+    ymin = rda_lat - dy + 0.25
+    ymax = rda_lat + dy - 0.25
+    extent = (xmin, xmax, ymin, ymax)
+    if not fast:
+        projection = ccrs.LambertConformal(central_latitude=rda_lat,
+                                           central_longitude=rda_lon)
+        with instrument.span('overlays', file=filename):
+            counties = layer_cache.geometries(shape_path, projection, extent)
+            locations = get_places(xmin, xmax, ymin, ymax, min_distance=0.1)
+
+    labels = sweeps.sweep_labels(radar)
+    image_paths = []
+    for product in products:
+        if PRODUCTS[product]['field'] not in radar.fields:
+            print('  No ' + product + ' in ' + filename)
+            continue
+        field = product_field(radar, product, storm_motion)
+        renderer = None
+        if not fast:
+            renderer = FrameRenderer(rda_lat, rda_lon, extent,
+                                     cmap=plts[product]['cmap'],
+                                     vmin=plts[product]['vmn'],
+                                     vmax=plts[product]['vmx'],
+                                     cblabel=plts[product]['cblabel'],
+                                     counties=counties, locations=locations,
+                                     gate_cache=gate_cache)
+        try:
+            for s in product_sweeps(labels, cuts, product):
+                cut = int(labels['cut'][s])
+                title, image_filename = frame_names(
+                    radar, display, s, product, cut)
+                image_dst_path = os.path.join(image_dest_dir, image_filename)
+                with instrument.span('render', file=filename,
+                                     product=product, sweep=int(s),
+                                     fast=fast):
+                    if fast:
+                        fast_render.render_sweep(radar, s, field, product,
+                                                 extent, image_dst_path)
+                    else:
+                        renderer.render(radar, s, field, title,
+                                        image_dst_path)
+                print('  Image saved at  ' + image_dst_path)
+                image_paths.append(image_dst_path)
+        finally:
+            if renderer is not None:
+                renderer.close()
+
+    return image_paths
+
+
+def render_file(filepath, image_dest_dir, products=None, cuts=(5,),
+                storm_motion=None, volume_cache=None, fast=False,
+                nexrad=None):
+    """
+    Plot one volume and report errors instead of raising.
+
+    Used as the process pool worker by render_batch and pipeline.stream.
+    With the default products only the 0.5 degree reflectivity is plotted
+    by pyart_plot_reflectivity; otherwise every product and cut is drawn
+    from one decode by render_products.
+
+    With a nexrad catalog, filepath is an AWS filepath instead: the volume
+    is fetched into memory (see NexradLevel2.fetch) and decoded from
+    there, so nothing is written to disk.  volume_cache is then unused.
+
+    Returns
+    -------
+    result : dict
+        the saved 'images' and the 'error' raised (None on success)
+
+    """
 
-# create a string of format YYYYmmdd based on inputs above
-# (example: '20190719')
-# then, use this string to create sub-directory in image directory
-# to save images
-YYYY = start_date.year
-mm = start_date.month
-dd = start_date.day
-ymd_str = f'{YYYY:.0f}{mm:02.0f}{dd:02.0f}'
-this_image_dir = os.path.join(image_dir, ymd_str, 'radar')
-os.makedirs(this_image_dir, exist_ok=True)
-
-this_data_dir = os.path.join(data_dir, ymd_str, radar, 'raw')
-
-radar_files_already_downloaded = nexradlist.download(filelist, this_data_dir)
-
-# Eventually most of this can go away since downloads now occur elsewhere.
-if radar_files_already_downloaded is False:
-    print("Data files not found or some were missing.")
-
-
-else:
-    # this_data_dir = 'C:/data/20190720/radar' # where arc2 files are
-    files = os.listdir(this_data_dir)
-    for file in files:
-        if 'V06' in file:
-            full_filepath = os.path.join(this_data_dir, file)
-            print('  Beginning plot of ' + full_filepath)
-            locations = pyart_plot_reflectivity(full_filepath, file)
+    filename = os.path.basename(filepath)
+    try:
+        with instrument.profiled(filename), \
+                instrument.span('volume', file=filename) as attrs:
+            radar = None
+            if nexrad is not None:
+                if products is None:
+                    fields, read_cuts = ['reflectivity'], [5]
+                else:
+                    fields = sorted({PRODUCTS[p]['field'] for p in products})
+                    read_cuts = list(cuts)
+                with nexrad.fetch(filepath) as fp, \
+                        instrument.span('decode', file=filename,
+                                        in_memory=True):
+                    radar = read_volume(fp, fields=fields, cuts=read_cuts)
+            if products is None:
+                images = pyart_plot_reflectivity(
+                    filepath, filename, image_dest_dir=image_dest_dir,
+                    radar=radar)
+            else:
+                images = render_products(filepath, products, cuts,
+                                         image_dest_dir=image_dest_dir,
+                                         storm_motion=storm_motion,
+                                         volume_cache=volume_cache,
+                                         fast=fast, radar=radar)
+            attrs['images'] = len(images)
+        return {'images': images, 'error': None}
+    except Exception as e:
+        plt.close('all')
+        return {'images': [], 'error': repr(e)}
+
+
+def render_loop(filepaths, image_dest_dir=None, dx=1, dy=1,
+                volume_cache=None):
+    """
+    Plot a time series of volumes from one radar as animation frames.
+
+    The figure, map, counties, place labels and colorbar are built once by
+    a FrameRenderer; each frame only replaces the radar data and title.
+    Image filenames match pyart_plot_reflectivity.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        full local paths to Archive 2 radar files from the same radar
+    image_dest_dir : str, optional
+        Directory where images are saved.  The default is
+        {image_dir}/YYYYmmdd/radar using the date in each filename.
+    dx, dy : float, optional
+        Degrees of longitude/latitude on each side of the radar to plot.
+    volume_cache : volume_cache.VolumeCache, optional
+        if given, decoded volumes are stored in and read from it
+
+    Returns
+    -------
+    results : dict
+        keyed by filepath, each value a dict with the saved 'images' and
+        the 'error' raised while plotting (None on success)
+
+    """
+    renderer = None
+    results = {}
+    try:
+        for filepath in filepaths:
+            filename = os.path.basename(filepath)
+            images = []
+            try:
+                dest_dir = image_dest_dir
+                if dest_dir is None:
+                    dest_dir = os.path.join(image_dir, filename[4:12],
+                                            'radar')
+                os.makedirs(dest_dir, exist_ok=True)
+
+                radar = read_radar(filepath, ['reflectivity'], [5],
+                                   volume_cache)
+                display = pyart.graph.RadarMapDisplay(radar)
+                if renderer is None:
+                    rda_lon = radar.longitude['data'][0]
+                    rda_lat = radar.latitude['data'][0]
+                    xmin = rda_lon - dx + 0.25
+                    xmax = rda_lon + dx - 0.25
+                    ymin = rda_lat - dy + 0.25
+                    ymax = rda_lat + dy - 0.25
+                    extent = (xmin, xmax, ymin, ymax)
+                    projection = ccrs.LambertConformal(
+                        central_latitude=rda_lat, central_longitude=rda_lon)
+                    renderer = FrameRenderer(
+                        rda_lat, rda_lon, extent,
+                        cmap=plts['Ref']['cmap'], vmin=-30, vmax=80,
+                        cblabel=plts['Ref']['cblabel'],
+                        counties=layer_cache.geometries(shape_path,
+                                                        projection, extent),
+                        locations=get_places(xmin, xmax, ymin, ymax,
+                                             min_distance=0.1),
+                        gate_cache=gate_cache)
+
+                labels = sweeps.sweep_labels(radar)
+                for s in sweeps.select(labels, 5):
+                    title, image_filename = frame_names(radar, display, s)
+                    image_dst_path = os.path.join(dest_dir, image_filename)
+                    with instrument.span('render', file=filename,
+                                         product='Ref', sweep=int(s)):
+                        renderer.render(radar, s, 'reflectivity', title,
+                                        image_dst_path)
+                    print('  Image saved at  ' + image_dst_path)
+                    images.append(image_dst_path)
+                results[filepath] = {'images': images, 'error': None}
+            except Exception as e:
+                results[filepath] = {'images': images, 'error': repr(e)}
+    finally:
+        if renderer is not None:
+            renderer.close()
+
+    return results
+
+
+def render_tiles(filepaths, tile_dir=None, products=('Ref',), cuts=(5,),
+                 writer=None, storm_motion=None, volume_cache=None):
+    """
+    Write Web Mercator XYZ tiles for a time series of volumes.
+
+    Volumes are handled in order by one TileWriter, so a tile that did not
+    change since the previous volume is linked instead of encoded again.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        full local paths to Archive 2 radar files, oldest first
+    tile_dir : str, optional
+        root directory of the tiles.  The default is {image_dir}/tiles.
+        Each frame is written to a directory named like its image, e.g.
+        KGRR_20200408_0003_UTC/{z}/{x}/{y}.png
+    products, cuts : list, optional
+        as for render_products
+    writer : tiles.TileWriter, optional
+        writer to continue with, e.g. between calls in real time.
+        The default creates one for tile_dir.
+    storm_motion, volume_cache : optional
+        as for render_products
+
+    Returns
+    -------
+    results : dict
+        keyed by filepath, each value a dict with the 'tiles' counts of
+        every frame and the 'error' raised (None on success)
+
+    """
+    if writer is None:
+        if tile_dir is None:
+            tile_dir = os.path.join(image_dir, 'tiles')
+        writer = TileWriter(tile_dir)
+
+    fields = sorted({PRODUCTS[p]['field'] for p in products})
+    results = {}
+    for filepath in filepaths:
+        filename = os.path.basename(filepath)
+        counts = {}
+        try:
+            radar = read_radar(filepath, fields, list(cuts), volume_cache)
+            display = pyart.graph.RadarMapDisplay(radar)
+            labels = sweeps.sweep_labels(radar)
+            for product in products:
+                if PRODUCTS[product]['field'] not in radar.fields:
+                    continue
+                field = product_field(radar, product, storm_motion)
+                for s in product_sweeps(labels, cuts, product):
+                    cut = int(labels['cut'][s])
+                    _, image_filename = frame_names(
+                        radar, display, s, product, cut)
+                    name = os.path.splitext(image_filename)[0]
+                    with instrument.span('tiles', file=filename,
+                                         product=product,
+                                         sweep=int(s)) as attrs:
+                        counts[name] = writer.write(radar, s, field,
+                                                    product, name)
+                        attrs.update(counts[name])
+                    print('  Tiles saved for  ' + name + '  ' +
+                          str(counts[name]))
+            results[filepath] = {'tiles': counts, 'error': None}
+        except Exception as e:
+            results[filepath] = {'tiles': counts, 'error': repr(e)}
+
+    return results
+
+
+def render_batch(filepaths, image_dest_dir=None, workers=None):
+    """
+    Plot many volumes in parallel, one volume per worker process.
+
+    Parameters
+    ----------
+    filepaths : list of str
+        full local paths to Archive 2 radar files
+    image_dest_dir : str, optional
+        Directory where images are saved.  Passed on to
+        pyart_plot_reflectivity, so image filenames are unchanged.
+    workers : int, optional
+        Number of worker processes.  The default is the number of CPUs.
+
+    Returns
+    -------
+    results : dict
+        keyed by filepath, each value a dict with the saved 'images' and
+        the 'error' raised while plotting (None on success)
+
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(render_file, f, image_dest_dir): f
+                   for f in filepaths}
+        for future in as_completed(futures):
+            filepath = futures[future]
+            try:
+                results[filepath] = future.result()
+            except Exception as e:
+                # the worker itself died, e.g. killed for memory
+                results[filepath] = {'images': [], 'error': repr(e)}
+            if results[filepath]['error'] is not None:
+                print('  Plot failed for ' + filepath + '  ' +
+                      results[filepath]['error'])
+
+    return {f: results[f] for f in filepaths}
+
+
+if __name__ == '__main__':
+    # TODO: Move other GIS files to an external location, and eventually
+    # provide via a GUI.
+    # Define radar, date, hours in which to acquire files and plot data
+    ###########################################
+    radar = 'KGRR'
+    start_date = datetime(2020, 4, 8, 0, 0)
+    end_date = datetime(2020, 4, 8, 0, 10)
+    # set True to follow the radar live instead; start_date is then ignored
+    # and plotting begins with volumes from the last 10 minutes
+    realtime = False
+    # plts products and cuts (elevation times 10) plotted for each volume,
+    # e.g. ['Ref', 'Vel', 'RhoHV'] and [5, 9]; SRV also needs storm_motion
+    products = ['Ref']
+    cuts = [5]
+    storm_motion = None
+    # keep decoded volumes on disk so plotting them again skips the decode
+    cache_volumes = True
+    # data-only images written without matplotlib, for bulk production
+    fast = False
+    # write web map tiles to {image_dir}/tiles instead of images
+    tiles = False
+    # in realtime, read only the cuts plotted with byte-range requests
+    # instead of downloading whole volumes (images only, not tiles)
+    low_latency = False
+    # fetch volumes into memory and decode them there, without writing
+    # raw files to {data_dir} (images only, not tiles)
+    in_memory = False
+    # in realtime, follow the chunks bucket and plot each cut as soon as it
+    # has been scanned instead of waiting for the whole volume (images only)
+    chunks = False
+    # append per-stage timings to {data_dir}/trace.jsonl (summarize with
+    # python instrument.py), and profile every volume with 'cprofile' or
+    # 'tracemalloc' into {data_dir}/profiles
+    trace = False
+    profile = None
+    ###########################################
+
+    if trace or profile:
+        instrument.configure(os.path.join(data_dir, 'trace.jsonl')
+                             if trace else None, profile,
+                             os.path.join(data_dir, 'profiles'))
+
+    if realtime:
+        start_date = datetime.utcnow() - timedelta(minutes=10)
+        end_date = start_date
+
+    # Go to AWS or other location and get list of available files for
+    # date range
+    # listings of past days are cached for good, today's for a few minutes
+    catalog_cache = CatalogCache(os.path.join(data_dir, 'aws_catalog.sqlite'))
+    nexradlist = NexradLevel2(radar, start_date, end_date, cache=catalog_cache)
+
+    # create a string of format YYYYmmdd based on inputs above
+    # (example: '20190719')
+    # then, use this string to create sub-directory in image directory
+    # to save images
+    YYYY = start_date.year
+    mm = start_date.month
+    dd = start_date.day
+    ymd_str = f'{YYYY:.0f}{mm:02.0f}{dd:02.0f}'
+    this_image_dir = os.path.join(image_dir, ymd_str, 'radar')
+    os.makedirs(this_image_dir, exist_ok=True)
+
+    this_data_dir = os.path.join(data_dir, ymd_str, radar, 'raw')
+
+    volume_cache = None
+    if cache_volumes:
+        volume_cache = VolumeCache(os.path.join(data_dir, 'volume_cache'))
+
+    if realtime and chunks:
+        fields = sorted({PRODUCTS[p]['field'] for p in products})
+        # runs until interrupted; a split cut is plotted after its Doppler
+        # scan, so every product of the cut comes from one decode
+        for sweep in ChunkIngester(radar).watch():
+            if not sweep['last_of_cut'] or sweep['cut'] not in cuts:
+                continue
+            try:
+                render_products(sweep['name'], products, [sweep['cut']],
+                                storm_motion=storm_motion, fast=fast,
+                                radar=read_sweeps(sweep, fields))
+            except Exception as e:
+                plt.close('all')
+                print('  Failed  ' + sweep['name'] + '  ' + repr(e))
+
+    elif realtime:
+        writer = TileWriter(os.path.join(image_dir, 'tiles'))
+        partial_reads = low_latency and not tiles
+        memory_reads = in_memory and not tiles
+        # runs until interrupted; images go to a directory per file date
+        for aws_filepath, result in nexradlist.watch(
+                this_data_dir, download=not (partial_reads or memory_reads)):
+            if partial_reads:
+                fields = sorted({PRODUCTS[p]['field'] for p in products})
+                try:
+                    volume = read_remote(nexradlist.fs, aws_filepath,
+                                         fields, cuts)
+                    render_products(aws_filepath, products, cuts,
+                                    storm_motion=storm_motion, fast=fast,
+                                    radar=volume)
+                except Exception as e:
+                    plt.close('all')
+                    print('  Failed  ' + aws_filepath + '  ' + repr(e))
+                continue
+            if memory_reads:
+                rendered = render_file(aws_filepath, None, products, cuts,
+                                       storm_motion, fast=fast,
+                                       nexrad=nexradlist)
+            elif result['status'] == 'failed':
+                continue
+            elif tiles:
+                render_tiles([result['path']], products=products, cuts=cuts,
+                             writer=writer, storm_motion=storm_motion,
+                             volume_cache=volume_cache)
+                continue
+            else:
+                rendered = render_file(result['path'], None, products, cuts,
+                                       storm_motion, volume_cache, fast)
+            if rendered['error'] is not None:
+                print('  Failed  ' + aws_filepath + '  ' + rendered['error'])
+
+    elif tiles:
+        # tiles are written in time order so unchanged ones can be reused
+        downloads = nexradlist.download(nexradlist.filelist(), this_data_dir)
+        filepaths = sorted(d['path'] for d in downloads.values()
+                           if d['status'] != 'failed')
+        render_tiles(filepaths, products=products, cuts=cuts,
+                     storm_motion=storm_motion, volume_cache=volume_cache)
+
+    else:
+        filelist = nexradlist.filelist()
+
+        # each volume is plotted as soon as its own download completes
+        failed = []
+        render = partial(render_file, products=products, cuts=cuts,
+                         storm_motion=storm_motion,
+                         volume_cache=volume_cache, fast=fast,
+                         nexrad=nexradlist if in_memory else None)
+        for aws_filepath, result in stream(nexradlist, filelist,
+                                           this_data_dir, this_image_dir,
+                                           render=render,
+                                           in_memory=in_memory):
+            if result['error'] is not None:
+                failed.append(aws_filepath)
+                print('  Failed  ' + aws_filepath + '  ' + result['error'])
+
+        if len(failed) > 0:
+            print("Data files not found or some were missing.")
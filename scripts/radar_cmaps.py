@@ -6,15 +6,75 @@ Assumption: You'll import the created cmaps into wdss_create_netcdfs.py
 author: thomas.turnage@noaa.gov
 Last updated: 05 May 2020
 ------------------------------------------------
+
+Importing this module only defines the color ramps.  Each ramp is resolved
+into a 256 entry RGBA lookup table (LUT) the first time any of them is
+used; the tables are saved next to the compiled module, so later processes
+just load them.  plts entries expose the LUT as a discrete ListedColormap
+('cmap') with a matching BoundaryNorm ('norm'), both created on first
+access, and to_rgba maps data values to colors with a plain table index.
+matplotlib is only imported when a colormap is actually requested.
 """
 
-import matplotlib as mpl
+import hashlib
+import json
+import os
+from functools import lru_cache
 import numpy as np
-import matplotlib.pyplot as plt
-# from matplotlib.colors import ListedColormap
 import sys
+import cache_files
 # from metpy.plots import colortables
 
+# number of entries of every lookup table
+LUT_SIZE = 256
+
+# resolved lookup tables, rebuilt whenever the ramp definitions change
+LUT_CACHE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         '__pycache__', 'radar_cmaps_luts.npz')
+
+
+def check_position(colors, position=None):
+    """ Position of each color; equally spaced when position is None. """
+
+    if position is None:
+        return np.linspace(0, 1, len(colors))
+    if len(position) != len(colors):
+        sys.exit("position length must be the same as colors")
+    elif position[0] != 0 or position[-1] != 1:
+        sys.exit("position must start with 0 and end with 1")
+    return np.asarray(position, dtype=float)
+
+
+def make_lut(colors, position=None, bit=False, n=LUT_SIZE):
+    """
+    Resolve a color ramp into an RGBA lookup table.
+
+    The entries are the colors make_cmap's LinearSegmentedColormap gives
+    for its n bins, computed with np.interp instead of per-color loops.
+
+    Parameters
+    ----------
+    colors, position, bit :
+        as for make_cmap
+    n : int, optional
+        number of entries.  The default is LUT_SIZE.
+
+    Returns
+    -------
+    lut : ndarray of shape (n, 4)
+        RGBA values between 0 and 1
+
+    """
+    position = check_position(colors, position)
+    rgb = np.asarray(colors, dtype=float)
+    if bit:
+        rgb = rgb / 255.0
+    x = np.linspace(0, 1, n)
+    lut = np.ones((n, 4))
+    for c in range(3):
+        lut[:, c] = np.interp(x, position, rgb[:, c])
+    return np.clip(lut, 0, 1)
+
 
 def make_cmap(colors, position=None, bit=False):
     """
@@ -43,30 +103,58 @@ def make_cmap(colors, position=None, bit=False):
          cmap
 
     """
-    import numpy as np
-    bit_rgb = np.linspace(0, 1, 256)
-    if position is None:
-        position = np.linspace(0, 1, len(colors))
-    else:
-        if len(position) != len(colors):
-            sys.exit("position length must be the same as colors")
-        elif position[0] != 0 or position[-1] != 1:
-            sys.exit("position must start with 0 and end with 1")
+    from matplotlib.colors import LinearSegmentedColormap
+    position = check_position(colors, position)
     if bit:
-        for i in range(len(colors)):
-            colors[i] = (bit_rgb[colors[i][0]],
-                         bit_rgb[colors[i][1]],
-                         bit_rgb[colors[i][2]])
+        colors = [tuple(np.asarray(color) / 255.0) for color in colors]
     cdict = {'red': [], 'green': [], 'blue': []}
     for pos, color in zip(position, colors):
         cdict['red'].append((pos, color[0], color[0]))
         cdict['green'].append((pos, color[1], color[1]))
         cdict['blue'].append((pos, color[2], color[2]))
 
-    cmap = mpl.colors.LinearSegmentedColormap('my_colormap', cdict, 256)
+    cmap = LinearSegmentedColormap('my_colormap', cdict, 256)
     return cmap
 
 
+class PlotEntry(dict):
+    """
+    plts entry whose 'cmap' and 'norm' are built on first access.
+
+    Parameters
+    ----------
+    lut : str
+        key of the cmaps ramp used by the entry
+    **kwargs
+        plain plot settings ('vmn', 'vmx', 'title', ...)
+
+    """
+
+    LAZY = ('cmap', 'norm')
+
+    def __init__(self, lut, **kwargs):
+        super().__init__(kwargs)
+        self.lut = lut
+
+    def __missing__(self, key):
+        if key == 'cmap':
+            value = listed_cmap(self.lut)
+        elif key == 'norm':
+            value = boundary_norm(self['vmn'], self['vmx'])
+        else:
+            raise KeyError(key)
+        self[key] = value
+        return value
+
+    def get(self, key, default=None):
+        if key in self.LAZY:
+            return self[key]
+        return super().get(key, default)
+
+    def __contains__(self, key):
+        return key in self.LAZY or super().__contains__(key)
+
+
 plts = {}
 cmaps = {}
 
@@ -150,6 +238,21 @@ position = [0.0, 0.00001, 0.05, 0.1, 0.15, 0.2, 0.25, 0.255, 0.3, 0.35, 0.4,
 cmaps['dkc_v'] = {'colors': colors, 'position': position, 'min': -100,
                   'max': 100}
 
+# --- Spectrum Width
+cmaps['sw'] = {'colors': [(0, 0, 0), (220, 220, 255), (180, 180, 240),
+                          (50, 50, 150), (255, 255, 0), (255, 150, 0),
+                          (255, 0, 0), (255, 255, 255)],
+               'position': [0, 1/40, 5/40, 0.25, 15/40, 0.5, 0.75, 1],
+               'min': 0, 'max': 40}
+
+# --- CC
+cmaps['cc'] = {'colors': [(175, 175, 175), (255, 225, 200), (100, 50, 50),
+                          (175, 150, 120), (255, 255, 75), (35, 100, 35),
+                          (100, 255, 100), (175, 175, 175)],
+               'position': [0, 10/105, 50/105, 70/105, 90/105, 96/105,
+                            100/105, 1],
+               'min': 0.00, 'max': 1.05}
+
 z = cmaps['wdtd_z']
 v = cmaps['wdtd_v']
 
@@ -157,38 +260,142 @@ vel_max = 100
 vels_array = np.linspace(-vel_max, vel_max, 11)
 vticks = np.ndarray.tolist(vels_array)
 
-ref_cmap = make_cmap(z['colors'], position=z['position'], bit=True)
-plt.register_cmap(cmap=ref_cmap)
-plts['ReflectivityQC'] = {'cmap': ref_cmap, 'vmn': z['min'], 'vmx': z['max'],
-                          'title': 'Reflectivity',
-                          'cbticks': [0, 15, 30, 50, 60], 'cblabel': 'dBZ'}
+plts['ReflectivityQC'] = PlotEntry('wdtd_z', vmn=z['min'], vmx=z['max'],
+                                   title='Reflectivity',
+                                   cbticks=[0, 15, 30, 50, 60],
+                                   cblabel='dBZ')
 plts['Ref'] = plts['ReflectivityQC']
 
-vel_cmap = make_cmap(v['colors'], position=v['position'], bit=True)
-plt.register_cmap(cmap=vel_cmap)
-plts['Velocity'] = {'cmap': vel_cmap, 'vmn': v['min'], 'vmx': v['max'],
-                    'title': 'Velocity', 'cbticks': vticks, 'cblabel': 'kts'}
+plts['Velocity'] = PlotEntry('wdtd_v', vmn=v['min'], vmx=v['max'],
+                             title='Velocity', cbticks=vticks, cblabel='kts')
 plts['Vel'] = plts['Velocity']
-plts['SRV'] = {'cmap': vel_cmap, 'vmn': v['min'], 'vmx': v['max'],
-               'title': 'SR Velocity', 'cbticks': vticks, 'cblabel': 'kts'}
+plts['SRV'] = PlotEntry('wdtd_v', vmn=v['min'], vmx=v['max'],
+                        title='SR Velocity', cbticks=vticks, cblabel='kts')
 
+plts['SpectrumWidth'] = PlotEntry('sw', vmn=0, vmx=40,
+                                  title='Spectrum Width',
+                                  cbticks=[0, 10, 15, 20, 25, 40],
+                                  cblabel='kts')
 
-# --- Spectrum Width
-sw_colors = [(0, 0, 0), (220, 220, 255), (180, 180, 240), (50, 50, 150),
-             (255, 255, 0), (255, 150, 0), (255, 0, 0), (255, 255, 255)]
-sw_position = [0, 1/40, 5/40, 0.25, 15/40, 0.5, 0.75, 1]
-sw_cmap = make_cmap(sw_colors, position=sw_position, bit=True)
-plt.register_cmap(cmap=sw_cmap)
-plts['SpectrumWidth'] = {'cmap': sw_cmap, 'vmn': 0, 'vmx': 40,
-                         'title': 'Spectrum Width',
-                         'cbticks': [0, 10, 15, 20, 25, 40], 'cblabel': 'kts'}
+plts['RhoHV'] = PlotEntry('cc', vmn=0.00, vmx=1.05,
+                          title='Correlation Coefficient',
+                          cbticks=[0.4, 0.6, 0.8, 0.9, 1.0], cblabel=' ')
 
-# --- CC
-cc_colors = [(175, 175, 175), (255, 225, 200), (100, 50, 50), (175, 150, 120),
-             (255, 255, 75), (35, 100, 35), (100, 255, 100), (175, 175, 175)]
-cc_position = [0, 10/105, 50/105, 70/105, 90/105, 96/105, 100/105, 1]
-cc_cmap = make_cmap(cc_colors, position=cc_position, bit=True)
-plt.register_cmap(cmap=cc_cmap)
-plts['RhoHV'] = {'cmap': cc_cmap, 'vmn': 0.00, 'vmx': 1.05,
-                 'title': 'Correlation Coefficient',
-                 'cbticks': [0.4, 0.6, 0.8, 0.9, 1.0], 'cblabel': ' '}
+# module attributes of earlier versions, now resolved on first use
+_CMAP_ATTRS = {'ref_cmap': 'Ref', 'vel_cmap': 'Vel',
+               'sw_cmap': 'SpectrumWidth', 'cc_cmap': 'RhoHV'}
+
+
+def __getattr__(name):
+    if name in _CMAP_ATTRS:
+        return plts[_CMAP_ATTRS[name]]['cmap']
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _digest():
+    """ Hash of the ramp definitions the cached tables were built from. """
+
+    spec = {name: [cmap['colors'], cmap['position']]
+            for name, cmap in sorted(cmaps.items())}
+    spec['size'] = LUT_SIZE
+    return hashlib.sha1(json.dumps(spec).encode()).hexdigest()
+
+
+@lru_cache(maxsize=None)
+def luts():
+    """
+    RGBA lookup table of every ramp in cmaps, keyed by ramp name.
+
+    Loaded from LUT_CACHE when it matches the current definitions,
+    otherwise built with make_lut and saved there for later processes.
+
+    """
+    digest = _digest()
+
+    def load(path):
+        with np.load(path) as npz:
+            if str(npz['digest']) == digest:
+                return {name: npz[name] for name in cmaps}
+        return None
+
+    tables = cache_files.read(LUT_CACHE, load)
+    if tables is not None:
+        return tables
+
+    tables = {name: make_lut(cmap['colors'], cmap['position'], bit=True)
+              for name, cmap in cmaps.items()}
+    try:
+        os.makedirs(os.path.dirname(LUT_CACHE), exist_ok=True)
+        cache_files.write(LUT_CACHE, lambda path: np.savez(
+            path, digest=digest, **tables), suffix='.npz')
+    except OSError:
+        # read-only install; the tables are rebuilt by each process
+        pass
+    return tables
+
+
+@lru_cache(maxsize=None)
+def listed_cmap(name):
+    """ Discrete ListedColormap of the cmaps ramp called name. """
+
+    from matplotlib.colors import ListedColormap
+    return ListedColormap(luts()[name], name=name)
+
+
+def boundary_norm(vmin, vmax, n=LUT_SIZE):
+    """ BoundaryNorm putting vmin..vmax into the n bins of a LUT. """
+
+    from matplotlib.colors import BoundaryNorm
+    return BoundaryNorm(np.linspace(vmin, vmax, n + 1), n, clip=True)
+
+
+def lut_index(product, values):
+    """
+    LUT entry of each data value, as a matplotlib Normalize would pick it.
+
+    Parameters
+    ----------
+    product : str
+        plts key, e.g. 'Ref'
+    values : array-like or masked array
+
+    Returns
+    -------
+    index : ndarray of int
+        between 0 and LUT_SIZE - 1; values outside vmn..vmx are clipped
+
+    """
+    entry = plts[product]
+    scale = LUT_SIZE / (entry['vmx'] - entry['vmn'])
+    values = np.ma.filled(np.ma.asarray(values, dtype=float), np.nan)
+    index = np.floor((values - entry['vmn']) * scale)
+    return np.clip(np.nan_to_num(index), 0, LUT_SIZE - 1).astype(np.intp)
+
+
+def to_rgba(product, values, bytes=False):
+    """
+    Colors of data values in a product's colormap, by direct table index.
+
+    Parameters
+    ----------
+    product : str
+        plts key, e.g. 'Ref'
+    values : array-like or masked array
+        data in the units of the plts limits, e.g. dBZ; masked and NaN
+        values get a transparent color
+    bytes : bool, optional
+        return uint8 values instead of floats.  The default is False.
+
+    Returns
+    -------
+    rgba : ndarray of shape values.shape + (4,)
+
+    """
+    table = luts()[plts[product].lut]
+    if bytes:
+        table = np.rint(table * 255).astype(np.uint8)
+    rgba = table[lut_index(product, values)]
+    invalid = np.ma.getmaskarray(values) | ~np.isfinite(
+        np.ma.filled(np.ma.asarray(values, dtype=float), 0))
+    rgba[invalid] = 0
+    return rgba
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Label every sweep of a volume with its elevation cut and scan type.
+
+Split cuts are scanned twice in a row at the same elevation: first a
+surveillance scan (long PRF, reflectivity and dual-pol moments), then a
+Doppler scan (velocity and spectrum width).  SAILS and MESO-SAILS VCPs also
+revisit the lowest cut several times per volume.  classify labels all the
+sweeps at once, in scan order, with
+
+    cut     elevation angle times 10, e.g. 5 for 0.5 degrees
+    scan    SURVEILLANCE, DOPPLER or BATCH (a cut scanned only once, which
+            holds every moment)
+    repeat  0 for the first visit of a cut in the volume, 1 for the first
+            SAILS revisit, and so on
+    time    seconds from the volume start to the first ray of the sweep
+
+so picking sweeps for plotting is a single boolean lookup with select.
+
+Functions:
+    classify
+    sweep_labels
+    select
+    sweep_datetime
+"""
+
+from datetime import datetime, timedelta
+import numpy as np
+
+SURVEILLANCE = 0
+DOPPLER = 1
+BATCH = 2
+
+LABEL_DTYPE = np.dtype([('cut', int), ('scan', int), ('repeat', int),
+                        ('time', float)])
+
+
+def classify(fixed_angles, start_times=None):
+    """
+    Label the sweeps of a volume.
+
+    Parameters
+    ----------
+    fixed_angles : array-like of float
+        elevation of every sweep in degrees, e.g. radar.fixed_angle['data']
+    start_times : array-like of float, optional
+        time of the first ray of every sweep.  Sweeps are labeled in the
+        order of these times.  The default (None) takes the order given.
+
+    Returns
+    -------
+    labels : ndarray of LABEL_DTYPE
+        one label per sweep, in the order of fixed_angles
+
+    """
+    cuts = np.rint(np.asarray(fixed_angles, dtype=float) * 10).astype(int)
+    n = len(cuts)
+    labels = np.zeros(n, dtype=LABEL_DTYPE)
+    if n == 0:
+        return labels
+    if start_times is None:
+        start_times = np.arange(n, dtype=float)
+    start_times = np.asarray(start_times, dtype=float)
+
+    order = np.argsort(start_times, kind='stable')
+    ordered = cuts[order]
+    index = np.arange(n)
+
+    # runs of consecutive sweeps at the same cut
+    run_start = np.r_[True, ordered[1:] != ordered[:-1]]
+    first = np.maximum.accumulate(np.where(run_start, index, 0))
+    run_end = np.r_[run_start[1:], True]
+    last = np.minimum.accumulate(np.where(run_end, index, n)[::-1])[::-1]
+    position = index - first
+    length = last - first + 1
+
+    # a run holds one scan per batch cut or surveillance/Doppler pairs
+    scan = np.where(position % 2 == 0, SURVEILLANCE, DOPPLER)
+    scan[length == 1] = BATCH
+
+    # visits of each cut (a pair counts once), numbered in time order
+    visit = position % 2 == 0
+    visits = np.flatnonzero(visit)
+    by_cut = visits[np.argsort(ordered[visits], kind='stable')]
+    group_start = np.r_[True, ordered[by_cut][1:] != ordered[by_cut][:-1]]
+    rank = np.arange(len(by_cut))
+    rank -= np.maximum.accumulate(np.where(group_start, rank, 0))
+    repeat = np.zeros(n, dtype=int)
+    repeat[by_cut] = rank
+    # the Doppler scan takes the visit number of its surveillance scan
+    repeat = repeat[index - position % 2]
+
+    labels['cut'][order] = ordered
+    labels['scan'][order] = scan
+    labels['repeat'][order] = repeat
+    labels['time'] = start_times
+    return labels
+
+
+def sweep_labels(radar):
+    """
+    Labels of every sweep of a pyart Radar, ordered by sweep start time.
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+
+    Returns
+    -------
+    labels : ndarray of LABEL_DTYPE
+        see classify
+
+    """
+    starts = radar.time['data'][radar.sweep_start_ray_index['data']]
+    return classify(radar.fixed_angle['data'], starts)
+
+
+def select(labels, cuts, scans=(SURVEILLANCE, BATCH), repeats=None):
+    """
+    Sweep numbers matching a set of cuts, scan types and SAILS visits.
+
+    Parameters
+    ----------
+    labels : ndarray of LABEL_DTYPE
+        from classify or sweep_labels
+    cuts : int or list of int
+        elevation cuts times 10, e.g. [5, 9]
+    scans : list of int, optional
+        scan types to keep.  The default, (SURVEILLANCE, BATCH), keeps one
+        sweep with reflectivity per visit of a cut; use (DOPPLER, BATCH)
+        for velocity.
+    repeats : list of int, optional
+        visits to keep, e.g. [0] to drop SAILS revisits.  The default
+        (None) keeps them all.
+
+    Returns
+    -------
+    sweeps : ndarray of int
+        in scan order
+
+    """
+    keep = (np.isin(labels['cut'], np.atleast_1d(cuts)) &
+            np.isin(labels['scan'], scans))
+    if repeats is not None:
+        keep &= np.isin(labels['repeat'], repeats)
+    sweeps = np.flatnonzero(keep)
+    return sweeps[np.argsort(labels['time'][sweeps], kind='stable')]
+
+
+def sweep_datetime(radar, sweep):
+    """
+    UTC time of the first ray of a sweep, to the nearest second.
+
+    The time comes from the radar's own time units.  A radar decoded from
+    only some scans (read_volume with cuts, or a chunk of a volume) counts
+    its times from the first scan decoded, not from the volume start in
+    the filename.
+
+    Parameters
+    ----------
+    radar : pyart.core.Radar
+    sweep : int
+
+    Returns
+    -------
+    time : datetime
+
+    """
+    start = radar.time['units'].split(' ')[-1].rstrip('Z')
+    first = radar.sweep_start_ray_index['data'][sweep]
+    seconds = int(round(float(radar.time['data'][first])))
+    return datetime.fromisoformat(start) + timedelta(seconds=seconds)
@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Web Mercator XYZ tiles written straight from radar sweeps.
+
+For each zoom level the tiles covering the radar's range are treated as one
+large image.  The sweep is resampled onto it with a fast_render.PixelIndex
+(cached per site, zoom and gate geometry), colored through the plts lookup
+table and cut into 256 x 256 tiles, laid out as {z}/{x}/{y}.png for web
+maps.  Tiles without any echo are not written.  A tile identical to the
+same tile of the previous volume is hard linked to it instead of being
+encoded again.  Zoom levels are resampled in parallel in a thread pool,
+and the tiles of each zoom are encoded in the same pool as soon as it is
+ready.
+
+Classes:
+    TileWriter
+
+Functions:
+    tile_range
+    tile_index
+"""
+
+import hashlib
+import math
+import os
+import shutil
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
+import numpy as np
+from fast_render import PixelIndex, write_png
+from radar_cmaps import to_rgba
+
+TILE_SIZE = 256
+# the Web Mercator square stops at this latitude
+MAX_LATITUDE = 85.0511287798
+METERS_PER_DEGREE = 111195.0
+
+
+def lon_to_tile(lon, zoom):
+    """ Fractional tile column of a longitude. """
+
+    return (np.asarray(lon) + 180.0) / 360.0 * 2**zoom
+
+
+def lat_to_tile(lat, zoom):
+    """ Fractional tile row of a latitude. """
+
+    lat = np.radians(np.clip(lat, -MAX_LATITUDE, MAX_LATITUDE))
+    return (1.0 - np.arcsinh(np.tan(lat)) / np.pi) / 2.0 * 2**zoom
+
+
+def tile_to_lat(row, zoom):
+    """ Latitude of a fractional tile row. """
+
+    return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * row / 2**zoom))))
+
+
+def tile_range(rda_lat, rda_lon, max_range, zoom):
+    """
+    Tiles covering a circle around the radar.
+
+    Parameters
+    ----------
+    rda_lat, rda_lon : float
+    max_range : float
+        radius in meters, e.g. the range of the last gate
+    zoom : int
+
+    Returns
+    -------
+    x0, y0, nx, ny : int
+        first tile column and row, number of columns and rows
+
+    """
+    dlat = max_range / METERS_PER_DEGREE
+    dlon = dlat / max(math.cos(math.radians(rda_lat)), 0.01)
+    x0 = int(lon_to_tile(rda_lon - dlon, zoom))
+    x1 = int(lon_to_tile(rda_lon + dlon, zoom))
+    y0 = int(lat_to_tile(rda_lat + dlat, zoom))
+    y1 = int(lat_to_tile(rda_lat - dlat, zoom))
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, 2**zoom - 1), min(y1, 2**zoom - 1)
+    return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+
+@lru_cache(maxsize=16)
+def tile_index(rda_lat, rda_lon, zoom, first_gate, gate_spacing, ngates,
+               elevation):
+    """
+    PixelIndex of all the tiles of a zoom level covering the radar.
+
+    Arguments must be hashable; round floats read from a radar so that the
+    volumes of one site share an index.
+
+    Returns
+    -------
+    index : fast_render.PixelIndex
+        over an image of ny * TILE_SIZE rows and nx * TILE_SIZE columns
+    x0, y0 : int
+        tile column and row of the top left tile
+
+    """
+    max_range = first_gate + gate_spacing * ngates
+    x0, y0, nx, ny = tile_range(rda_lat, rda_lon, max_range, zoom)
+    # pixel centers, in fractional tile units
+    cols = x0 + (np.arange(nx * TILE_SIZE) + 0.5) / TILE_SIZE
+    rows = y0 + (np.arange(ny * TILE_SIZE) + 0.5) / TILE_SIZE
+    lons = cols / 2**zoom * 360.0 - 180.0
+    lats = tile_to_lat(rows, zoom)
+    lons, lats = np.meshgrid(lons, lats)
+    index = PixelIndex(lons, lats, rda_lat, rda_lon, first_gate,
+                       gate_spacing, ngates, elevation)
+    return index, x0, y0
+
+
+def _replace_with_link(src, dst):
+    if os.path.lexists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        # file system without hard links
+        shutil.copyfile(src, dst)
+
+
+class TileWriter():
+    """
+    Writes the tiles of successive sweeps, reusing unchanged tiles.
+
+    Parameters
+    ----------
+    tile_dir : str
+        root directory; every frame gets its own {name}/{z}/{x}/{y}.png
+    zooms : list of int, optional
+        zoom levels written.  The default is (5, 6, 7, 8).
+    workers : int, optional
+        threads resampling zooms and encoding tiles.  The default is
+        chosen by ThreadPoolExecutor.
+
+    """
+
+    def __init__(self, tile_dir, zooms=(5, 6, 7, 8), workers=None):
+        self.tile_dir = tile_dir
+        self.zooms = zooms
+        self.workers = workers
+        # (product, z, x, y) -> (digest, path) of the last tile written
+        self.previous = {}
+
+    def write(self, radar, sweep, field, product, name):
+        """
+        Write the tiles of one sweep.
+
+        Parameters
+        ----------
+        radar : pyart.core.Radar
+        sweep : int
+        field : str
+            name of the field in radar, in the units of the plts limits
+        product : str
+            plts key giving the colormap and limits, e.g. 'Ref'
+        name : str
+            directory of this frame below tile_dir, e.g.
+            KGRR_Vel_09_20200408_0003_UTC (see pyart_plot.frame_names)
+
+        Returns
+        -------
+        counts : dict
+            number of tiles 'written', 'reused' and 'skipped' (no echo)
+
+        """
+        ranges = radar.range['data']
+        geometry = (round(float(radar.latitude['data'][0]), 4),
+                    round(float(radar.longitude['data'][0]), 4))
+        gates = (round(float(ranges[0]), 1),
+                 round(float(ranges[1] - ranges[0]), 1), len(ranges),
+                 round(float(radar.fixed_angle['data'][sweep]), 1))
+
+        def cut(zoom):
+            # resample one zoom level and slice it into tile jobs
+            index, x0, y0 = tile_index(*geometry, zoom, *gates)
+            rgba = to_rgba(product, index.resample(radar, sweep, field),
+                           bytes=True)
+            ny = rgba.shape[0] // TILE_SIZE
+            nx = rgba.shape[1] // TILE_SIZE
+            jobs = []
+            for row in range(ny):
+                for col in range(nx):
+                    tile = rgba[row * TILE_SIZE:(row + 1) * TILE_SIZE,
+                                col * TILE_SIZE:(col + 1) * TILE_SIZE]
+                    jobs.append((product, zoom, x0 + col, y0 + row, tile))
+            return jobs
+
+        def save(job):
+            product, zoom, x, y, tile = job
+            if not tile[..., 3].any():
+                return 'skipped', job, None
+            digest = hashlib.sha1(tile.tobytes()).hexdigest()
+            path = os.path.join(self.tile_dir, name, str(zoom), str(x),
+                                f'{y}.png')
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            old = self.previous.get((product, zoom, x, y))
+            if old is not None and old[0] == digest and \
+                    os.path.exists(old[1]):
+                if old[1] != path:
+                    _replace_with_link(old[1], path)
+                return 'reused', job, (digest, path)
+            # never write through a link shared with an earlier frame
+            if os.path.lexists(path):
+                os.remove(path)
+            write_png(path, np.ascontiguousarray(tile))
+            return 'written', job, (digest, path)
+
+        counts = {'written': 0, 'reused': 0, 'skipped': 0}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            zooms = [pool.submit(cut, zoom) for zoom in self.zooms]
+            saves = []
+            for done in as_completed(zooms):
+                saves.extend(pool.submit(save, job) for job in done.result())
+            for future in saves:
+                status, job, written = future.result()
+                counts[status] += 1
+                key = job[:4]
+                if written is None:
+                    self.previous.pop(key, None)
+                else:
+                    self.previous[key] = written
+        return counts
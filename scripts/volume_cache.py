@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+"""
+Disk cache of decoded level 2 volumes in a compact, memory-mapped layout.
+
+Decoding an Archive II file with pyart is the slowest step of a render, and
+the same volumes are often plotted many times with different bounds and
+products.  VolumeCache decodes a volume once and keeps one directory per
+volume, keyed by file name and size:
+
+    coords.npz            ray and gate coordinates, sweep bookkeeping
+    meta.json             attributes of every dict, field encodings
+    <field>.npy           gates of one moment, integer encoded
+
+Moments are stored as the small integers the radar sends (for example
+reflectivity as uint8 codes of 0.5 dBZ), so a field takes a quarter of the
+float32 space or less, with no loss for Archive II data.  Fields are loaded
+lazily: a field is only read and decoded when a plot first uses it, and it
+is memory mapped so only the rays of the selected sweeps are paged in.
+
+The cache keeps itself under a byte budget by evicting the volumes used
+least recently.
+
+Classes:
+    VolumeCache
+"""
+
+import json
+import os
+import shutil
+import numpy as np
+import pyart
+from pyart.lazydict import LazyLoadDict
+from level2 import read_volume
+import sweeps
+
+# dtype, scale and offset of each moment: value = code * scale + offset.
+# These are the Archive II encodings, so decoded gates round trip exactly.
+ENCODINGS = {
+    'reflectivity': ('u1', 0.5, -33.0),
+    'velocity': ('i2', 0.5, 0.0),
+    'spectrum_width': ('u1', 0.5, -64.5),
+    'differential_reflectivity': ('u1', 1 / 16, -8.0),
+    'cross_correlation_ratio': ('u1', 1 / 300, 60.5 / 300),
+    'differential_phase': ('u2', 1 / 2.8361, -2 / 2.8361),
+}
+# code of masked gates; other fields are kept as float32 with NaN
+FILL = {'u1': 0, 'u2': 0, 'i2': -32768}
+
+COORDS = ['time', 'range', 'azimuth', 'elevation', 'fixed_angle',
+          'sweep_number', 'sweep_mode', 'sweep_start_ray_index',
+          'sweep_end_ray_index', 'latitude', 'longitude', 'altitude']
+
+
+def _attrs(dic):
+    """ JSON friendly copy of a pyart dict without its data. """
+
+    return {k: (v.item() if isinstance(v, np.generic) else v)
+            for k, v in dic.items() if k != 'data'}
+
+
+def encode(data, encoding):
+    """
+    Integer codes of a masked field.
+
+    Parameters
+    ----------
+    data : masked array of float
+    encoding : tuple
+        (dtype, scale, offset) from ENCODINGS
+
+    Returns
+    -------
+    codes : ndarray of dtype
+
+    """
+    dtype, scale, offset = encoding
+    fill = FILL[dtype]
+    info = np.iinfo(dtype)
+    low = info.min + 1 if fill == info.min else fill + 1
+    values = np.ma.filled(np.ma.masked_invalid(data), np.nan)
+    codes = np.rint((values - offset) / scale)
+    codes = np.clip(np.nan_to_num(codes, nan=fill), low, info.max)
+    codes[np.isnan(values)] = fill
+    return codes.astype(dtype)
+
+
+def decode(codes, encoding):
+    """ Masked float32 field from integer codes. """
+
+    dtype, scale, offset = encoding
+    data = codes.astype(np.float32) * np.float32(scale) + np.float32(offset)
+    return np.ma.masked_where(codes == FILL[dtype], data)
+
+
+class VolumeCache():
+    """
+    Decoded volumes kept on disk between runs.
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory of the cache; created if needed
+    max_bytes : int, optional
+        disk budget.  After each new volume, the least recently used
+        volumes are removed until the cache fits.  The default is 2 GB.
+
+    """
+
+    def __init__(self, cache_dir, max_bytes=2 * 2**30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(filepath):
+        """ Cache key of an Archive II file: its name and size. """
+
+        return f'{os.path.basename(filepath)}_{os.path.getsize(filepath)}'
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def read(self, filepath, fields=None, cuts=None):
+        """
+        Radar for a volume, decoded from the cache when possible.
+
+        On a miss the whole volume is decoded and stored, so later reads
+        can ask for any fields and cuts.
+
+        Parameters
+        ----------
+        filepath : str
+            full local path to Archive 2 radar file
+        fields : list of str, optional
+            pyart fields to include.  The default (None) includes all.
+        cuts : list of int, optional
+            elevation cuts times 10 to include.  The default (None)
+            includes every sweep.  As with level2.read_volume, a
+            ValueError is raised when the volume has none of the cuts.
+
+        Returns
+        -------
+        radar : pyart.core.Radar
+            fields load lazily from memory-mapped files
+
+        """
+        key = self.key(filepath)
+        radar = self.load(key, fields, cuts)
+        if radar is None:
+            self.put(key, read_volume(filepath))
+            self.evict(keep=key)
+            radar = self.load(key, fields, cuts)
+        return radar
+
+    def put(self, key, radar):
+        """ Store a decoded volume under key. """
+
+        # unique per process so parallel workers never share a directory
+        tmp_path = self._path(key) + f'.{os.getpid()}.tmp'
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+
+        coords = {name: getattr(radar, name)['data'] for name in COORDS}
+        np.savez(os.path.join(tmp_path, 'coords.npz'), **coords)
+
+        fields = {}
+        for name, field in radar.fields.items():
+            encoding = ENCODINGS.get(name)
+            if encoding is None:
+                data = np.ma.filled(field['data'].astype(np.float32), np.nan)
+            else:
+                data = encode(field['data'], encoding)
+            np.save(os.path.join(tmp_path, name + '.npy'), data)
+            fields[name] = {'attrs': _attrs(field), 'encoding': encoding}
+
+        meta = {'coords': {name: _attrs(getattr(radar, name))
+                           for name in COORDS},
+                'metadata': _attrs(radar.metadata),
+                'scan_type': radar.scan_type,
+                'fields': fields}
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+        try:
+            os.rename(tmp_path, self._path(key))
+        except OSError:
+            # another worker stored the same volume first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def load(self, key, fields=None, cuts=None):
+        """
+        Radar from a cached volume, or None if it is not cached.
+
+        See read for the parameters.
+
+        """
+        path = self._path(key)
+        meta_path = os.path.join(path, 'meta.json')
+        try:
+            with open(meta_path) as fp:
+                meta = json.load(fp)
+            with np.load(os.path.join(path, 'coords.npz')) as npz:
+                coords = {name: npz[name] for name in COORDS}
+        except (OSError, ValueError, KeyError):
+            return None
+        # the modification time of meta.json records the last use
+        os.utime(meta_path)
+
+        starts = coords['sweep_start_ray_index']
+        ends = coords['sweep_end_ray_index']
+        keep = np.arange(len(starts))
+        if cuts is not None:
+            labels = sweeps.classify(coords['fixed_angle'],
+                                     coords['time'][starts])
+            keep = np.flatnonzero(np.isin(labels['cut'], cuts))
+            if len(keep) == 0:
+                raise ValueError(f'volume has none of the cuts {cuts}')
+        rays = np.concatenate([np.arange(starts[s], ends[s] + 1)
+                               for s in keep]).astype(int)
+        whole = len(rays) == len(coords['time'])
+
+        def coord(name, data):
+            dic = dict(meta['coords'][name])
+            dic['data'] = data
+            return dic
+
+        counts = ends[keep] - starts[keep] + 1
+        new_starts = np.cumsum(counts) - counts
+        sweep_mode = coords['sweep_mode'][keep]
+        radar = pyart.core.Radar(
+            coord('time', coords['time'][rays]),
+            coord('range', coords['range']),
+            {}, dict(meta['metadata']), meta['scan_type'],
+            coord('latitude', coords['latitude']),
+            coord('longitude', coords['longitude']),
+            coord('altitude', coords['altitude']),
+            coord('sweep_number', np.arange(len(keep), dtype=np.int32)),
+            coord('sweep_mode', sweep_mode),
+            coord('fixed_angle', coords['fixed_angle'][keep]),
+            coord('sweep_start_ray_index', new_starts.astype(np.int32)),
+            coord('sweep_end_ray_index',
+                  (new_starts + counts - 1).astype(np.int32)),
+            coord('azimuth', coords['azimuth'][rays]),
+            coord('elevation', coords['elevation'][rays]))
+
+        for name, info in meta['fields'].items():
+            if fields is not None and name not in fields:
+                continue
+            field = LazyLoadDict(info['attrs'])
+            field.set_lazy('data', _FieldLoader(
+                os.path.join(path, name + '.npy'), info['encoding'],
+                None if whole else rays))
+            radar.fields[name] = field
+        return radar
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used volumes until the cache fits.
+
+        Parameters
+        ----------
+        keep : str, optional
+            key that is never evicted, e.g. the volume just stored
+
+        """
+        entries = []
+        total = 0
+        for key in os.listdir(self.cache_dir):
+            path = self._path(key)
+            if key.endswith('.tmp') or not os.path.isdir(path):
+                continue
+            size = sum(entry.stat().st_size for entry in os.scandir(path))
+            try:
+                used = os.path.getmtime(os.path.join(path, 'meta.json'))
+            except OSError:
+                used = 0
+            entries.append((used, key, size))
+            total += size
+
+        for used, key, size in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+
+
+class _FieldLoader():
+    """ Picklable callable decoding one cached field on first use. """
+
+    def __init__(self, path, encoding, rays):
+        self.path = path
+        self.encoding = encoding
+        self.rays = rays
+
+    def __call__(self):
+        codes = np.load(self.path, mmap_mode='r')
+        if self.rays is not None:
+            codes = codes[self.rays]
+        if self.encoding is None:
+            return np.ma.masked_invalid(np.array(codes))
+        return decode(codes, self.encoding)
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+""" The modules under test live in scripts/, which is not a package. """
+
+import bz2
+import os
+import struct
+import sys
+import matplotlib
+import pytest
+
+matplotlib.use('Agg')
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'scripts'))
+
+from pyart.testing import NEXRAD_ARCHIVE_MSG31_FILE  # noqa: E402
+from chunks_ingest import MSG31_ELEVATION_OFFSET  # noqa: E402
+from level2 import (CTM_SIZE, METADATA_MESSAGES, MSG31_STATUS_OFFSET,  # noqa
+                    MSG5_CUT_SIZE, MSG5_HEADER, MSG5_HEADER_SIZE,
+                    MSG_HEADER_SIZE, RECORD_SIZE, VOLUME_HEADER_SIZE,
+                    iter_messages)
+
+# seconds after the volume start of the SAILS revisit in sails_volume
+REVISIT_SECONDS = 300
+RADIALS_PER_RECORD = 120
+
+
+def _body(pos, offset):
+    # offset of a field of the message 31 body at pos
+    return pos + CTM_SIZE + MSG_HEADER_SIZE + offset
+
+
+@pytest.fixture(scope='session')
+def sails_volume(tmp_path_factory):
+    """
+    The pyart sample volume as a real-time style Archive II file.
+
+    The sample is one bzip2 stream; here its messages are split into LDM
+    records of RADIALS_PER_RECORD radials like the files in the buckets.
+    A SAILS revisit of the 0.5 degree surveillance scan is added as a
+    17th cut, REVISIT_SECONDS after the volume start.
+
+    """
+    with bz2.open(NEXRAD_ARCHIVE_MSG31_FILE) as fh:
+        raw = fh.read()
+    header = raw[:VOLUME_HEADER_SIZE]
+    body = bytearray(raw[VOLUME_HEADER_SIZE:])
+    metadata_size = METADATA_MESSAGES * RECORD_SIZE
+
+    # the VCP gets a copy of its first cut at the end
+    for msg_type, pos in iter_messages(body):
+        if msg_type == 5:
+            vcp = pos + CTM_SIZE + MSG_HEADER_SIZE
+            ncuts = MSG5_HEADER.unpack_from(body, vcp)[3]
+            first = vcp + MSG5_HEADER_SIZE
+            added = first + ncuts * MSG5_CUT_SIZE
+            body[added:added + MSG5_CUT_SIZE] = \
+                body[first:first + MSG5_CUT_SIZE]
+            struct.pack_into('>H', body, vcp + 6, ncuts + 1)
+            break
+
+    found = [(msg_type, pos) for msg_type, pos in iter_messages(body)
+             if pos >= metadata_size]
+    ends = [pos for _, pos in found[1:]] + [len(body)]
+    radials = [bytearray(body[pos:end])
+               for (msg_type, pos), end in zip(found, ends)
+               if msg_type == 31]
+
+    revisit = []
+    for radial in radials:
+        if radial[_body(0, MSG31_ELEVATION_OFFSET)] == 1:
+            radial = bytearray(radial)
+            collect_ms = struct.unpack_from('>I', radial, _body(0, 4))[0]
+            struct.pack_into('>I', radial, _body(0, 4),
+                             collect_ms + REVISIT_SECONDS * 1000)
+            radial[_body(0, MSG31_ELEVATION_OFFSET)] = ncuts + 1
+            revisit.append(radial)
+    # the volume now ends with the revisit
+    radials[-1][_body(0, MSG31_STATUS_OFFSET)] = 2
+    revisit[-1][_body(0, MSG31_STATUS_OFFSET)] = 4
+    radials += revisit
+
+    records = [bytes(body[:metadata_size])]
+    for n in range(0, len(radials), RADIALS_PER_RECORD):
+        records.append(b''.join(radials[n:n + RADIALS_PER_RECORD]))
+    path = tmp_path_factory.mktemp('sails') / 'KATX20130717_195021_V06'
+    with open(path, 'wb') as fh:
+        fh.write(header)
+        for record in records:
+            data = bz2.compress(record)
+            fh.write(struct.pack('>i', len(data)) + data)
+    return str(path)
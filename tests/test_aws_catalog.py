@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+""" Listing, matching and watching against a local stand-in bucket. """
+
+import os
+from datetime import datetime, timedelta
+import numpy as np
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from aws_catalog import (FileIndex, NexradLevel2, match_volumes, scan_datetime,
+                         scan_times)
+
+
+class FlakyFileSystem(LocalFileSystem):
+    """ Fails to open the paths in fail the given number of times. """
+
+    def __init__(self, fail):
+        super().__init__(skip_instance_cache=True)
+        self.fail = dict(fail)
+
+    def open(self, path, *args, **kwargs):
+        for key, count in self.fail.items():
+            if path.endswith(key) and count:
+                self.fail[key] -= 1
+                raise OSError('transient error')
+        return super().open(path, *args, **kwargs)
+
+
+class CountingFileSystem(LocalFileSystem):
+    """ Counts the directories listed. """
+
+    def __init__(self):
+        super().__init__(skip_instance_cache=True)
+        self.listed = []
+
+    def ls(self, path, *args, **kwargs):
+        self.listed.append(path)
+        return super().ls(path, *args, **kwargs)
+
+
+def stage(bucket, name):
+    day_dir = os.path.join(bucket, name[4:8], name[8:10], name[10:12],
+                           name[:4])
+    os.makedirs(day_dir, exist_ok=True)
+    with open(os.path.join(day_dir, name), 'wb') as fp:
+        fp.write(name.encode())
+
+
+def follow(tmp_path, fs, arrivals, polls, **kwargs):
+    """ Run watch; arrivals[n] are staged while waiting after poll n. """
+
+    bucket = str(tmp_path / 'bucket')
+    stage(bucket, 'KATX20130717_194821_V06')
+    stage(bucket, 'KATX20130717_195021_V06')
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        for name in arrivals.get(len(waits), []):
+            stage(bucket, name)
+
+    nexrad = NexradLevel2('KATX', datetime(2013, 7, 17, 19, 50, 21),
+                          datetime(2013, 7, 17, 23), fs=fs, bucket=bucket)
+    # (filename, status) yielded by each poll
+    results = {}
+    for key, result in nexrad.watch(
+            str(tmp_path / 'raw'), interval=60, max_interval=600,
+            now=lambda: datetime(2013, 7, 17, 20), sleep=sleep,
+            polls=polls, **kwargs):
+        results.setdefault(len(waits), []).append(
+            (key.split('/')[-1], result['status']))
+    return [results.get(n, []) for n in range(polls)], waits
+
+
+def test_yields_new_volumes_once(tmp_path):
+    results, waits = follow(tmp_path, LocalFileSystem(),
+                            {2: ['KATX20130717_195221_V06']}, polls=4)
+    assert results == [[('KATX20130717_195021_V06', 'downloaded')],
+                       [],
+                       [('KATX20130717_195221_V06', 'downloaded')],
+                       []]
+    # the wait doubles while nothing arrives
+    assert waits == [60, 120, 60]
+
+
+def test_retries_failed_downloads(tmp_path):
+    fs = FlakyFileSystem({'KATX20130717_195021_V06': 1})
+    results, waits = follow(tmp_path, fs, {1: ['KATX20130717_195221_V06']},
+                            polls=3)
+    assert results == [[('KATX20130717_195021_V06', 'failed')],
+                       [('KATX20130717_195021_V06', 'downloaded'),
+                        ('KATX20130717_195221_V06', 'downloaded')],
+                       []]
+    assert os.path.exists(tmp_path / 'raw' / 'KATX20130717_195021_V06')
+
+
+def test_gives_up_after_retries(tmp_path):
+    fs = FlakyFileSystem({'KATX20130717_195021_V06': 10})
+    results, waits = follow(tmp_path, fs, {}, polls=4, retries=2)
+    assert results == [[('KATX20130717_195021_V06', 'failed')]] * 3 + [[]]
+    assert waits == [60, 60, 120]
+
+
+def test_scan_times_matches_scan_datetime():
+    names = ['noaa/2018/07/19/KDMX/KDMX20180719_221153_V06',
+             'KDMX20180719_221153_V06_MDM', 'KDMX20180230_221153_V06',
+             'KDMX20180719_241153_V06', 'KDMX20180719_226053_V06',
+             'KDMX20180719_221160_V06', 'KDMX20181331_221153_V06',
+             'KDMX20181231_235959_V06.gz', 'KDMX20200229_000000_V06',
+             'KDMX20190229_000000_V06', 'KDMX20180719_2211', 'KDMX2018',
+             '', 'KDMX20180719_221153', 'KDMXabcdefgh_221153_V06',
+             'KDMX2018 719_221153_V06', 'KDMX20180719-221153_V06']
+    rng = np.random.default_rng(0)
+    start = datetime(1991, 1, 1)
+    names += [f'KTLX{start + timedelta(seconds=int(s)):%Y%m%d_%H%M%S}_V06'
+              for s in rng.integers(0, 40 * 365 * 86400, 2000)]
+    alphabet = list('0123456789_ ')
+    names += ['KDMX' + ''.join(rng.choice(alphabet, rng.integers(0, 20)))
+              for _ in range(2000)]
+
+    expected = [scan_datetime(name) for name in names]
+    times = scan_times(names)
+    assert [None if np.isnat(t) else t.astype(object) for t in times] == \
+        expected
+    assert expected[:3] == [datetime(2018, 7, 19, 22, 11, 53), None, None]
+    assert expected[10] is None
+
+
+@pytest.fixture
+def index():
+    times = [datetime(2013, 7, 17, 10, 0), datetime(2013, 7, 17, 10, 10),
+             datetime(2013, 7, 17, 10, 20)]
+    return FileIndex((f'KATX{t:%Y%m%d_%H%M%S}_V06', 1, t) for t in times)
+
+
+@pytest.mark.parametrize('mode, expected', [
+    ('nearest', [0, 0, 1, 0, 1, 2]),
+    ('before', [-1, 0, 1, 0, 0, 2]),
+    ('after', [0, 1, 1, 1, 1, -1])])
+def test_match_modes(index, mode, expected):
+    queries = [datetime(2013, 7, 17, 9), datetime(2013, 7, 17, 10, 4),
+               datetime(2013, 7, 17, 10, 10), datetime(2013, 7, 17, 10, 5),
+               datetime(2013, 7, 17, 10, 9), datetime(2013, 7, 17, 11)]
+    # 10:05 is a tie between 10:00 and 10:10, which goes to the earlier
+    assert list(index.match(queries, mode)) == expected
+
+
+def test_match_tolerance(index):
+    queries = [datetime(2013, 7, 17, 10, 4), datetime(2013, 7, 17, 10, 5),
+               datetime(2013, 7, 17, 10, 9), datetime(2013, 7, 17, 11)]
+    tolerance = timedelta(minutes=4)
+    assert list(index.match(queries, 'nearest', tolerance)) == \
+        [0, -1, 1, -1]
+    assert list(index.match(queries, 'before', tolerance)) == \
+        [0, -1, -1, -1]
+    assert list(index.match(queries, 'after', tolerance)) == \
+        [-1, -1, 1, -1]
+    assert list(FileIndex().match(queries, 'nearest', tolerance)) == [-1] * 4
+    with pytest.raises(ValueError):
+        index.match(queries, 'closest')
+
+
+def test_match_volumes_across_midnight(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    for name in ('KATX20130716_235800_V06', 'KATX20130717_000300_V06',
+                 'KATX20130717_000300_V06_MDM', 'KTLX20130717_000100_V06'):
+        stage(bucket, name)
+    fs = CountingFileSystem()
+    midnight = datetime(2013, 7, 17)
+    queries = [('KATX', midnight), ('KTLX', midnight),
+               ('KATX', midnight + timedelta(minutes=2)),
+               ('KAAA', midnight), ('KATX', midnight - timedelta(hours=1))]
+
+    def names(results):
+        return [None if r is None else r[0].split('/')[-1] for r in results]
+
+    assert names(match_volumes(queries, fs=fs, bucket=bucket)) == [
+        'KATX20130716_235800_V06', 'KTLX20130717_000100_V06',
+        'KATX20130717_000300_V06', None, None]
+    # each site and day is listed once
+    assert len(fs.listed) == len(set(fs.listed))
+
+    results = match_volumes(queries[:1], 'after', fs=fs, bucket=bucket)
+    assert results == [(f'{bucket}/2013/07/17/KATX/KATX20130717_000300_V06',
+                        datetime(2013, 7, 17, 0, 3))]
+    assert match_volumes(queries[:1], tolerance=timedelta(minutes=1),
+                         fs=fs, bucket=bucket) == [None]
+    # without a tolerance only the day of each time is listed
+    assert names(match_volumes(
+        [('KATX', midnight + timedelta(hours=12))], tolerance=None, fs=fs,
+        bucket=bucket)) == ['KATX20130717_000300_V06']
@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+""" ChunkIngester against a locally staged chunks bucket. """
+
+import bz2
+import os
+import shutil
+import struct
+from datetime import timedelta
+import numpy as np
+import pyart
+import pytest
+from fsspec.implementations.local import LocalFileSystem
+from chunks_ingest import (MAX_VOLUME, ChunkIngester, read_sweeps,
+                           stage_chunks)
+from level2 import CTM_SIZE, MSG_HEADER_SIZE, RECORD_SIZE, VOLUME_HEADER_SIZE
+import sweeps
+
+# a split 0.5 degree cut, then 1.5 and 2.4 degrees
+ANGLES = (0.5, 0.5, 1.5, 2.4)
+RADIALS = 3
+
+
+def message(msg_type, body):
+    size = (MSG_HEADER_SIZE + len(body)) // 2
+    return (bytes(CTM_SIZE) + struct.pack('>HBB', size, 0, msg_type) +
+            bytes(MSG_HEADER_SIZE - 4) + body)
+
+
+def record(messages):
+    data = bz2.compress(b''.join(messages))
+    return struct.pack('>i', len(data)) + data
+
+
+def write_volume(directory, name):
+    """ Volume with a VCP and RADIALS message 31 radials per scan. """
+
+    vcp = struct.pack('>HHHH', 0, 0, 212, len(ANGLES)) + bytes(14)
+    for angle in ANGLES:
+        vcp += struct.pack('>HBB', int(round(angle / 360.0 * 65536)), 0,
+                           1) + bytes(42)
+    metadata = message(5, vcp)
+    metadata += bytes(RECORD_SIZE - len(metadata))
+
+    records = [record([metadata])]
+    for n in range(len(ANGLES)):
+        radials = []
+        for r in range(RADIALS):
+            status = 0 if r == 0 else 1
+            if r == RADIALS - 1:
+                status = 4 if n == len(ANGLES) - 1 else 2
+            body = bytearray(32)
+            body[21] = status
+            body[22] = n + 1
+            radials.append(message(31, bytes(body)))
+        records.append(record(radials))
+
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as fh:
+        fh.write(b'AR2V0006.001'.ljust(VOLUME_HEADER_SIZE, b'\0'))
+        fh.write(b''.join(records))
+    return path
+
+
+def summary(sweeps):
+    return [(s['name'], s['volume'], s['scan'], s['cut'], s['visit'],
+             s['last_of_cut']) for s in sweeps]
+
+
+def volume_bytes(sweep):
+    return bytes(sweep['buffer'][:sweep['nbytes']])
+
+
+def expected(name, volume):
+    return [(name, volume, 0, 5, [0], False),
+            (name, volume, 1, 5, [0, 1], True),
+            (name, volume, 2, 15, [2], True),
+            (name, volume, 3, 24, [3], True)]
+
+
+def test_publishes_every_scan(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    path = write_volume(str(tmp_path), 'KATX20130717_170602_V06')
+    stage_chunks(path, bucket, volume=7)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket)
+
+    sweeps = ingester.poll()
+    assert ingester.latest_volume() == 7
+    assert summary(sweeps) == expected('KATX20130717_170602_V06', 7)
+    with open(path, 'rb') as fh:
+        assert volume_bytes(sweeps[-1]) == fh.read()
+    # the next volume has not started yet
+    assert ingester.volume == 8
+    assert ingester.poll() == []
+
+
+def test_chunks_arrive_one_at_a_time(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    path = write_volume(str(tmp_path), 'KATX20130717_170602_V06')
+    chunks = stage_chunks(path, str(tmp_path / 'staged'), volume=7)
+    volume_dir = os.path.join(bucket, 'KATX', '7')
+    os.makedirs(volume_dir)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket,
+                             volume=7)
+
+    published = []
+    for chunk in chunks:
+        shutil.copy(chunk, volume_dir)
+        published.append([s['scan'] for s in ingester.poll()])
+    # the S chunk only holds metadata, every other chunk ends one scan
+    assert published == [[], [0], [1], [2], [3]]
+
+
+def test_wraps_around_past_max_volume(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    old = write_volume(str(tmp_path), 'KATX20130717_165602_V06')
+    new = write_volume(str(tmp_path), 'KATX20130717_170602_V06')
+    stale = write_volume(str(tmp_path), 'KATX20130714_101500_V06')
+    stage_chunks(old, bucket, volume=MAX_VOLUME)
+    # volume 1 still holds a volume from before the numbers wrapped
+    stage_chunks(stale, bucket, volume=1)
+    stage_chunks(new, bucket, volume=1)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket)
+
+    assert ingester.latest_volume() == 1
+    ingester.volume = MAX_VOLUME
+    sweeps = ingester.poll()
+    assert summary(sweeps) == (
+        expected('KATX20130717_165602_V06', MAX_VOLUME) +
+        expected('KATX20130717_170602_V06', 1))
+    with open(new, 'rb') as fh:
+        assert volume_bytes(sweeps[-1]) == fh.read()
+    assert ingester.volume == 2
+
+
+def test_ignores_leftover_chunks_of_an_older_volume(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    new = write_volume(str(tmp_path), 'KATX20130717_170602_V06')
+    stale = write_volume(str(tmp_path), 'KATX20130714_101500_V06')
+    new_chunks = stage_chunks(new, bucket, volume=7)
+    stale_chunks = stage_chunks(stale, bucket, volume=7)
+    # only the S chunk of the new volume has arrived, next to chunk 2 of
+    # the volume scanned before the wrap around
+    for chunk in new_chunks[1:]:
+        os.remove(chunk)
+    for n, chunk in enumerate(stale_chunks):
+        if n != 1:
+            os.remove(chunk)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket,
+                             volume=7)
+
+    assert ingester.poll() == []
+    assert ingester.name == 'KATX20130717_170602_V06'
+    assert ingester.next_chunk == 2
+
+    # the rest of the new volume arrives
+    stage_chunks(new, bucket, volume=7)
+    assert summary(ingester.poll()) == expected('KATX20130717_170602_V06', 7)
+
+
+def test_gives_up_on_a_volume_missing_a_chunk(tmp_path):
+    bucket = str(tmp_path / 'bucket')
+    lost = write_volume(str(tmp_path), 'KATX20130717_170602_V06')
+    new = write_volume(str(tmp_path), 'KATX20130717_171602_V06')
+    os.remove(stage_chunks(lost, bucket, volume=7)[2])
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket,
+                             volume=7)
+
+    # chunk 3 never arrives
+    assert [s['scan'] for s in ingester.poll()] == [0]
+    assert ingester.poll() == []
+    assert ingester.volume == 7
+
+    stage_chunks(new, bucket, volume=8)
+    assert summary(ingester.poll()) == expected('KATX20130717_171602_V06', 8)
+    assert ingester.volume == 9
+
+
+def test_decodes_published_sweeps(tmp_path, sails_volume):
+    bucket = str(tmp_path / 'bucket')
+    stage_chunks(sails_volume, bucket, volume=7)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket)
+    published = ingester.poll()
+    full = pyart.io.read_nexrad_archive(sails_volume)
+
+    assert len(published) == full.nsweeps == 17
+    assert [s['cut'] for s in published[:3]] == [5, 5, 15]
+    assert published[-1]['cut'] == 5
+    assert published[-1]['visit'] == [16]
+    assert [s['last_of_cut'] for s in published[:3]] == [False, True, False]
+    # every sweep shares the buffer of the volume
+    assert len({id(s['buffer']) for s in published}) == 1
+    with open(sails_volume, 'rb') as fh:
+        assert volume_bytes(published[-1]) == fh.read()
+
+    for sweep in (published[1], published[-1]):
+        radar = read_sweeps(sweep, fields=['reflectivity'])
+        assert radar.nsweeps == len(sweep['visit'])
+        first = sweep['visit'][0]
+        start = full.sweep_start_ray_index['data'][first]
+        end = full.sweep_end_ray_index['data'][first] + 1
+        np.testing.assert_array_equal(
+            radar.get_field(0, 'reflectivity'),
+            full.fields['reflectivity']['data'][start:end])
+
+
+def test_visits_of_a_cut_get_their_own_names(tmp_path, sails_volume):
+    bucket = str(tmp_path / 'bucket')
+    stage_chunks(sails_volume, bucket, volume=7)
+    ingester = ChunkIngester('KATX', fs=LocalFileSystem(), bucket=bucket)
+    first, revisit = [s for s in ingester.poll()
+                      if s['cut'] == 5 and s['last_of_cut']]
+    radars = [read_sweeps(sweep, fields=['reflectivity'])
+              for sweep in (first, revisit)]
+    times = [sweeps.sweep_datetime(radar, 0) for radar in radars]
+    # the revisit of sails_volume comes five minutes after the first visit
+    assert times[1] - times[0] == timedelta(minutes=5)
+
+    # pyart_plot needs the site settings of configlocal
+    pyart_plot = pytest.importorskip('pyart_plot')
+    names = [pyart_plot.frame_names(radar, pyart.graph.RadarMapDisplay(
+        radar), 0)[1] for radar in radars]
+    assert names == ['KATX_20130717_1950_UTC.png',
+                     'KATX_20130717_1955_UTC.png']
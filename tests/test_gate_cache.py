@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+""" Projected gate grids are shared by the volumes of one site. """
+
+import numpy as np
+import pytest
+from pyart.testing import make_empty_ppi_radar
+from frame_renderer import FrameRenderer
+from gate_cache import GateCache
+
+RDA_LAT, RDA_LON = 36.5, -97.5
+EXTENT = (-98.0, -97.0, 36.0, 37.0)
+
+
+def fake_volume(azimuths):
+    radar = make_empty_ppi_radar(50, len(azimuths), 1)
+    radar.range['data'] = 2125.0 + 250.0 * np.arange(50)
+    radar.azimuth['data'] = np.asarray(azimuths, dtype=float)
+    radar.add_field('reflectivity', {'data': np.ma.array(
+        np.random.default_rng(0).uniform(-30, 80, (len(azimuths), 50)))})
+    return radar
+
+
+def full_circle(rng, nrays=720):
+    # super resolution rays starting at a random ray and jittered by a few
+    # thousandths of a degree, like real volumes
+    azimuths = np.arange(nrays) * 360.0 / nrays + 180.0 / nrays
+    azimuths = np.roll(azimuths, rng.integers(nrays))
+    return (azimuths + rng.normal(0, 0.005, nrays)) % 360.0
+
+
+@pytest.fixture
+def builds(monkeypatch):
+    """ Azimuths of every gate grid projected. """
+
+    azimuths = []
+    build = GateCache.build
+
+    def counted(map_crs, radar_crs, az, ranges, elevation):
+        azimuths.append(np.array(az))
+        return build(map_crs, radar_crs, az, ranges, elevation)
+
+    monkeypatch.setattr(GateCache, 'build', staticmethod(counted))
+    return azimuths
+
+
+def render_all(radars, image_dir, gate_cache=None):
+    """ Render one frame per radar; the mesh of every frame. """
+
+    renderer = FrameRenderer(RDA_LAT, RDA_LON, EXTENT, cmap='viridis',
+                             vmin=-30, vmax=80, gate_cache=gate_cache)
+    meshes = []
+    try:
+        for n, radar in enumerate(radars):
+            renderer.render(radar, 0, 'reflectivity', str(n),
+                            str(image_dir / f'{n}.png'))
+            meshes.append(renderer.mesh)
+    finally:
+        renderer.close()
+    return meshes
+
+
+def test_volumes_of_one_vcp_share_a_grid(builds, tmp_path):
+    rng = np.random.default_rng(0)
+    radars = [fake_volume(full_circle(rng)) for _ in range(4)]
+    cache = GateCache(str(tmp_path / 'cache'))
+
+    meshes = render_all(radars, tmp_path, cache)
+    assert len(builds) == 1
+    assert all(mesh is meshes[0] for mesh in meshes)
+    # full circles are drawn from 0 degrees whatever ray they start at
+    assert 0 < builds[0][0] < 0.5
+    assert np.all(np.diff(builds[0]) > 0)
+
+    # a later run finds the grid on disk
+    assert len(list((tmp_path / 'cache').glob('*.npz'))) == 1
+    render_all(radars[:1], tmp_path, GateCache(str(tmp_path / 'cache')))
+    assert len(builds) == 1
+
+
+def test_sector_scan_starts_after_its_gap(builds, tmp_path):
+    azimuths = np.roll(np.arange(300.0, 420.0, 0.5) % 360.0, 30)
+    render_all([fake_volume(azimuths)], tmp_path, GateCache())
+    assert builds[0][0] == 300.0
+    assert builds[0][-1] == 419.5
+    assert np.all(np.diff(builds[0]) > 0)
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+""" Reading only some elevation cuts of a volume. """
+
+import pytest
+from pyart.testing import (NEXRAD_ARCHIVE_MSG31_COMPRESSED_FILE,
+                           NEXRAD_ARCHIVE_MSG31_FILE)
+from fsspec.implementations.local import LocalFileSystem
+from level2 import read_remote, read_volume
+
+
+def test_reads_both_scans_of_a_split_cut():
+    radar = read_volume(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[5])
+    assert radar.nsweeps == 2
+    assert read_volume(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[24]).nsweeps == 1
+
+
+def test_cut_not_in_the_vcp():
+    with pytest.raises(ValueError):
+        read_volume(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[25])
+    with pytest.raises(ValueError):
+        read_remote(LocalFileSystem(), NEXRAD_ARCHIVE_MSG31_COMPRESSED_FILE,
+                    cuts=[25])
+
+
+def test_cut_missing_from_a_truncated_volume():
+    # the sample only holds the first scan of the 16 its VCP lists
+    assert read_volume(NEXRAD_ARCHIVE_MSG31_COMPRESSED_FILE,
+                       cuts=[5]).nsweeps == 1
+    with pytest.raises(ValueError):
+        read_volume(NEXRAD_ARCHIVE_MSG31_COMPRESSED_FILE, cuts=[24])
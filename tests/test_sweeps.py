@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+""" Sweep times do not depend on which scans were decoded. """
+
+import pyart
+import pytest
+from pyart.testing import NEXRAD_ARCHIVE_MSG31_FILE
+from level2 import read_volume
+from volume_cache import VolumeCache
+import sweeps
+
+
+@pytest.fixture(scope='module')
+def volumes(tmp_path_factory):
+    cache = VolumeCache(str(tmp_path_factory.mktemp('volume_cache')))
+    return {'full': read_volume(NEXRAD_ARCHIVE_MSG31_FILE),
+            'cuts': read_volume(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[24]),
+            'cached': cache.read(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[24])}
+
+
+def sweep_of(radar, cut):
+    return int(sweeps.select(sweeps.sweep_labels(radar), cut)[0])
+
+
+def test_sweep_datetime(volumes):
+    times = {name: sweeps.sweep_datetime(radar, sweep_of(radar, 24))
+             for name, radar in volumes.items()}
+    assert len(set(times.values())) == 1
+    # 78 seconds after the volume start in the filename, 19:50:21
+    assert times['full'].isoformat() == '2013-07-17T19:51:39'
+
+
+def test_frame_names(volumes):
+    # pyart_plot needs the site settings of configlocal
+    pyart_plot = pytest.importorskip('pyart_plot')
+    names = set()
+    for radar in volumes.values():
+        display = pyart.graph.RadarMapDisplay(radar)
+        names.add(pyart_plot.frame_names(radar, display,
+                                         sweep_of(radar, 24), 'Ref', 24))
+    assert len(names) == 1
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+""" Tiles of successive sweeps, with unchanged tiles reused. """
+
+import os
+import pyart
+from pyart.testing import NEXRAD_ARCHIVE_MSG31_FILE
+from tiles import TileWriter
+
+
+def test_unchanged_tiles_are_linked(tmp_path):
+    radar = pyart.io.read_nexrad_archive(NEXRAD_ARCHIVE_MSG31_FILE)
+    writer = TileWriter(str(tmp_path), zooms=(5, 6, 7), workers=4)
+
+    first = writer.write(radar, 0, 'reflectivity', 'Ref', 'a')
+    assert first['written'] > 0 and first['reused'] == 0
+    again = writer.write(radar, 0, 'reflectivity', 'Ref', 'b')
+    assert again == {'written': 0, 'reused': first['written'],
+                     'skipped': first['skipped']}
+
+    for zoom in (5, 6, 7):
+        assert os.path.isdir(tmp_path / 'a' / str(zoom))
+    for path in (tmp_path / 'b').rglob('*.png'):
+        relative = path.relative_to(tmp_path / 'b')
+        assert os.path.samefile(path, tmp_path / 'a' / relative)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+""" Cached volumes give the same sweeps as decoding the file. """
+
+import pytest
+from pyart.testing import NEXRAD_ARCHIVE_MSG31_FILE
+from level2 import read_volume
+from volume_cache import VolumeCache
+
+
+@pytest.mark.parametrize('cuts', [None, [5], [5, 24]])
+def test_hit_matches_read_volume(tmp_path, cuts):
+    cache = VolumeCache(str(tmp_path))
+    cache.read(NEXRAD_ARCHIVE_MSG31_FILE)
+    radar = cache.read(NEXRAD_ARCHIVE_MSG31_FILE, cuts=cuts)
+    expected = read_volume(NEXRAD_ARCHIVE_MSG31_FILE, cuts=cuts)
+    assert list(radar.fixed_angle['data']) == \
+        list(expected.fixed_angle['data'])
+    assert radar.nrays == expected.nrays
+
+
+def test_cut_not_in_the_volume(tmp_path):
+    cache = VolumeCache(str(tmp_path))
+    # on a miss and on a hit, like read_volume
+    for _ in range(2):
+        with pytest.raises(ValueError):
+            cache.read(NEXRAD_ARCHIVE_MSG31_FILE, cuts=[25])